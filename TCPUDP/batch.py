@@ -0,0 +1,179 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import namedtuple
+
+import client
+import client_api
+
+# Batch mode for the client: runs the operations listed in a manifest
+# against the server, several at once, and reports aggregate throughput.
+#
+#   python batch.py manifest.txt --host 127.0.0.1 --concurrency 8 --retries 2
+#
+# Each line of the manifest is one operation, in the syntax of the
+# interactive client plus optional local paths:
+#
+#   put <local path> [<name on the server>] [tcp|udp|dedup]
+#   get <name on the server> [<local path>] [tcp|udp]
+#   change <old name> <new name>
+#   summary <name on the server>
+#
+# Blank lines and lines starting with # are skipped. Operations start in
+# manifest order, at most --concurrency at a time over a pool of as many
+# connections (see client_api.py), so a line must not depend on an earlier
+# one finishing first; run such steps as separate manifests. Failed
+# operations are retried --retries times. The report lists per-operation
+# counts and latencies, the bytes moved over the wall-clock time and every
+# failure; the exit status is 1 if anything failed.
+
+CONCURRENCY = 4
+TRANSPORTS = ('tcp', 'udp', 'dedup')  # dedup only for put (see client_api.Client.put)
+ARGUMENT_COUNTS = {'put': (1, 2), 'get': (1, 2), 'change': (2, 2), 'summary': (1, 1)}  # (least, most)
+
+Operation = namedtuple('Operation', 'line command args transport')
+Outcome = namedtuple('Outcome', 'operation seconds size error')
+
+
+class ManifestError(Exception):
+    pass
+
+
+# Parse the text of a manifest into a list of Operations
+def parse_manifest(text):
+    operations = []
+    for number, line in enumerate(text.splitlines(), 1):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        command, args = words[0].lower(), words[1:]
+        transport = 'tcp'
+        if command in ('put', 'get') and args and args[-1].lower() in TRANSPORTS:
+            transport = args.pop().lower()
+        if command not in ARGUMENT_COUNTS:
+            raise ManifestError(f"Line {number}: unknown operation {words[0]}")
+        if transport == 'dedup' and command != 'put':
+            raise ManifestError(f"Line {number}: only put can be deduplicated")
+        least, most = ARGUMENT_COUNTS[command]
+        if not least <= len(args) <= most:
+            raise ManifestError(f"Line {number}: {command} takes {least} to {most} arguments")
+        operations.append(Operation(number, command, args, transport))
+    return operations
+
+
+# Run one operation; returns the bytes it transferred
+async def perform(api, operation):
+    args = operation.args
+    if operation.command == 'put':
+        return (await api.put(args[0], args[1] if len(args) > 1 else None, operation.transport)).size
+    if operation.command == 'get':
+        return (await api.get(args[0], args[1] if len(args) > 1 else None, operation.transport)).size
+    if operation.command == 'change':
+        await api.rename(args[0], args[1])
+    else:
+        await api.summary(args[0])
+    return 0
+
+
+# Run the operations, at most concurrency at a time; returns their Outcomes
+# in manifest order and the number of retries
+async def run_batch(operations, host, port, udp_port, concurrency=CONCURRENCY, retries=client_api.RETRIES):
+    slots = asyncio.Semaphore(concurrency)
+    async with client_api.AsyncClient(host, port, udp_port, pool_size=concurrency, retries=retries) as api:
+
+        async def run(operation):
+            async with slots:
+                started = time.perf_counter()
+                try:
+                    size = await perform(api, operation)
+                except (client_api.ClientError, OSError, RuntimeError) as e:
+                    return Outcome(operation, time.perf_counter() - started, 0, str(e))
+                return Outcome(operation, time.perf_counter() - started, size, None)
+
+        outcomes = await asyncio.gather(*(run(operation) for operation in operations))
+        return outcomes, api.client.retried
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+# Aggregate Outcomes into a dict for the report
+def summarize(outcomes, seconds, retries):
+    per_command = {}
+    for outcome in outcomes:
+        per_command.setdefault(outcome.operation.command, []).append(outcome)
+    commands = {}
+    for command, group in per_command.items():
+        latencies = [outcome.seconds for outcome in group]
+        commands[command] = {
+            'ok': sum(outcome.error is None for outcome in group),
+            'failed': sum(outcome.error is not None for outcome in group),
+            'bytes': sum(outcome.size for outcome in group),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+            'max_ms': round(max(latencies) * 1000, 3),
+        }
+    total_bytes = sum(outcome.size for outcome in outcomes)
+    return {
+        'operations': len(outcomes),
+        'failed': sum(outcome.error is not None for outcome in outcomes),
+        'retries': retries,
+        'seconds': round(seconds, 3),
+        'bytes': total_bytes,
+        'mb_per_s': round(total_bytes / seconds / 1e6, 3) if seconds else 0.0,
+        'commands': commands,
+        'failures': [{'line': outcome.operation.line, 'operation': ' '.join([outcome.operation.command,
+                                                                              *outcome.operation.args]),
+                      'error': outcome.error} for outcome in outcomes if outcome.error is not None],
+    }
+
+
+def print_report(report):
+    print(f"Ran {report['operations']} operations in {report['seconds']:.2f} s: "
+          f"{report['operations'] - report['failed']} succeeded, {report['failed']} failed, "
+          f"{report['retries']} retries")
+    for command, figures in report['commands'].items():
+        print(f"  {command:<8} {figures['ok']:5} ok {figures['failed']:5} failed "
+              f"{figures['bytes'] / 1e6:10.1f} MB  p50 {figures['p50_ms']:9.1f} ms  max {figures['max_ms']:9.1f} ms")
+    print(f"Aggregate throughput: {report['mb_per_s']:.1f} MB/s ({report['bytes']} bytes)")
+    for failure in report['failures']:
+        print(f"  line {failure['line']}: {failure['operation']}: {failure['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the file operations listed in a manifest")
+    parser.add_argument('manifest', help="file of operations, one per line ('-' for standard input)")
+    parser.add_argument('--host', default=client.IP)
+    parser.add_argument('--port', type=int, default=client.PORT)
+    parser.add_argument('--udp-port', type=int, default=client.UDP_PORT)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="operations run at once")
+    parser.add_argument('--retries', type=int, default=client_api.RETRIES, help="further attempts per failed operation")
+    parser.add_argument('--json', metavar='FILE', help="also write the report as JSON to FILE")
+    args = parser.parse_args()
+
+    if args.manifest == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.manifest) as f:
+            text = f.read()
+    try:
+        operations = parse_manifest(text)
+    except ManifestError as e:
+        parser.error(str(e))
+
+    started = time.perf_counter()
+    outcomes, retries = asyncio.run(run_batch(operations, args.host, args.port, args.udp_port,
+                                              args.concurrency, args.retries))
+    report = summarize(outcomes, time.perf_counter() - started, retries)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
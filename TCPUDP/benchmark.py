@@ -0,0 +1,511 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import client
+import impairment
+import protocol
+import server
+import udp_transfer
+
+# Loopback benchmark for the file server.
+#
+# Starts server.py (in this process, or as a subprocess to include process
+# startup effects and --workers mode) in a scratch directory on localhost and
+# runs every combination of transport, operation, file size, buffer size
+# and client concurrency. Each combination is one "cell": every client
+# thread performs --repeat operations on its own copy of the file, and each
+# operation is timed with perf_counter_ns. Results are written as JSON:
+#
+#   python benchmark.py --sizes 1K,1M,64M --concurrency 1,8 --output base.json
+#   python benchmark.py --sizes 1K,1M,64M --concurrency 1,8 --compare base.json
+#
+# The second form reports the change against the saved run and exits with
+# status 1 if any cell got slower than the tolerance allows.
+#
+# With any of --loss, --delay, --jitter, --reorder, --duplicate,
+# --bandwidth or --corrupt the client talks to the server through the relays in
+# impairment.py, and each cell also reports the relay's packet counts, so
+# UDP goodput and retransmission overhead can be measured reproducibly.
+#
+# Files up to SPARSE_THRESHOLD hold random bytes; larger ones are created
+# sparse, so multi-GB cases need no disk space up front (downloads are real
+# files and are deleted after each operation). SUMMARY runs on a file of
+# random numbers of the same size, capped at NUMBERS_MAX_SIZE.
+
+SPARSE_THRESHOLD = 256 * 1024 * 1024
+NUMBERS_MAX_SIZE = 256 * 1024 * 1024
+SERVER_START_TIMEOUT = 10  # Seconds to wait for a subprocess server to listen
+TOLERANCE = 0.10  # Allowed drop in throughput before a cell counts as a regression
+LATENCY_TOLERANCE = 0.25  # Allowed rise in p99 latency
+
+TCP_OPS = ['put', 'get', 'change', 'summary', 'summary-cached', 'striped-put', 'striped-get']
+UDP_OPS = ['put', 'get']
+SIZE_INDEPENDENT_OPS = ['change']  # Measured once, at the smallest size
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+# Parse "64K", "1M", "4G", ... into bytes
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+
+def free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, fraction):
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+#-------------------------- Test data ----------------------------------
+
+def make_data_file(path, size):
+    with open(path, 'wb') as f:
+        if size > SPARSE_THRESHOLD:
+            f.truncate(size)
+            return
+        remaining = size
+        while remaining:
+            chunk = min(remaining, 1024 * 1024)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def make_numbers_file(path, size, seed=1):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        written = 0
+        while written < size:
+            block = "".join(f"{rng.uniform(-1000, 1000):.6f}\n" for _ in range(10000))
+            block = block[:size - written]
+            f.write(block)
+            written += len(block)
+
+
+# Give every client thread its own name for a file (hard links, so large
+# files are not copied) in both the upload source and the server's store
+def link_copies(source, folder, base, count, extension):
+    names = []
+    for i in range(count):
+        name = f"{base}-{i}{extension}"
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            os.link(source, path)
+        names.append(name)
+    return names
+
+
+#-------------------------- Server ----------------------------------
+
+class BenchServer:
+    def __init__(self, mode, workers):
+        self.mode = mode
+        self.workers = workers
+        self.tcp_port = free_port(socket.SOCK_STREAM)
+        self.udp_port = free_port(socket.SOCK_DGRAM)
+        self.process = None
+
+    def start(self):
+        if self.mode == 'inprocess':
+            server.TCP_PORT = self.tcp_port
+            server.UDP_PORT = self.udp_port
+            server.DEBUG = False
+            threading.Thread(target=server.udp_server, daemon=True).start()
+            threading.Thread(target=server.start_server, daemon=True).start()
+        else:
+            command = [sys.executable, os.path.abspath(server.__file__), str(self.tcp_port), '0',
+                       '--udp-port', str(self.udp_port)]
+            if self.workers > 1:
+                command += ['--workers', str(self.workers)]
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.tcp_port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Server did not start")
+                time.sleep(0.05)
+
+    # Buffer size used for socket reads; a subprocess server keeps its own
+    def set_buffer_size(self, size):
+        client.TCP_BUFFER_SIZE = size
+        if self.mode == 'inprocess':
+            server.TCP_BUFFER_SIZE = size
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(timeout=server.WORKER_SHUTDOWN_TIMEOUT + 5)
+
+
+#-------------------------- Operations ----------------------------------
+# Each operation factory returns (setup, run): setup() runs once per client
+# thread outside the timing and returns per-thread state, run(state) does
+# one timed operation and returns the payload bytes it moved.
+
+def tcp_operation(op, addr, data_name, numbers_name, size):
+    def connect(i):
+        return {'conn': client.ServerConnection(addr), 'i': i, 'turn': 0}
+
+    def expect(state, wanted=protocol.STATUS_OK):
+        op_name, status, detail = state['conn'].result()
+        if status != wanted:
+            raise RuntimeError(f"{op_name} returned status {status}")
+        return detail
+
+    if op == 'put':
+        def run(state):
+            state['conn'].put(data_name[state['i']])
+            expect(state)
+            return size
+        return connect, run
+    if op == 'get':
+        def run(state):
+            state['conn'].get(data_name[state['i']])
+            path = expect(state, protocol.STATUS_FILE)
+            os.remove(path)
+            return size
+        return connect, run
+    if op == 'change':
+        # Rename a small file of each thread's back and forth between two names
+        def setup(i):
+            state = connect(i)
+            names = [os.path.join(server.UPLOAD_FOLDER_DESTINATION, f"rename-{i}.{end}") for end in 'ab']
+            if not os.path.exists(names[1]):
+                open(names[0], 'ab').close()
+            state['turn'] = 0 if os.path.exists(names[0]) else 1
+            return state
+
+        def run(state):
+            names = [f"rename-{state['i']}.a", f"rename-{state['i']}.b"]
+            old, new = names[state['turn'] % 2], names[(state['turn'] + 1) % 2]
+            state['turn'] += 1
+            state['conn'].change(old, new)
+            expect(state)
+            return 0
+        return setup, run
+    if op in ('summary', 'summary-cached'):
+        def run(state):
+            name = numbers_name[state['i']]
+            if op == 'summary':
+                # Bump the mtime so the server's summary cache misses
+                path = os.path.join(server.UPLOAD_FOLDER_DESTINATION, name)
+                os.utime(path, ns=(time.time_ns(), time.time_ns()))
+            state['conn'].summary(name)
+            expect(state)
+            return 0
+        return connect, run
+    if op == 'striped-put':
+        def run(state):
+            if not client.striped_put(addr, data_name[state['i']]):
+                raise RuntimeError("Striped upload failed")
+            return size
+        return (lambda i: {'i': i}), run
+    if op == 'striped-get':
+        def run(state):
+            if not client.striped_get(addr, data_name[state['i']]):
+                raise RuntimeError("Striped download failed")
+            os.remove(os.path.join(client.DOWNLOAD_FOLDER_DESTINATION, data_name[state['i']]))
+            return size
+        return (lambda i: {'i': i}), run
+    raise ValueError(f"Unknown TCP operation {op}")
+
+
+def udp_operation(op, data_name, size):
+    if op == 'put':
+        def run(state):
+            if not client.udp_send_file(data_name[state['i']]):
+                raise RuntimeError("UDP upload failed")
+            return size
+    elif op == 'get':
+        def run(state):
+            if not client.udp_receive_file(data_name[state['i']]):
+                raise RuntimeError("UDP download failed")
+            os.remove(os.path.join(client.DOWNLOAD_FOLDER_DESTINATION, data_name[state['i']]))
+            return size
+    else:
+        raise ValueError(f"Unknown UDP operation {op}")
+    return (lambda i: {'i': i}), run
+
+
+# Run one cell: concurrency threads each doing repeat operations
+def run_cell(setup, run, concurrency, repeat):
+    states = [setup(i) for i in range(concurrency)]
+    latencies = []
+    errors = []
+    moved = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(state):
+        barrier.wait()
+        mine = []
+        total = 0
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            try:
+                total += run(state)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            mine.append(time.perf_counter_ns() - start)
+        with lock:
+            latencies.extend(mine)
+            moved[0] += total
+
+    threads = [threading.Thread(target=worker, args=(state,)) for state in states]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter_ns()
+    for thread in threads:
+        thread.join()
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+    for state in states:
+        if 'conn' in state:
+            state['conn'].close()
+    latencies.sort()
+    result = {
+        'ops': len(latencies),
+        'errors': len(errors),
+        'bytes': moved[0],
+        'seconds': round(elapsed, 6),
+        'mb_per_s': round(moved[0] / elapsed / 1e6, 3) if elapsed else 0.0,
+        'ops_per_s': round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+    }
+    if latencies:
+        result['p50_ms'] = round(percentile(latencies, 0.50) / 1e6, 3)
+        result['p99_ms'] = round(percentile(latencies, 0.99) / 1e6, 3)
+        result['max_ms'] = round(latencies[-1] / 1e6, 3)
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+
+#-------------------------- Benchmark ----------------------------------
+
+# Relay packet counts during a cell, and for UDP the datagrams sent per
+# datagram of payload (1.0 = nothing resent)
+def relay_report(relays, before, transport, op, moved):
+    relay = relays.get(transport)
+    if relay is None:
+        return None
+    after = relay.stats()
+    report = {direction: {key: after[direction][key] - before[transport][direction][key]
+                          for key in after[direction]}
+              for direction in after}
+    if transport == 'udp' and moved:
+        data_direction = 'forward' if op == 'put' else 'backward'
+        needed = math.ceil(moved / udp_transfer.PAYLOAD_SIZE)
+        report['overhead'] = round(report[data_direction]['packets'] / needed, 4)
+    return report
+
+
+def run_benchmark(args, bench_server, relays):
+    tcp_port = relays['tcp'].port if 'tcp' in relays else bench_server.tcp_port
+    addr = ('127.0.0.1', tcp_port)
+    client.IP = '127.0.0.1'
+    client.UDP_PORT = relays['udp'].port if 'udp' in relays else bench_server.udp_port
+    client.COMPRESSION = args.compression
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+    buffers = [parse_size(s) for s in args.buffers.split(',')]
+    levels = [int(c) for c in args.concurrency.split(',')]
+    threads = max(levels)
+    results = []
+    for size in sizes:
+        label = format_size(size)
+        source = os.path.join(client.UPLOAD_FOLDER, f"data-{label}.bin")
+        make_data_file(source, size)
+        data_names = link_copies(source, client.UPLOAD_FOLDER, f"data-{label}", threads, '.bin')
+        link_copies(source, server.UPLOAD_FOLDER_DESTINATION, f"data-{label}", threads, '.bin')
+        numbers_names = []
+        if any(op.startswith('summary') for op in args.ops.split(',')):
+            numbers = os.path.join(client.UPLOAD_FOLDER, f"numbers-{label}.txt")
+            make_numbers_file(numbers, min(size, NUMBERS_MAX_SIZE))
+            numbers_names = link_copies(numbers, server.UPLOAD_FOLDER_DESTINATION, f"numbers-{label}", threads, '.txt')
+        for transport in args.transports.split(','):
+            for op in args.ops.split(','):
+                if op not in (TCP_OPS if transport == 'tcp' else UDP_OPS):
+                    continue
+                if op in SIZE_INDEPENDENT_OPS and size != sizes[0]:
+                    continue
+                for buffer in buffers:
+                    if transport == 'udp' and buffer != buffers[0]:
+                        continue  # UDP datagram size does not depend on the TCP buffer
+                    bench_server.set_buffer_size(buffer)
+                    for concurrency in levels:
+                        if transport == 'tcp':
+                            setup, run = tcp_operation(op, addr, data_names, numbers_names, size)
+                        else:
+                            setup, run = udp_operation(op, data_names, size)
+                        before = {name: relay.stats() for name, relay in relays.items()}
+                        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                            result = run_cell(setup, run, concurrency, args.repeat)
+                        cell = {'transport': transport, 'op': op, 'size': size, 'buffer': buffer,
+                                'concurrency': concurrency, **result}
+                        relay = relay_report(relays, before, transport, op, result['bytes'])
+                        if relay is not None:
+                            cell['relay'] = relay
+                        results.append(cell)
+                        print_cell(cell)
+    return results
+
+
+def cell_key(cell):
+    return cell['transport'], cell['op'], cell['size'], cell['buffer'], cell['concurrency']
+
+
+# Throughput figure compared between runs: MB/s for data transfers, ops/s
+# for the rest
+def throughput(cell):
+    return cell['mb_per_s'] if cell['bytes'] else cell['ops_per_s']
+
+
+def print_cell(cell):
+    unit = 'MB/s' if cell['bytes'] else 'op/s'
+    print(f"{cell['transport']:<4} {cell['op']:<15} size={format_size(cell['size']):<6} "
+          f"buf={format_size(cell['buffer']):<6} c={cell['concurrency']:<3} "
+          f"{throughput(cell):10.1f} {unit}  p50={cell.get('p50_ms', 0):9.3f}ms "
+          f"p99={cell.get('p99_ms', 0):9.3f}ms errors={cell['errors']}", file=sys.stderr)
+
+
+# Compare results with a saved run; returns (rows, regression count)
+def compare(results, baseline, tolerance, latency_tolerance):
+    previous = {cell_key(cell): cell for cell in baseline['results']}
+    rows = []
+    regressions = 0
+    for cell in results:
+        old = previous.get(cell_key(cell))
+        if old is None:
+            continue
+        row = {'transport': cell['transport'], 'op': cell['op'], 'size': cell['size'],
+               'buffer': cell['buffer'], 'concurrency': cell['concurrency'],
+               'baseline': throughput(old), 'current': throughput(cell)}
+        row['change'] = round(row['current'] / row['baseline'] - 1, 4) if row['baseline'] else None
+        if old.get('p99_ms') and cell.get('p99_ms'):
+            row['p99_change'] = round(cell['p99_ms'] / old['p99_ms'] - 1, 4)
+        row['regression'] = bool(
+            cell['errors'] > old['errors']
+            or (row['change'] is not None and row['change'] < -tolerance)
+            or row.get('p99_change', 0) > latency_tolerance)
+        regressions += row['regression']
+        rows.append(row)
+        marker = "REGRESSION" if row['regression'] else ""
+        change = f"{row['change']:+.1%}" if row['change'] is not None else "n/a"
+        p99 = f"{row['p99_change']:+.1%}" if 'p99_change' in row else "n/a"
+        print(f"{row['transport']:<4} {row['op']:<15} size={format_size(row['size']):<6} "
+              f"buf={format_size(row['buffer']):<6} c={row['concurrency']:<3} "
+              f"throughput {change:>8}  p99 {p99:>8}  {marker}", file=sys.stderr)
+    return rows, regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Loopback benchmark for the TCP/UDP file server")
+    parser.add_argument('--mode', choices=['inprocess', 'subprocess'], default='inprocess')
+    parser.add_argument('--workers', type=int, default=1, help="server processes (subprocess mode)")
+    parser.add_argument('--transports', default='tcp,udp')
+    parser.add_argument('--ops', default='put,get,change,summary,summary-cached,striped-put,striped-get')
+    parser.add_argument('--sizes', default='1K,1M,16M', help="file sizes, e.g. 1K,1M,4G")
+    parser.add_argument('--buffers', default=format_size(client.TCP_BUFFER_SIZE), help="TCP buffer sizes")
+    parser.add_argument('--concurrency', default='1,4', help="client thread counts")
+    parser.add_argument('--repeat', type=int, default=5, help="operations per client thread per cell")
+    parser.add_argument('--compression', action='store_true', help="let the client compress transfers")
+    parser.add_argument('--output', help="write the JSON results here instead of stdout")
+    parser.add_argument('--compare', metavar='BASELINE', help="JSON results of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--latency-tolerance', type=float, default=LATENCY_TOLERANCE)
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory")
+    impairment.add_impairment_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix='tcpudp-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)  # client.py and server.py use paths relative to the working directory
+    bench_server = BenchServer(args.mode, args.workers)
+    relays = {}
+    impaired = any([args.loss, args.delay, args.jitter, args.reorder, args.duplicate, args.bandwidth, args.corrupt])
+    try:
+        for folder in (client.UPLOAD_FOLDER, client.DOWNLOAD_FOLDER_DESTINATION, server.UPLOAD_FOLDER_DESTINATION):
+            os.makedirs(folder, exist_ok=True)
+        with contextlib.redirect_stdout(sys.stderr):  # Keep stdout for the JSON report
+            bench_server.start()
+            if impaired:
+                network = impairment.impairment_from_args(args)
+                relays['tcp'] = impairment.TcpRelay(('127.0.0.1', bench_server.tcp_port), network).start()
+                relays['udp'] = impairment.UdpRelay(('127.0.0.1', bench_server.udp_port), network).start()
+            started = time.time()
+            results = run_benchmark(args, bench_server, relays)
+    finally:
+        for relay in relays.values():
+            relay.stop()
+        bench_server.stop()
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        'meta': {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'mode': args.mode,
+            'workers': args.workers,
+            'repeat': args.repeat,
+            'compression': args.compression,
+            'impairment': vars(impairment.impairment_from_args(args)) if impaired else None,
+        },
+        'results': results,
+    }
+    regressions = 0
+    if baseline is not None:
+        report['comparison'], regressions = compare(results, baseline, args.tolerance, args.latency_tolerance)
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if regressions:
+        print(f"{regressions} regression(s) against {args.compare}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
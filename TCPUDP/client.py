@@ -1,343 +1,903 @@
 import socket
 import os
 import sys
+import itertools
+import json
+import mmap
+import tempfile
+import threading
+import time
+from collections import deque
+
+import compression
+import dedup
+import fec
+import delta
+import integrity
+import protocol
+import udp_io
+import udp_transfer
 
 # Default values and global variables
 DEFAULT_IP = socket.gethostbyname(socket.gethostname())
 DEFAULT_PORT = 1999
+DEFAULT_UDP_PORT = 12346
 DEFAULT_DEBUG = False
 IP = DEFAULT_IP
 PORT = DEFAULT_PORT
+UDP_PORT = DEFAULT_UDP_PORT
 DEBUG = DEFAULT_DEBUG
 
 # Directory constants
 UPLOAD_FOLDER = "to_upload"
 DOWNLOAD_FOLDER_DESTINATION = "downloads"
 BUFFER_SIZE = 1024
+TCP_BUFFER_SIZE = 256 * 1024  # Bytes per recv_into() on TCP transfers
+PARTIAL_SUFFIX = ".part"  # Unfinished downloads are kept under this suffix
+RESUME_ATTEMPTS = 5  # Reconnect this often to resume an interrupted transfer
+RESUME_DELAY = 1  # Seconds to wait before reconnecting
+STRIPE_SIZE = 8 * 1024 * 1024  # Bytes per stripe of a striped transfer
+STREAM_COUNT = 4  # Parallel connections used by a striped transfer
+COMPRESSION = True  # Compress TCP transfers when a sample of the data shows it pays off
+COMPRESSION_CODEC = compression.preferred_codec()
+CHECKSUMS = True  # Check TCP transfers end to end and resend only corrupted chunks (see integrity.py)
+REPAIR_ATTEMPTS = 3  # Rounds of resending corrupted chunks before giving up
 TIMEOUT = 2  # Timeout in seconds for UDP
+UDP_WINDOW_SIZE = udp_transfer.WINDOW_SIZE  # Datagrams in flight per UDP transfer
+UDP_CONGESTION_CONTROL = udp_transfer.CONGESTION_CONTROL  # 'reno', or 'fixed' for no congestion control
+UDP_FEC = None  # (K, M): send M FEC repair datagrams per K data datagrams, e.g. (fec.BLOCK_SIZE, fec.REPAIR_COUNT)
+UDP_PAYLOAD_SIZE = udp_transfer.PAYLOAD_SIZE  # File bytes per datagram; None for the most the path MTU allows
+UDP_OFFLOAD = True  # Batch datagrams with UDP GSO/GRO where the kernel supports it
+VERBOSE = True  # Print progress messages (client_api.py turns them off)
 FILE_INFO_SIZE = 1 
 
+# Print a progress message unless VERBOSE is off
+def report(message):
+    if VERBOSE:
+        print(message)
+
 #-------------------------- UDP ----------------------------------
 
-def udp_send_file(filename):
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
+# Payload size for UDP transfers with the server at server_addr
+def udp_payload_size(server_addr):
+    if UDP_PAYLOAD_SIZE is None:
+        return udp_transfer.path_payload_size(server_addr)
+    return min(UDP_PAYLOAD_SIZE, udp_transfer.MAX_PAYLOAD_SIZE)
+
+# Window for UDP_WINDOW_SIZE packets' worth of bytes at payload_size
+def udp_window(payload_size):
+    return max(UDP_WINDOW_SIZE * udp_transfer.PAYLOAD_SIZE // payload_size, udp_transfer.MIN_WINDOW_SIZE)
+
+# Command datagram text for a UDP transfer
+def udp_command(command, filename, payload_size):
+    words = [command, filename]
+    if UDP_FEC:
+        words.append(fec.format_option(*UDP_FEC))
+    if payload_size != udp_transfer.PAYLOAD_SIZE:
+        words.append(f"payload={payload_size}")
+    return " ".join(words)
+
+# Upload a file over UDP, from path if given (else from UPLOAD_FOLDER), to
+# server_addr (default IP, UDP_PORT); returns True on success
+def udp_send_file(filename, path=None, server_addr=None):
+    filepath = path or os.path.join(UPLOAD_FOLDER, filename)
     if not os.path.isfile(filepath):
-        print(f"Error: The file '{filepath}' does not exist.")
-        return
+        report(f"Error: The file '{filepath}' does not exist.")
+        return False
 
+    server_addr = server_addr or (IP, UDP_PORT)
+    payload_size = udp_payload_size(server_addr)
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
-        udp_socket.settimeout(TIMEOUT)
+        datagram_io = udp_io.DatagramIO(udp_socket, offload=UDP_OFFLOAD)
         with open(filepath, 'rb') as f:
-            udp_socket.sendto(f"put {os.path.basename(filename)}".encode(), (IP, PORT))
-            while True:
-                bytes_read = f.read(BUFFER_SIZE)
-                if not bytes_read:
-                    udp_socket.sendto(b'END', (IP, PORT))
-                    break
-                udp_socket.sendto(bytes_read, (IP, PORT))
-                try:
-                    _, _ = udp_socket.recvfrom(BUFFER_SIZE)  # Wait for ACK
-                except socket.timeout:
-                    print("Timeout, resending packet")
-                    if f.tell() > BUFFER_SIZE:
-                        f.seek(-BUFFER_SIZE, os.SEEK_CUR)  # Only move back if not at the start of the file
-                    else:
-                        print("Cannot resend - at the beginning of the file.")
-                        break
-
-def udp_receive_file(filename):
-    download_path = os.path.join(DOWNLOAD_FOLDER_DESTINATION, filename)
+            transfer_id = udp_transfer.new_transfer_id()
+            try:
+                kind, _, _, body = udp_transfer.request(datagram_io, server_addr, transfer_id,
+                                                        udp_command('put', os.path.basename(filename), payload_size),
+                                                        TIMEOUT)
+                if kind == udp_transfer.PACKET_ERROR:
+                    report(f"Error: {bytes(body).decode()}")
+                    return False
+                sender = udp_transfer.WindowSender(f, transfer_id, udp_window(payload_size), payload_size,
+                                                   congestion_control=UDP_CONGESTION_CONTROL, fec_params=UDP_FEC)
+                udp_transfer.run_transfer(datagram_io, server_addr, sender)
+            except udp_transfer.TransferError as e:
+                report(f"UDP upload failed: {e}")
+                return False
+    if DEBUG:
+        print(f"Sent {sender.describe()}")
+        print(f"Datagram I/O: {datagram_io.stats()}")
+    report(f"{filename} has been uploaded successfully over UDP")
+    return True
+
+# Download a file over UDP, to path if given (else into
+# DOWNLOAD_FOLDER_DESTINATION), from server_addr (default IP, UDP_PORT);
+# returns True on success
+def udp_receive_file(filename, path=None, server_addr=None):
+    download_path = path or os.path.join(DOWNLOAD_FOLDER_DESTINATION, filename)
+    server_addr = server_addr or (IP, UDP_PORT)
+    payload_size = udp_payload_size(server_addr)
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
-        udp_socket.settimeout(TIMEOUT)
-        udp_socket.sendto(f"get {filename}".encode(), (IP, PORT))
-        with open(download_path, 'wb') as f:
-            while True:
-                try:
-                    bytes_read, _ = udp_socket.recvfrom(BUFFER_SIZE)
-                    if bytes_read == b'END':
-                        break
-                    f.write(bytes_read)
-                    udp_socket.sendto(b'ACK', (IP, PORT))
-                except socket.timeout:
-                    print("Failed to receive file.")
-                    break
+        datagram_io = udp_io.DatagramIO(udp_socket, offload=UDP_OFFLOAD)
+        transfer_id = udp_transfer.new_transfer_id()
+        try:
+            kind, _, seq, body = udp_transfer.request(datagram_io, server_addr, transfer_id,
+                                                     udp_command('get', filename, payload_size), TIMEOUT)
+            if kind == udp_transfer.PACKET_ERROR:
+                report(f"Error: {bytes(body).decode()}")
+                return False
+            os.makedirs(os.path.dirname(download_path) or '.', exist_ok=True)
+            with open(download_path, 'wb') as f:
+                receiver = udp_transfer.WindowReceiver(f, transfer_id, udp_window(payload_size), fec_params=UDP_FEC)
+                if kind != udp_transfer.PACKET_READY:
+                    # READY was lost but the data is already flowing
+                    datagram_io.send(receiver.handle(kind, seq, body, time.monotonic()), server_addr)
+                udp_transfer.run_transfer(datagram_io, server_addr, receiver)
+        except udp_transfer.TransferError as e:
+            report(f"Failed to receive file: {e}")
+            return False
+    if DEBUG:
+        print(f"Received {receiver.describe()}")
+        print(f"Datagram I/O: {datagram_io.stats()}")
+    report(f"{filename} has been downloaded successfully to {download_path}")
+    return True
 
 
 #-------------------------- UDP ----------------------------------
-def get_user_protocol_choice():
-    print("Choose the protocol for sending the file:")
-    print("1: TCP")
-    print("2: UDP")
-    return input("Enter your choice (1 or 2): ")
 
-def tcp_send_file(client, filename):
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
+# Receive filesize bytes into the download at offset. The data goes to a
+# ".part" file that is renamed into place once all total_size bytes are there,
+# so an interrupted download can be resumed from where it stopped.
+# For a checksummed reply refetch(filename, f, ranges) is given; it is used
+# to download corrupted chunks again before the file is renamed into place.
+# The file goes to path if given, else into DOWNLOAD_FOLDER_DESTINATION.
+def get_file(client, filename, filesize, offset=0, total_size=None, codec=compression.CODEC_NONE, refetch=None,
+             path=None):
+    filepath = path or os.path.join(DOWNLOAD_FOLDER_DESTINATION, filename)
+    partial_path = filepath + PARTIAL_SUFFIX
+    if total_size is None:
+        total_size = offset + filesize
+    report(f"Starting to receive file: {filename} of size: {filesize} bytes.")
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    with open(partial_path, "r+b" if offset and os.path.exists(partial_path) else "w+b") as f:
+        f.seek(offset)
+        f.truncate()
+        if codec:
+            receive_decompressed(client, f, filesize, codec)
+        elif refetch is not None:
+            verify_download(client, f, filename, filesize, offset, total_size, refetch)
+        else:
+            receive_chunk(client, f, filesize)
+    if offset + filesize != total_size:
+        return partial_path
+    os.replace(partial_path, filepath)
+    report(f"{filename} has been downloaded successfully to {filepath}")
+    return filepath
+
+# Receive a checksummed download into f, fetch any corrupted chunks again
+# and check the whole file against the server's hash. The hash is taken
+# inline; the file is only read back when chunks had to be replaced.
+# A resumed download is covered by the chunk CRCs of the part just received.
+def verify_download(client, f, filename, filesize, offset, total_size, refetch):
+    checksum = integrity.StreamChecksum(whole_file=not offset)
+    bad_ranges, digest = receive_checksummed(client, f, filesize, offset, checksum)
+    repaired = False
+    for attempt in range(REPAIR_ATTEMPTS):
+        if not bad_ranges:
+            break
+        report(f"Fetching {len(bad_ranges)} corrupted range(s) of {filename} again")
+        bad_ranges = refetch(filename, f, bad_ranges)
+        repaired = True
+    if bad_ranges:
+        raise integrity.IntegrityError(f"{filename} is still corrupted after {REPAIR_ATTEMPTS} attempts")
+    if digest is None or offset + filesize != total_size or (offset and not repaired):
+        return
+    if repaired:
+        checksum = integrity.checksum_file(f)
+    if checksum.digest() != digest:
+        f.truncate(0)  # The CRCs cannot tell where; start over
+        raise integrity.IntegrityError(f"{filename} does not match the server's hash")
+
+# Messages for the failure statuses of a reply
+STATUS_MESSAGES = {
+    protocol.STATUS_NOT_FOUND: "Error: File not found",
+    protocol.STATUS_UNKNOWN: "Error: Unknown request",
+    protocol.STATUS_FAILED: "Error: Unsuccessful operation",
+    protocol.STATUS_SUMMARY_FAILED: "Error occurred during summary operation",
+    protocol.STATUS_CORRUPT: "Error: File was corrupted in transit",
+    protocol.STATUS_MISSING: "Error: Server lacks chunks of the file",
+}
+
+# Run one command typed at the prompt. put and get go over TCP unless the
+# filename is followed by "udp"; "put <file> dedup" sends only the chunks the
+# server does not hold yet.
+def do_command(command, addr):
+    vals = command.split()
+    if not vals:
+        return
+    cmd = vals[0].lower()
     try:
-        filesize = os.path.getsize(filepath)
-        opcode = '000'
-        filename_length = f'{len(filename):05b}'
+        if cmd in ("put", "get") and len(vals) > 1:
+            transport = vals[2].lower() if len(vals) > 2 else "tcp"
+            transports = ("tcp", "udp", "dedup") if cmd == "put" else ("tcp", "udp")
+            if transport not in transports:
+                print(f"Unknown transport {vals[2]}; use {', '.join(transports)}.")
+            elif transport == "dedup":
+                dedup_put(addr, vals[1])
+            elif cmd == "put":
+                resumable_put(addr, vals[1]) if transport == "tcp" else udp_send_file(vals[1])
+            else:
+                resumable_get(addr, vals[1]) if transport == "tcp" else udp_receive_file(vals[1])
+        elif cmd in ("change", "summary", "help") and len(vals) > {"change": 2, "summary": 1, "help": 0}[cmd]:
+            with ServerConnection(addr) as conn:
+                if cmd == "change":
+                    conn.change(vals[1], vals[2])
+                elif cmd == "summary":
+                    conn.summary(vals[1])
+                else:
+                    conn.help()
+                _, status, detail = conn.result()
+            if status in STATUS_MESSAGES:
+                print(STATUS_MESSAGES[status])
+            elif cmd == "change":
+                print(f"{vals[1]} has been renamed to {vals[2]}")
+            elif cmd == "summary":
+                print("Summary of the file is as follows:")
+                print(detail)
+            else:
+                print(detail)
+        elif cmd == "sync" and len(vals) > 1:
+            delta_put(addr, vals[1])
+        elif cmd == "bench" and len(vals) > 1:
+            benchmark_striping(addr, vals[1])
+        elif cmd == "stats":
+            show_stats(addr)
+        else:
+            print("Invalid command or incorrect usage.")
+    except (OSError, RuntimeError) as e:
+        print(f"Error during command execution: {e}")
 
-        send_data = opcode + filename_length
-        client.send(bytes([int(send_data, 2)]))
-        client.send(filename.encode("utf-8"))
-        client.send(filesize.to_bytes(4, 'big'))
+def send_chunk(client, file, total_size):
+    # sendfile() copies from the page cache in the kernel and retries partial
+    # sends itself; it falls back to a send() loop where unsupported.
+    client.sendfile(file, file.tell(), total_size)
+
+# Send total_size bytes of file, from its current position, followed by their
+# checksum trailer. The data still goes out with sendfile(), one chunk at a
+# time; each chunk is checksummed after it was sent, through an mmap of the
+# file while it is hot in the page cache, so it is never copied into
+# userspace. Returns the StreamChecksum.
+def send_checksummed(client, file, total_size, whole_file=True):
+    checksum = integrity.StreamChecksum(whole_file)
+    position = file.tell()
+    end = position + total_size
+    if total_size:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+            if len(data) < end:
+                raise RuntimeError("File ended before the expected size")
+            while position < end:
+                n = min(end - position, integrity.CHUNK_SIZE)
+                client.sendfile(file, position, n)
+                checksum.update(view[position:position + n])
+                position += n
+    client.sendall(checksum.trailer())
+    return checksum
+
+# Receive total_size bytes and pwrite() them into fd starting at offset
+def receive_into_fd(client, fd, offset, total_size):
+    buffer = memoryview(bytearray(TCP_BUFFER_SIZE))
+    end = offset + total_size
+    while offset < end:
+        n = client.recv_into(buffer, min(end - offset, TCP_BUFFER_SIZE))
+        if not n:
+            raise RuntimeError("Socket connection broken")
+        written = 0
+        while written < n:
+            written += os.pwrite(fd, buffer[written:n], offset + written)
+        offset += n
 
+def receive_chunk(client, file, total_size):
+    buffer = memoryview(bytearray(TCP_BUFFER_SIZE))  # Reused for every recv_into
+    bytes_recd = 0
+    while bytes_recd < total_size:
+        n = client.recv_into(buffer, min(total_size - bytes_recd, TCP_BUFFER_SIZE))
+        if not n:
+            raise RuntimeError("Socket connection broken")
+        file.write(buffer[:n])
+        bytes_recd += n
+
+# Receive total_size bytes for file offset like receive_chunk(), feeding
+# them to checksum, then their trailer. Returns the ranges whose CRCs did not
+# match and the sender's hash of the whole file (None if it sent none).
+def receive_checksummed(client, file, total_size, offset, checksum):
+    buffer = memoryview(bytearray(TCP_BUFFER_SIZE))
+    bytes_recd = 0
+    while bytes_recd < total_size:
+        n = client.recv_into(buffer, min(total_size - bytes_recd, TCP_BUFFER_SIZE))
+        if not n:
+            raise RuntimeError("Socket connection broken")
+        file.write(buffer[:n])
+        checksum.update(buffer[:n])
+        bytes_recd += n
+    crcs, digest = integrity.unpack_trailer(protocol.recv_exact(client, integrity.trailer_size(total_size)), total_size)
+    return integrity.bad_ranges(offset, total_size, checksum.finish(), crcs), digest
+
+# Receive a compressed record stream that decodes to total_size bytes
+def receive_decompressed(client, file, total_size, codec):
+    bytes_recd = 0
+    for piece in compression.receive_compressed(lambda n: protocol.recv_exact(client, n), codec):
+        bytes_recd += len(piece)
+        if bytes_recd > total_size:
+            raise protocol.ProtocolError("Compressed download is larger than announced")
+        file.write(piece)
+    if bytes_recd != total_size:
+        raise RuntimeError("Compressed download ended early")
+
+#-------------------------- Persistent connection ----------------------------------
+# A reusable protocol v2 connection that carries any number of requests. Each
+# request is written immediately and tagged with a request ID; result() reads
+# the responses back and matches them to their requests by that ID, so
+# several requests can be in flight at once.
+class ServerConnection:
+    def __init__(self, addr):
+        self.addr = addr
+        self.sock = socket.create_connection(addr)
+        # Requests are written as header + payload in separate calls; without
+        # this, Nagle holds the payload's last segment for the server's
+        # delayed ACK (~40 ms per small request)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        protocol.client_hello(self.sock)
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request ID -> (operation, filename), oldest first
+        self.completed = deque()  # Responses read early, not yet returned
+        self.digests = {}  # filename -> hash of the last whole file uploaded
+        self.download_paths = {}  # request ID -> where a GET's file goes, if not DOWNLOAD_FOLDER_DESTINATION
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _send(self, op, opcode, name='', payload=b'', payload_length=None, flags=0):
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        if payload_length is None:
+            payload_length = len(payload)
+        self.sock.sendall(protocol.pack_frame(opcode, request_id, name, payload_length, flags) + payload)
+        self.pending[request_id] = (op, name)
+        return request_id
+
+    def _send_range(self, op, opcode, name, offset, size, payload_length=0, flags=0):
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        self.sock.sendall(protocol.pack_frame(opcode, request_id, name, payload_length, flags, offset, size))
+        self.pending[request_id] = (op, name)
+        return request_id
+
+    # Upload a file, optionally only from offset onwards (resuming an upload
+    # the server already holds the first offset bytes of), compressed with
+    # codec if one is given. The data comes from path if given, else from
+    # UPLOAD_FOLDER.
+    def put(self, filename, offset=0, codec=compression.CODEC_NONE, path=None):
+        filepath = path or os.path.join(UPLOAD_FOLDER, filename)
+        filesize = os.path.getsize(filepath)
+        # The server cannot read our upload while it is blocked writing a
+        # download we have not consumed yet, so collect those first.
+        if any(op in ('get', 'summary', 'help', 'stat') for op, _ in self.pending.values()):
+            self.completed.extend(self._read_pending())
+        flags = protocol.codec_flags(codec)
+        if CHECKSUMS and not codec:
+            flags |= protocol.FLAG_CHECKSUM
+        if offset:
+            request_id = self._send_range('put', protocol.OP_PUT, filename, offset, filesize, filesize - offset, flags)
+        else:
+            request_id = self._send('put', protocol.OP_PUT, filename, payload_length=filesize, flags=flags)
         with open(filepath, "rb") as f:
-            send_chunk(client, f, filesize)
-
-        return client.recv(FILE_INFO_SIZE)
+            f.seek(offset)
+            if codec:
+                compression.send_compressed(f, filesize - offset, codec, self.sock.sendall)
+            elif flags & protocol.FLAG_CHECKSUM:
+                checksum = send_checksummed(self.sock, f, filesize - offset, whole_file=not offset)
+                if not offset:
+                    self.digests[filename] = checksum.digest()
+            else:
+                send_chunk(self.sock, f, filesize - offset)
+        return request_id
+
+    # Resend the ranges of an upload the server found corrupted (it keeps the
+    # rest staged), then have it check the whole file against our hash and
+    # move it into place. Must not be mixed with other outstanding requests
+    # on this connection. Returns the final status.
+    def repair_put(self, filename, bad_ranges, path=None):
+        filepath = path or os.path.join(UPLOAD_FOLDER, filename)
+        filesize = os.path.getsize(filepath)
+        with open(filepath, "rb") as f:
+            for attempt in range(REPAIR_ATTEMPTS):
+                if not bad_ranges:
+                    break
+                report(f"Resending {len(bad_ranges)} corrupted range(s) of {filename}")
+                for offset, size in bad_ranges:
+                    request_id = next(self.request_ids) & 0xFFFFFFFF
+                    self.sock.sendall(protocol.pack_frame(protocol.OP_PUT, request_id, filename, size,
+                                                          protocol.FLAG_CHECKSUM | protocol.FLAG_PATCH,
+                                                          offset=offset, size=filesize))
+                    self.pending[request_id] = ('put', filename)
+                    f.seek(offset)
+                    send_checksummed(self.sock, f, size, whole_file=False)
+                bad_ranges = []
+                for _, status, detail in self._read_pending():
+                    if status == protocol.STATUS_CORRUPT:
+                        bad_ranges += detail
+                    elif status != protocol.STATUS_OK:
+                        return status
+            if bad_ranges:
+                return protocol.STATUS_CORRUPT
+            digest = self.digests.get(filename)
+            if digest is None:  # A resumed upload; hash the file now
+                digest = integrity.checksum_file(f).digest()
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        self.sock.sendall(protocol.pack_frame(protocol.OP_COMMIT, request_id, filename, len(digest),
+                                              protocol.FLAG_PATCH, offset=0, size=filesize) + digest)
+        self.pending[request_id] = ('commit', filename)
+        return self.result()[1]
+
+    # Download a file, or length bytes of it from offset (0 = to the end),
+    # to path if given, else into DOWNLOAD_FOLDER_DESTINATION. With a codec,
+    # the server compresses the reply if the data compresses.
+    def get(self, filename, offset=None, length=0, codec=compression.CODEC_NONE, path=None):
+        flags = protocol.codec_flags(codec)
+        if CHECKSUMS:
+            flags |= protocol.FLAG_CHECKSUM
+        if offset is None and not length:
+            request_id = self._send('get', protocol.OP_GET, filename, flags=flags)
+        else:
+            request_id = self._send_range('get', protocol.OP_GET, filename, offset or 0, length, flags=flags)
+        if path:
+            self.download_paths[request_id] = path
+        return request_id
+
+    # Ask how many bytes of an interrupted upload the server holds and how
+    # large the stored file is
+    def stat(self, filename):
+        return self._send('stat', protocol.OP_STAT, filename)
+
+    # Send count bytes of file f from offset as one stripe of a striped upload
+    def put_stripe(self, filename, f, offset, count, filesize):
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        header = protocol.pack_frame(protocol.OP_PUT, request_id, filename, count,
+                                     flags=protocol.FLAG_STRIPE, offset=offset, size=filesize)
+        self.sock.sendall(header)
+        self.pending[request_id] = ('put', filename)
+        self.sock.sendfile(f, offset, count)
+        return request_id
+
+    # Ask which of the chunks with the given hashes the server holds
+    def chunks(self, digests):
+        return self._send('chunks', protocol.OP_CHUNKS, payload=b''.join(digests))
+
+    # Upload a file as the list of its chunks (dedup.Chunk, cut from the
+    # open file f) plus the data of those flagged in send
+    def put_chunks(self, filename, f, chunks, send):
+        listing = dedup.pack_entries([(chunk.digest, chunk.size) for chunk in chunks]) + dedup.pack_bitmap(send)
+        ranges = []  # Neighbouring chunks go out in one sendfile()
+        for chunk, flag in zip(chunks, send):
+            if not flag:
+                continue
+            if ranges and sum(ranges[-1]) == chunk.offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + chunk.size)
+            else:
+                ranges.append((chunk.offset, chunk.size))
+        payload_length = len(listing) + sum(size for _, size in ranges)
+        request_id = self._send('put', protocol.OP_PUT_CHUNKS, filename, listing, payload_length)
+        for offset, size in ranges:
+            self.sock.sendfile(f, offset, size)
+        return request_id
+
+    # Fetch the block signatures of the server's copy of a file
+    def signatures(self, filename):
+        return self._send('signatures', protocol.OP_SIGNATURES, filename)
+
+    # Send a delta stream (an open binary file of delta records) that turns
+    # the server's copy into ours
+    def put_delta(self, filename, delta_file, block_size, filesize):
+        delta_size = delta_file.seek(0, os.SEEK_END)
+        delta_file.seek(0)
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        self.sock.sendall(protocol.pack_frame(protocol.OP_DELTA, request_id, filename, delta_size,
+                                              offset=block_size, size=filesize))
+        self.pending[request_id] = ('delta', filename)
+        self.sock.sendfile(delta_file, 0, delta_size)
+        return request_id
+
+    # Move a striped upload into place once every stripe was acknowledged
+    def commit(self, filename, filesize):
+        return self._send_range('commit', protocol.OP_COMMIT, filename, 0, filesize)
+
+    # Download length bytes from offset straight into fd with pwrite(), for
+    # striped downloads sharing one preallocated file. Must not be mixed with
+    # other outstanding requests on this connection.
+    def get_into(self, filename, fd, offset, length):
+        self._send_range('get', protocol.OP_GET, filename, offset, length)
+        frame = protocol.read_frame(self.sock)
+        if frame is None:
+            raise RuntimeError("Server closed the connection")
+        self.pending.pop(frame.request_id)
+        if frame.opcode == protocol.STATUS_FILE:
+            receive_into_fd(self.sock, fd, frame.offset, frame.payload_length)
+        elif frame.payload_length:
+            protocol.recv_exact(self.sock, frame.payload_length)
+        return frame.opcode
+
+    # Download the given (offset, size) ranges of a file again into f over a
+    # second connection, as this one may have other responses in flight,
+    # checking each against its chunk CRCs; returns the ranges that are still
+    # corrupted
+    def refetch(self, filename, f, ranges):
+        bad_ranges = []
+        with ServerConnection(self.addr) as conn:
+            for offset, size in ranges:
+                conn._send_range('get', protocol.OP_GET, filename, offset, size, flags=protocol.FLAG_CHECKSUM)
+                frame = protocol.read_frame(conn.sock)
+                if frame is None:
+                    raise RuntimeError("Server closed the connection")
+                conn.pending.pop(frame.request_id)
+                if frame.opcode != protocol.STATUS_FILE or not frame.flags & protocol.FLAG_CHECKSUM:
+                    protocol.recv_exact(conn.sock, frame.payload_length)
+                    raise integrity.IntegrityError(f"Could not fetch {filename} again (status {frame.opcode})")
+                f.seek(frame.offset)
+                checksum = integrity.StreamChecksum(whole_file=False)
+                ranges_left, _ = receive_checksummed(conn.sock, f, frame.payload_length, frame.offset, checksum)
+                bad_ranges += ranges_left
+        return bad_ranges
+
+    def change(self, oldfilename, newfilename):
+        return self._send('change', protocol.OP_CHANGE, oldfilename, newfilename.encode("utf-8"))
+
+    def summary(self, filename):
+        return self._send('summary', protocol.OP_SUMMARY, filename)
+
+    def help(self):
+        return self._send('help', protocol.OP_HELP)
+
+    # Fetch server statistics (cache hit/miss counters, ...)
+    def stats(self):
+        return self._send('stats', protocol.OP_STATS)
+
+    # Read the next response. Returns (operation, status, detail) where
+    # detail is the download path for a GET, the text for SUMMARY/HELP,
+    # (staged bytes, stored file size) for STAT, (block size, packed
+    # signatures) for SIGNATURES, a dict for STATS, the corrupted (offset,
+    # size) ranges for STATUS_CORRUPT, a bitmap (see dedup.unpack_bitmap) for
+    # CHUNKS and STATUS_MISSING and None otherwise.
+    def result(self):
+        if self.completed:
+            return self.completed.popleft()
+        return self._read_response()
+
+    def _read_response(self):
+        frame = protocol.read_frame(self.sock)
+        if frame is None:
+            raise RuntimeError("Server closed the connection")
+        op, name = self.pending.pop(frame.request_id)
+        path = self.download_paths.pop(frame.request_id, None)
+        detail = None
+        if frame.opcode == protocol.STATUS_FILE:
+            codec = protocol.frame_codec(frame)
+            refetch = self.refetch if frame.flags & protocol.FLAG_CHECKSUM else None
+            if frame.flags & protocol.FLAG_RANGE:
+                detail = get_file(self.sock, frame.name, frame.payload_length, frame.offset, frame.size, codec, refetch,
+                                  path)
+            else:
+                detail = get_file(self.sock, frame.name, frame.payload_length, codec=codec, refetch=refetch, path=path)
+        elif frame.opcode == protocol.STATUS_CORRUPT:
+            detail = protocol.unpack_ranges(protocol.recv_exact(self.sock, frame.payload_length))
+        elif frame.opcode == protocol.STATUS_MISSING or (op == 'chunks' and frame.opcode == protocol.STATUS_OK):
+            detail = bytes(protocol.recv_exact(self.sock, frame.payload_length))
+        elif op == 'stat':
+            detail = (frame.offset, frame.size)
+        elif op == 'signatures' and frame.opcode == protocol.STATUS_OK:
+            detail = (frame.offset, bytes(protocol.recv_exact(self.sock, frame.payload_length)))
+        elif op == 'stats' and frame.opcode == protocol.STATUS_OK:
+            detail = json.loads(protocol.recv_exact(self.sock, frame.payload_length))
+        elif frame.payload_length:
+            detail = protocol.recv_exact(self.sock, frame.payload_length).decode('utf-8')
+        return op, frame.opcode, detail
+
+    def _read_pending(self):
+        results = []
+        while self.pending:
+            results.append(self._read_response())
+        return results
+
+    # Read the responses to every outstanding request
+    def results(self):
+        results = list(self.completed)
+        self.completed.clear()
+        return results + self._read_pending()
+
+    def close(self):
+        try:
+            self.results()
+            self.sock.sendall(protocol.pack_frame(protocol.OP_CLOSE, 0))
+        finally:
+            self.sock.close()
+
+# Pick the codec for uploading a file from offset: COMPRESSION_CODEC unless
+# compression is off or a sample shows the data does not compress
+def choose_codec(filename, offset=0, path=None):
+    if not COMPRESSION:
+        return compression.CODEC_NONE
+    with open(path or os.path.join(UPLOAD_FOLDER, filename), 'rb') as f:
+        codec = compression.choose_codec(f, offset, codec_id=COMPRESSION_CODEC)
+    if codec and DEBUG:
+        print(f"Compressing {filename} with {compression.codecs[codec].name}")
+    return codec
+
+# Upload a file over an open connection (with no other requests
+# outstanding), from path if given, else from UPLOAD_FOLDER. Continues from
+# where the server's staged copy of an interrupted upload ends and resends
+# chunks that arrive corrupted. Returns the final status.
+def put_resuming(conn, filename, path=None):
+    filepath = path or os.path.join(UPLOAD_FOLDER, filename)
+    conn.stat(filename)
+    _, _, (offset, _) = conn.result()
+    if offset > os.path.getsize(filepath):
+        offset = 0  # Staged data belongs to some other, larger file
+    if offset and DEBUG:
+        print(f"Resuming upload of {filename} at byte {offset}")
+    conn.put(filename, offset, choose_codec(filename, offset, filepath), filepath)
+    _, status, detail = conn.result()
+    if status == protocol.STATUS_CORRUPT:
+        status = conn.repair_put(filename, detail, filepath)
+    return status
+
+# Upload a file over an open connection (with no other requests
+# outstanding), from path if given, else from UPLOAD_FOLDER, sending only the
+# chunks the server does not hold yet (see dedup.py). Returns the final
+# status, or None if the server does not store files as chunks.
+def put_deduplicated(conn, filename, path=None):
+    with open(path or os.path.join(UPLOAD_FOLDER, filename), 'rb') as f:
+        chunks = dedup.chunk_file(f)
+        # Ask about at most MAX_CHUNK_QUERY chunks per request, all queries pipelined
+        batches = [chunks[i:i + protocol.MAX_CHUNK_QUERY] for i in range(0, len(chunks), protocol.MAX_CHUNK_QUERY)]
+        for batch in batches:
+            conn.chunks([chunk.digest for chunk in batch])
+        replies = [conn.result() for batch in batches]
+        if any(status != protocol.STATUS_OK for _, status, _ in replies):
+            return None
+        held_chunks = []
+        for batch, (_, _, bitmap) in zip(batches, replies):
+            held_chunks += dedup.unpack_bitmap(bitmap, len(batch))
+        send = []
+        seen = set()
+        for chunk, held in zip(chunks, held_chunks):
+            send.append(not held and chunk.digest not in seen)  # A chunk repeated in the file goes once
+            seen.add(chunk.digest)
+        report(f"Sending {sum(send)} of {len(chunks)} chunks of {filename}; the server holds the rest")
+        for attempt in range(REPAIR_ATTEMPTS):
+            conn.put_chunks(filename, f, chunks, send)
+            _, status, bitmap = conn.result()
+            if status != protocol.STATUS_MISSING:
+                break
+            send = dedup.unpack_bitmap(bitmap, len(chunks))
+    return status
+
+# Download a file over an open connection (with no other requests
+# outstanding), to path if given, else into DOWNLOAD_FOLDER_DESTINATION,
+# continuing the .part file an interrupted download left. Returns the status.
+def get_resuming(conn, filename, path=None):
+    partial_path = (path or os.path.join(DOWNLOAD_FOLDER_DESTINATION, filename)) + PARTIAL_SUFFIX
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    if CHECKSUMS:
+        offset -= offset % integrity.CHUNK_SIZE  # Resume on a chunk boundary, so stored CRCs apply
+    if offset and DEBUG:
+        print(f"Resuming download of {filename} at byte {offset}")
+    conn.get(filename, offset, codec=COMPRESSION_CODEC if COMPRESSION else compression.CODEC_NONE, path=path)
+    return conn.result()[1]
+
+# Upload a file over TCP, resuming from where the server's staged copy ends
+# whenever the connection breaks
+def resumable_put(addr, filename):
+    for attempt in range(RESUME_ATTEMPTS):
+        try:
+            with ServerConnection(addr) as conn:
+                status = put_resuming(conn, filename)
+        except FileNotFoundError:
+            print(f"File {filename} not found in {UPLOAD_FOLDER}.")
+            return None
+        except (OSError, RuntimeError) as e:
+            print(f"Upload interrupted ({e}), retrying...")
+            time.sleep(RESUME_DELAY)
+            continue
+        if status == protocol.STATUS_OK:
+            print(f"{filename} has been uploaded successfully")
+        else:
+            print(f"Upload of {filename} failed (status {status})")
+        return status
+    print(f"Giving up on uploading {filename}")
+    return None
+
+# Download a file over TCP, continuing a previously interrupted download and
+# reconnecting with a ranged GET whenever the connection breaks
+def resumable_get(addr, filename):
+    for attempt in range(RESUME_ATTEMPTS):
+        try:
+            with ServerConnection(addr) as conn:
+                status = get_resuming(conn, filename)
+        except (OSError, RuntimeError) as e:
+            print(f"Download interrupted ({e}), retrying...")
+            time.sleep(RESUME_DELAY)
+            continue
+        if status == protocol.STATUS_NOT_FOUND:
+            print("Error: File not found")
+        return status
+    print(f"Giving up on downloading {filename}")
+    return None
+
+# Upload only what changed: fetch the block signatures of the server's copy,
+# send literal bytes plus references to blocks it already has, and let it
+# rebuild the file. Falls back to a full upload when there is no old copy.
+def delta_put(addr, filename):
+    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    filesize = os.path.getsize(filepath)
+    with ServerConnection(addr) as conn:
+        conn.signatures(filename)
+        _, status, detail = conn.result()
+        if status != protocol.STATUS_OK:
+            return resumable_put(addr, filename)
+        block_size, signatures = detail
+        with tempfile.TemporaryFile() as delta_file:
+            literal_bytes, copied_blocks = delta.write_delta(filepath, signatures, block_size, delta_file)
+            if DEBUG:
+                print(f"Delta for {filename}: {literal_bytes} literal bytes, "
+                      f"{copied_blocks} blocks of {block_size} bytes reused")
+            conn.put_delta(filename, delta_file, block_size, filesize)
+            _, status, _ = conn.result()
+    if status != protocol.STATUS_OK:
+        print(f"Delta upload of {filename} failed (status {status}), sending the whole file")
+        return resumable_put(addr, filename)
+    print(f"{filename} has been synchronized successfully")
+    return status
+
+# Upload a file sending only the chunks the server does not already hold.
+# Falls back to a whole upload when the server does not store chunks.
+def dedup_put(addr, filename):
+    try:
+        with ServerConnection(addr) as conn:
+            status = put_deduplicated(conn, filename)
     except FileNotFoundError:
         print(f"File {filename} not found in {UPLOAD_FOLDER}.")
         return None
-
-def get_file_response(client, filename):
-    opcode = '001'
-    filename_length = f'{len(filename):05b}'
-    send_data = opcode + filename_length
-    client.send(bytes([int(send_data, 2)]))
-    client.send(filename.encode("utf-8"))
-    return client.recv(FILE_INFO_SIZE)
-
-def get_file(client, filename, filesize):
-    filepath = os.path.join(DOWNLOAD_FOLDER_DESTINATION, filename)
-    print(f"Starting to receive file: {filename} of size: {filesize} bytes.")
-    with open(filepath, "wb") as f:
-        receive_chunk(client, f, filesize)
-    print(f"{filename} has been downloaded successfully to {filepath}")
-
-def change_file_name(client, oldfilename, newfilename):
-    opcode = '010'
-    oldfilename_length = f'{len(oldfilename):05b}'
-    newfilename_length = f'{len(newfilename):08b}'
-
-    send_data = opcode + oldfilename_length
-    client.send(bytes([int(send_data, 2)]))
-    client.send(oldfilename.encode("utf-8"))
-    client.send(bytes([int(newfilename_length, 2)]))
-    client.send(newfilename.encode("utf-8"))
-
-    return client.recv(FILE_INFO_SIZE)
-def summary_file(client, filename):
-    opcode = '011'  # Correct opcode for summary
-    filename_length = f'{len(filename):05b}'
-    send_data = opcode + filename_length
-
-    client.send(bytes([int(send_data, 2)]))
-    client.send(filename.encode("utf-8"))
-
-    # Receive the response
-    response = client.recv(FILE_INFO_SIZE)
-    return response
-
-def handle_summary_response(client, response):
-    byteInfo = int.from_bytes(response, 'big')
-    rescode = byteInfo >> 5
-
-    if rescode == 0:  # Success response
-        print("Summary operation completed successfully!")
-        summary_length = byteInfo & 0b00011111
-        summary = client.recv(summary_length).decode('utf-8')
-        print("Summary of the file is as follows:")
-        print(summary)
-    elif rescode == 2:  # File not found
-        print("Error: File not found")
-    elif rescode == 3:  # Unknown request
-        print("Error: Unknown request")
+    if status is None:
+        return resumable_put(addr, filename)
+    if status == protocol.STATUS_OK:
+        print(f"{filename} has been uploaded successfully")
     else:
-        print("Error occurred during summary operation")
-
-
-
-def get_help(client):
-    opcode = '110'  # Correct opcode for help (110 instead of 100)
-    padding = '00000'
-
-    send_data = opcode + padding
-    client.send(bytes([int(send_data, 2)]))
-    return client.recv(FILE_INFO_SIZE)
-
-def unsupported_cmd(client):
-    opcode = '100'  # Correct opcode for unsupported command
-    padding = '00000'
-
-    send_data = opcode + padding
-    client.send(bytes([int(send_data, 2)]))
-    return client.recv(FILE_INFO_SIZE)
-
-
-def do_command(command, addr):
-    vals = command.split(" ")
-    cmd = vals[0]
-
-    # Handle TCP commands
-    if cmd in ["summary", "change", "help"]:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-            client.connect(addr)
-
-            if cmd == "summary" and len(vals) > 1:
-                response = summary_file(client, vals[1])
-                handle_summary_response(client, response)
-            elif cmd == "change" and len(vals) > 2:
-                response = change_file_name(client, vals[1], vals[2])
-                print(response)  # Print the response from the server
-            elif cmd == "help":
-                response = get_help(client)
-                print(response)  # Print the response from the server
-            # Add additional TCP command handling here as needed
-
-    # Handle File Transfer Commands (put/get) with TCP or UDP choice
-    elif cmd in ["put", "get"] and len(vals) > 1:
-        filename = vals[1]
-        protocol = get_user_protocol_choice()
-
-        if protocol == "1":  # TCP
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                client.connect(addr)
-                if cmd == "put":
-                    tcp_send_file(client, filename)  # TCP file send
-                elif cmd == "get":
-                    response = get_file_response(client, filename)
-                    # Further TCP file get logic
-        elif protocol == "2":  # UDP
-            if cmd == "put":
-                udp_send_file(filename)  # UDP file send
-            elif cmd == "get":
-                udp_receive_file(filename)  # UDP file receive
-        else:
-            print("Invalid choice.")
-    else:
-        print("Invalid command or incorrect usage.")
-
-
-    vals = command.split(" ")
-    cmd = vals[0]
-
-    # TCP commands that require a socket connection
-    tcp_commands = ["summary", "change", "help", "put", "get"]
-
-    # Create the TCP client socket for TCP-specific commands
-    client = None
-    if cmd in tcp_commands:
-        client = socket.socket()
-        client.connect(addr)
-
+        print(f"Upload of {filename} failed (status {status})")
+    return status
+
+# Split a file of filesize bytes into (offset, length) stripes
+def make_stripes(filesize, stripe_size):
+    return [(offset, min(stripe_size, filesize - offset)) for offset in range(0, filesize, stripe_size)]
+
+# Run worker(conn, offset, length) for every stripe over `streams` parallel
+# connections; returns False if any stripe failed
+def run_striped(addr, stripes, streams, worker):
+    queue = deque(stripes)
+    lock = threading.Lock()
+    failures = []
+
+    def stream():
+        try:
+            with ServerConnection(addr) as conn:
+                while True:
+                    with lock:
+                        if not queue or failures:
+                            return
+                        offset, length = queue.popleft()
+                    if not worker(conn, offset, length):
+                        failures.append((offset, length))
+        except (OSError, RuntimeError) as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=stream) for _ in range(min(streams, max(len(stripes), 1)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures and DEBUG:
+        print(f"Striped transfer failed: {failures[0]}")
+    return not failures
+
+# Download a file as stripes over several parallel connections, each stripe
+# written with pwrite() into a preallocated .part file
+def striped_get(addr, filename, streams=STREAM_COUNT, stripe_size=STRIPE_SIZE):
+    with ServerConnection(addr) as conn:
+        conn.stat(filename)
+        _, status, (_, filesize) = conn.result()
+    if status == protocol.STATUS_NOT_FOUND:
+        print("Error: File not found")
+        return False
+    filepath = os.path.join(DOWNLOAD_FOLDER_DESTINATION, filename)
+    partial_path = filepath + PARTIAL_SUFFIX
+    os.makedirs(DOWNLOAD_FOLDER_DESTINATION, exist_ok=True)
+    fd = os.open(partial_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
     try:
-        if cmd == "summary" and len(vals) > 1:
-            response = summary_file(client, vals[1])
-            handle_summary_response(client, response)
-        elif cmd == "put" and len(vals) > 1:
-            protocol = get_user_protocol_choice()
-            if protocol == "1":
-                tcp_send_file(client, vals[1])  # TCP file send
-            elif protocol == "2":
-                udp_send_file(vals[1])  # UDP file send
-        elif cmd == "get" and len(vals) > 1:
-            protocol = get_user_protocol_choice()
-            if protocol == "1":
-                tcp_get_file(client, vals[1])  # TCP file get
-            elif protocol == "2":
-                udp_get_file(vals[1])  # UDP file get
-        elif cmd == "change" and len(vals) > 2:
-            response = change_file_name(client, vals[1], vals[2])
-            print(response)  # Print the response from the server
-        elif cmd == "help":
-            response = get_help(client)
-            print(response)  # Print the response from the server
-        else:
-            print("Invalid command or incorrect usage.")
-    except Exception as e:
-        print(f"Error during command execution: {e}")
-    finally:
-        # Close the TCP client socket if it was created
-        if client:
-            client.close()
-
-
-    vals = command.split(" ")
-    cmd = vals[0]
-      #--------UDP-------------------
-    if cmd == "put" and len(vals) > 1:
-        filename = vals[1]
-        protocol = get_user_protocol_choice()
-        if protocol == "1":
-            tcp_send_file(addr, filename)  # Function to send file via TCP
-        elif protocol == "2":
-            udp_send_file(filename)  # Function to send file via UDP
+        if filesize and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, filesize)
         else:
-            print("Invalid choice.")
-
-        client = socket.socket()
-        print(f"Connecting to server at {addr}...")
-        client.connect(addr)
-        print(f"Connected. Executing command: {cmd}")
-
-    response = None
-    if cmd == "summary" and len(vals) > 1:
-        response = summary_file(client, vals[1])
-        handle_summary_response(client, response)
-    elif cmd == "put" and len(vals) > 1:
-        response = send_file(client, vals[1])
-    elif cmd == "get" and len(vals) > 1:
-        response = get_file_response(client, vals[1])
-    elif cmd == "change" and len(vals) > 2:
-        response = change_file_name(client, vals[1], vals[2])
-    elif cmd == "help":
-        response = get_help(client)
-    else:
-        response = unsupported_cmd(client)
-
-    if response:
-        work_with_response(client, response)
-    client.close()
-
-def work_with_response(client, response):
-    byteInfo = int.from_bytes(response, 'big')
-    rescode = byteInfo >> 5
-
-    if rescode == 0:  # Success response for either put, get, change, or summary
-        print("Operation completed successfully!")
-        # Additional handling if this success response is for a summary operation
-        if byteInfo & 0b00011111 > 0:  # Check if there is additional data for summary
-            handle_summary_response(client, response)
-
-    elif rescode == 1:  # File received
-        print("Server indicates file is ready for download.")
-        filenameSize = byteInfo & 0b00011111
-        receivedFileName = client.recv(filenameSize).decode('utf-8')
-        print(f"Receiving file: {receivedFileName}")
-        receivedFileSize = int.from_bytes(client.recv(4), 'big')
-        get_file(client, receivedFileName, receivedFileSize)
-
-    elif rescode == 2:
-        print("Error: File not found")
-
-    elif rescode == 3:
-        print("Error: Unknown request")
+            os.ftruncate(fd, filesize)
 
-    elif rescode == 4:
-        print("Error: Unsuccessful operation")
+        def fetch(conn, offset, length):
+            return conn.get_into(filename, fd, offset, length) == protocol.STATUS_FILE
 
-    elif rescode == 5:
-        print("Error: Summary operation failed")
-
-    elif rescode == 6:
-        helpLength = byteInfo & 0b00011111
-        helpMessage = client.recv(helpLength).decode('utf-8')
-        print(helpMessage)
+        ok = run_striped(addr, make_stripes(filesize, stripe_size), streams, fetch)
+    finally:
+        os.close(fd)
+    if not ok:
+        return False
+    os.replace(partial_path, filepath)
+    print(f"{filename} has been downloaded successfully to {filepath}")
+    return True
 
-def send_chunk(client, file, total_size):
-    bytes_sent = 0
-    while bytes_sent < total_size:
-        chunk = file.read(min(total_size - bytes_sent, 2048))
-        client.send(chunk)
-        bytes_sent += len(chunk)
+# Upload a file as stripes over several parallel connections; the server
+# assembles them and moves the file into place on COMMIT
+def striped_put(addr, filename, streams=STREAM_COUNT, stripe_size=STRIPE_SIZE):
+    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    filesize = os.path.getsize(filepath)
 
-def receive_chunk(client, file, total_size):
-    bytes_recd = 0
-    while bytes_recd < total_size:
-        chunk = client.recv(min(total_size - bytes_recd, 2048))
-        file.write(chunk)
-        bytes_recd += len(chunk)
+    def send(conn, offset, length):
+        with open(filepath, "rb") as f:
+            conn.put_stripe(filename, f, offset, length, filesize)
+        return conn.result()[1] == protocol.STATUS_OK
+
+    if not run_striped(addr, make_stripes(filesize, stripe_size), streams, send):
+        return False
+    with ServerConnection(addr) as conn:
+        conn.commit(filename, filesize)
+        _, status, _ = conn.result()
+    if status != protocol.STATUS_OK:
+        print(f"Upload of {filename} failed (status {status})")
+        return False
+    print(f"{filename} has been uploaded successfully")
+    return True
+
+# Time single-stream against striped transfers of one file and print MB/s
+def benchmark_striping(addr, filename, streams=STREAM_COUNT, stripe_size=STRIPE_SIZE):
+    filesize = os.path.getsize(os.path.join(UPLOAD_FOLDER, filename))
+    runs = [
+        ("put, 1 stream", lambda: resumable_put(addr, filename)),
+        (f"put, {streams} streams", lambda: striped_put(addr, filename, streams, stripe_size)),
+        ("get, 1 stream", lambda: resumable_get(addr, filename)),
+        (f"get, {streams} streams", lambda: striped_get(addr, filename, streams, stripe_size)),
+    ]
+    results = {}
+    for label, run in runs:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        results[label] = filesize / elapsed / 1e6
+    print(f"Throughput for {filename} ({filesize} bytes, {stripe_size} byte stripes):")
+    for label, mbps in results.items():
+        print(f"  {label:<16} {mbps:10.1f} MB/s")
+    return results
+
+# Print the server's statistics
+def show_stats(addr):
+    with ServerConnection(addr) as conn:
+        conn.stats()
+        _, status, stats = conn.result()
+    if status != protocol.STATUS_OK:
+        print("Server did not return statistics")
+        return
+    for section, values in stats.items():
+        if not isinstance(values, dict):
+            print(f"{section}: {values}")
+        elif any(isinstance(value, dict) for value in values.values()):
+            print(f"{section}:")  # e.g. latency, one line per operation
+            for key, value in values.items():
+                print(f"  {key}: " + ", ".join(f"{name}={figure}" for name, figure in value.items()))
+        else:
+            print(f"{section}: " + ", ".join(f"{key}={value}" for key, value in values.items()))
 
 def display_welcome_message():
     print("Welcome to the FTP Client")
@@ -345,10 +905,14 @@ def display_welcome_message():
 
 def display_help():
     commands = {
-        "put <filename>": "Upload a file to the server.",
-        "get <filename>": "Download a file from the server.",
+        "put <filename> [tcp|udp|dedup]": "Upload a file to the server (over TCP unless udp is given; "
+                                          "dedup skips the chunks the server already holds).",
+        "get <filename> [tcp|udp]": "Download a file from the server (over TCP unless udp is given).",
         "change <oldfilename> <newfilename>": "Rename a file on the server.",
         "summary <filename>": "Get statistical summary (max, min, avg) of a file.",
+        "sync <filename>": "Upload only the parts of a file that changed on the server.",
+        "bench <filename>": "Compare single-stream and striped TCP throughput for a file.",
+        "stats": "Show server statistics.",
         "help": "Display this help message.",
         "exit": "Exit the application."
     }
@@ -356,13 +920,15 @@ def display_help():
         print(f"{cmd}: {desc}")
 
 def set_global_vars_from_args(args):
-    global IP, PORT, DEBUG
+    global IP, PORT, DEBUG, UDP_PORT
     if len(args) > 1:
         IP = args[1]
     if len(args) > 2:
         PORT = int(args[2])
     if len(args) > 3:
         DEBUG = bool(int(args[3]))
+    if len(args) > 4:
+        UDP_PORT = int(args[4])
 
 def main():
     set_global_vars_from_args(sys.argv)
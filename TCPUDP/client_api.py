@@ -0,0 +1,274 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import os
+import threading
+import time
+
+import client
+import protocol
+
+# Non-interactive client API, for scripts and for batch.py:
+#
+#   with client_api.Client('127.0.0.1') as c:
+#       c.put('data/big.bin')              # stored on the server as big.bin
+#       c.get('big.bin', 'copy/big.bin')
+#       text = c.summary('numbers.txt')
+#
+#   async with client_api.AsyncClient('127.0.0.1') as c:
+#       await asyncio.gather(*(c.put(path) for path in paths))
+#
+# Client keeps a pool of protocol v2 connections (client.ServerConnection)
+# and hands each operation one of them, so a run of operations pays for the
+# connection and HELLO handshake once per pooled connection rather than once
+# per operation. A connection goes back to the pool when its operation ended
+# cleanly; one that saw an error is closed, since its stream may be out of
+# step. Connections idle for POOL_IDLE_TIMEOUT are replaced before the
+# server's own idle timeout closes them under us. Client is thread safe; at
+# most pool_size TCP operations run at once and the rest wait for a
+# connection.
+#
+# Failures raise ClientError. Broken connections, corrupted transfers and
+# statuses another attempt may change are retried up to `retries` times on a
+# fresh connection; TCP transfers resume where the last attempt stopped.
+#
+# AsyncClient offers the same operations as coroutines. Transfers go through
+# sendfile() and blocking sockets, so it runs them on a pool of pool_size
+# worker threads rather than on the event loop.
+#
+# Importing this module turns off the progress messages client.py prints
+# for the interactive client.
+
+POOL_SIZE = 4  # Connections kept per Client
+POOL_IDLE_TIMEOUT = 60  # Seconds before an idle pooled connection is replaced (the server allows 300)
+RETRIES = 2  # Further attempts after a failed one
+RETRY_DELAY = 0.5  # Seconds before the first retry; doubles with each further one
+RETRYABLE_STATUSES = (protocol.STATUS_FAILED, protocol.STATUS_CORRUPT,
+                      protocol.STATUS_MISSING)  # e.g. an upload of the same name in progress
+
+client.VERBOSE = False
+
+
+class ClientError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status  # Status of the server's reply; None for transport failures
+
+    # Whether another attempt could succeed
+    @property
+    def retryable(self):
+        return self.status is None or self.status in RETRYABLE_STATUSES
+
+
+# What put() and get() return: the remote name, the local path, the bytes
+# moved and the seconds it took, retries included
+class Transfer(collections.namedtuple('Transfer', 'name path size seconds transport')):
+    @property
+    def mb_per_s(self):
+        return self.size / self.seconds / 1e6 if self.seconds else 0.0
+
+
+class ConnectionPool:
+    def __init__(self, addr, size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.addr = addr
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = collections.deque()  # (connection, time it came back), most recent last
+        self.lock = threading.Lock()
+        self.closed = False
+        self.opened = 0  # Connections made so far
+
+    # Borrow a connection for the duration of a with block
+    @contextlib.contextmanager
+    def connection(self):
+        with self.slots:
+            conn = self._take()
+            try:
+                yield conn
+            except BaseException:
+                _discard(conn)
+                raise
+            self._give_back(conn)
+
+    def _take(self):
+        with self.lock:
+            if self.idle and time.monotonic() - self.idle[-1][1] < self.idle_timeout:
+                return self.idle.pop()[0]
+            stale = [conn for conn, _ in self.idle]  # The most recent one is stale, so all are
+            self.idle.clear()
+            self.opened += 1
+        for conn in stale:
+            _discard(conn)
+        return client.ServerConnection(self.addr)
+
+    def _give_back(self, conn):
+        with self.lock:
+            if not self.closed and not conn.pending and not conn.completed:
+                self.idle.append((conn, time.monotonic()))
+                return
+        _discard(conn)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle = [conn for conn, _ in self.idle]
+            self.idle.clear()
+        for conn in idle:
+            try:
+                conn.close()
+            except (OSError, RuntimeError):
+                pass
+
+
+# Close a connection without the CLOSE handshake
+def _discard(conn):
+    try:
+        conn.sock.close()
+    except OSError:
+        pass
+
+
+# Raise ClientError unless a reply's status is OK (or FILE)
+def check_status(status, what):
+    if status not in (protocol.STATUS_OK, protocol.STATUS_FILE):
+        message = client.STATUS_MESSAGES.get(status, f"status {status}")
+        raise ClientError(f"{what} failed: {message}", status)
+
+
+class Client:
+    def __init__(self, host=None, port=None, udp_port=None, pool_size=POOL_SIZE, retries=RETRIES):
+        host = host or client.IP
+        self.addr = (host, port or client.PORT)
+        self.udp_addr = (host, udp_port or client.UDP_PORT)
+        self.retries = retries
+        self.pool = ConnectionPool(self.addr, pool_size)
+        self.retried = 0  # Attempts repeated so far
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    # Run operation(), retrying it as described above; what names it in errors
+    def _attempt(self, operation, what):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self.lock:
+                    self.retried += 1
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                return operation()
+            except ClientError as e:
+                if not e.retryable or attempt == self.retries:
+                    raise
+            except (OSError, RuntimeError) as e:  # Connection broken, still corrupted, ...
+                if attempt == self.retries:
+                    raise ClientError(f"{what} failed: {e}") from e
+
+    # Send one request with send(conn) and return the detail of its reply
+    def _request(self, send, what):
+        def operation():
+            with self.pool.connection() as conn:
+                send(conn)
+                _, status, detail = conn.result()
+            check_status(status, what)
+            return detail
+        return self._attempt(operation, what)
+
+    # Upload the file at path, stored on the server as name (default: the
+    # file's own name), over 'tcp' or 'udp', or as 'dedup': over TCP, sending
+    # only the chunks the server does not hold yet (see dedup.py)
+    def put(self, path, name=None, transport='tcp'):
+        name = name or os.path.basename(path)
+        size = os.path.getsize(path)  # Raises FileNotFoundError before any attempt
+        what = f"Upload of {name}"
+        started = time.perf_counter()
+        if transport == 'udp':
+            def operation():
+                if not client.udp_send_file(name, path, self.udp_addr):
+                    raise ClientError(f"{what} over UDP failed")
+        elif transport == 'dedup':
+            def operation():
+                with self.pool.connection() as conn:
+                    status = client.put_deduplicated(conn, name, path)
+                    if status is None:  # The server keeps files whole
+                        status = client.put_resuming(conn, name, path)
+                check_status(status, what)
+        else:
+            def operation():
+                with self.pool.connection() as conn:
+                    status = client.put_resuming(conn, name, path)
+                check_status(status, what)
+        self._attempt(operation, what)
+        return Transfer(name, path, size, time.perf_counter() - started, transport)
+
+    # Download the server's file name to path (default: under
+    # client.DOWNLOAD_FOLDER_DESTINATION), over 'tcp' or 'udp'
+    def get(self, name, path=None, transport='tcp'):
+        path = path or os.path.join(client.DOWNLOAD_FOLDER_DESTINATION, name)
+        what = f"Download of {name}"
+        started = time.perf_counter()
+        if transport == 'udp':
+            def operation():
+                if not client.udp_receive_file(name, path, self.udp_addr):
+                    raise ClientError(f"{what} over UDP failed")
+        else:
+            def operation():
+                with self.pool.connection() as conn:
+                    status = client.get_resuming(conn, name, path)
+                check_status(status, what)
+        self._attempt(operation, what)
+        return Transfer(name, path, os.path.getsize(path), time.perf_counter() - started, transport)
+
+    def rename(self, old_name, new_name):
+        self._request(lambda conn: conn.change(old_name, new_name), f"Renaming {old_name}")
+
+    # Return the summary text of a file of numbers on the server
+    def summary(self, name):
+        return self._request(lambda conn: conn.summary(name), f"Summary of {name}")
+
+    # Return the server's statistics as a dict
+    def stats(self):
+        return self._request(lambda conn: conn.stats(), "Fetching statistics")
+
+
+# Client's operations as coroutines
+class AsyncClient:
+    def __init__(self, host=None, port=None, udp_port=None, pool_size=POOL_SIZE, retries=RETRIES):
+        self.client = Client(host, port, udp_port, pool_size, retries)
+        self.executor = concurrent.futures.ThreadPoolExecutor(pool_size, thread_name_prefix='client-api')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args))
+
+    async def close(self):
+        await self._run(self.client.close)
+        self.executor.shutdown()
+
+    async def put(self, path, name=None, transport='tcp'):
+        return await self._run(self.client.put, path, name, transport)
+
+    async def get(self, name, path=None, transport='tcp'):
+        return await self._run(self.client.get, name, path, transport)
+
+    async def rename(self, old_name, new_name):
+        await self._run(self.client.rename, old_name, new_name)
+
+    async def summary(self, name):
+        return await self._run(self.client.summary, name)
+
+    async def stats(self):
+        return await self._run(self.client.stats)
@@ -0,0 +1,236 @@
+import lzma
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is only offered when the package is installed
+    zstandard = None
+
+# Streaming compression for TCP transfers, shared by client.py and server.py.
+#
+# A compressed payload is a sequence of records: CHUNK_HEADER (the number of
+# compressed bytes that follow) and that many bytes of codec output. A record
+# of length 0 ends the stream. The frame's payload length still gives the
+# uncompressed size, so the receiver knows how much data to expect, and the
+# records let it read exactly the compressed bytes without overrunning into
+# the next frame.
+#
+# Codecs are registered by a small integer ID that travels in the upper four
+# bits of the frame flags (see protocol.py). zlib and lzma come from the
+# standard library; faster codecs are registered when their package is
+# importable, and new ones can be added with register_codec().
+
+CHUNK_HEADER = struct.Struct('!I')
+READ_SIZE = 1024 * 1024  # Raw bytes compressed at a time
+OUTPUT_LIMIT = 1024 * 1024  # Most raw bytes a decompressor returns at once
+MAX_RECORD = 16 * 1024 * 1024  # Largest compressed record accepted
+
+# Adaptive choice: a few samples spread over the file are compressed with
+# fast zlib; compression is skipped unless they shrink by MIN_SAVINGS
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 4
+MIN_SAVINGS = 0.1
+MIN_COMPRESS_SIZE = 4 * 1024  # Smaller files are always sent as they are
+
+ZLIB_LEVEL = 1
+LZMA_PRESET = 1
+ZSTD_LEVEL = 3
+
+# Codec IDs (0 means uncompressed)
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+
+
+class CompressionError(Exception):
+    pass
+
+
+# A codec: compressor() returns an object with compress(data) and flush();
+# decompressor() one whose decompress(records) takes an iterator over the
+# compressed records of a stream and yields the raw data in pieces of at most
+# OUTPUT_LIMIT bytes, so a small record cannot expand into a huge allocation
+class Codec:
+    def __init__(self, codec_id, name, compressor, decompressor):
+        self.codec_id = codec_id
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+
+codecs = {}  # codec ID -> Codec
+
+
+def register_codec(codec):
+    codecs[codec.codec_id] = codec
+
+
+def codec_by_name(name):
+    for codec in codecs.values():
+        if codec.name == name:
+            return codec.codec_id
+    raise CompressionError(f"Unknown codec {name}")
+
+
+# The codec used when nothing else is asked for: the fastest one available
+def preferred_codec():
+    return CODEC_ZSTD if CODEC_ZSTD in codecs else CODEC_ZLIB
+
+
+class _ZlibDecompressor:
+    def __init__(self):
+        self.d = zlib.decompressobj()
+
+    def decompress(self, records):
+        for data in records:
+            while data:
+                out = self.d.decompress(data, OUTPUT_LIMIT)
+                if out:
+                    yield out
+                data = self.d.unconsumed_tail
+
+
+class _LzmaDecompressor:
+    def __init__(self):
+        self.d = lzma.LZMADecompressor()
+
+    def decompress(self, records):
+        for data in records:
+            while True:
+                out = self.d.decompress(data, OUTPUT_LIMIT)
+                if out:
+                    yield out
+                if self.d.eof or self.d.needs_input:
+                    break
+                data = b''
+
+
+register_codec(Codec(CODEC_ZLIB, 'zlib', lambda: zlib.compressobj(ZLIB_LEVEL), _ZlibDecompressor))
+register_codec(Codec(CODEC_LZMA, 'lzma', lambda: lzma.LZMACompressor(preset=LZMA_PRESET), _LzmaDecompressor))
+
+if zstandard is not None:
+    # File-like view of the records, for zstandard's stream_reader: its
+    # decompressobj() has no output bound, but reads from the reader are
+    # bounded by the size asked for
+    class _RecordReader:
+        def __init__(self, records):
+            self.records = records
+            self.buffer = b''
+
+        def read(self, size):
+            while not self.buffer:
+                self.buffer = next(self.records, None)
+                if self.buffer is None:
+                    self.buffer = b''
+                    return b''
+                self.buffer = memoryview(self.buffer)
+            out, self.buffer = self.buffer[:size], self.buffer[size:]
+            return bytes(out)
+
+    class _ZstdDecompressor:
+        def decompress(self, records):
+            with zstandard.ZstdDecompressor().stream_reader(_RecordReader(records), closefd=False) as reader:
+                while out := reader.read(OUTPUT_LIMIT):
+                    yield out
+
+    register_codec(Codec(CODEC_ZSTD, 'zstd', lambda: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj(),
+                         _ZstdDecompressor))
+
+# What the decompressors raise on corrupt data
+DECOMPRESSION_ERRORS = (zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+# Decide from samples of data (bytes-like) whether compressing it pays off
+def worth_compressing(data):
+    size = len(data)
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    step = max(size // SAMPLE_COUNT, SAMPLE_SIZE)
+    raw = packed = 0
+    for start in range(0, size, step):
+        sample = data[start:start + SAMPLE_SIZE]
+        raw += len(sample)
+        packed += len(zlib.compress(sample, 1))
+    return packed <= raw * (1 - MIN_SAVINGS)
+
+
+# Pick the codec for sending the open binary file f (or its first count
+# bytes from offset): the preferred one, or CODEC_NONE when samples show the
+# data does not compress
+def choose_codec(f, offset=0, count=None, codec_id=None):
+    if count is None:
+        count = f.seek(0, 2) - offset
+    if count < MIN_COMPRESS_SIZE:
+        return CODEC_NONE
+    step = max(count // SAMPLE_COUNT, SAMPLE_SIZE)
+    samples = bytearray()
+    for start in range(offset, offset + count, step):
+        f.seek(start)
+        samples += f.read(min(SAMPLE_SIZE, offset + count - start))
+    f.seek(offset)
+    if not worth_compressing(samples):
+        return CODEC_NONE
+    return codec_id or preferred_codec()
+
+
+# Compress count bytes of the open binary file f from its current position,
+# passing each record (ready to send) to send()
+def send_compressed(f, count, codec_id, send):
+    compressor = codecs[codec_id].compressor()
+    while count > 0:
+        data = f.read(min(READ_SIZE, count))
+        if not data:
+            raise CompressionError("File ended before the expected size")
+        count -= len(data)
+        out = compressor.compress(data)
+        if out:
+            send(CHUNK_HEADER.pack(len(out)) + out)
+    out = compressor.flush()
+    if out:
+        send(CHUNK_HEADER.pack(len(out)) + out)
+    send(CHUNK_HEADER.pack(0))
+
+
+# Read a compressed record stream with read_exact(n) and yield the raw data.
+# The whole stream, end record included, is consumed. If tee is given, it is
+# called with every record exactly as received.
+def receive_compressed(read_exact, codec_id, tee=None):
+    records = _read_records(read_exact, tee)
+    try:
+        yield from codecs[codec_id].decompressor().decompress(records)
+    except DECOMPRESSION_ERRORS as e:
+        raise CompressionError(f"Corrupt compressed data: {e}")
+    for _ in records:  # Whatever follows the end of the compressed data
+        pass
+
+
+# Yield the records of a compressed record stream read with read_exact(n),
+# up to the end record, passing them to tee as for receive_compressed()
+def _read_records(read_exact, tee):
+    while True:
+        header = read_exact(CHUNK_HEADER.size)
+        (length,) = CHUNK_HEADER.unpack(header)
+        if length > MAX_RECORD:
+            raise CompressionError(f"Compressed record of {length} bytes is too large")
+        if not length:
+            if tee is not None:
+                tee(header)
+            return
+        data = read_exact(length)
+        if tee is not None:
+            tee(header)
+            tee(data)
+        yield data
+
+
+# Read and drop a compressed record stream without decoding it
+def discard_compressed(read_exact):
+    while True:
+        (length,) = CHUNK_HEADER.unpack(read_exact(CHUNK_HEADER.size))
+        if length > MAX_RECORD:
+            raise CompressionError(f"Compressed record of {length} bytes is too large")
+        if not length:
+            return
+        read_exact(length)
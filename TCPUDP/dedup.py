@@ -0,0 +1,471 @@
+import bisect
+import collections
+import contextlib
+import hashlib
+import itertools
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+import integrity
+
+# Content-addressed, deduplicating storage for uploaded files, used by
+# server.py; client.py cuts files the same way to skip the chunks the server
+# already holds.
+#
+# A file is cut into chunks at places chosen by its content: GEAR maps every
+# byte value to a bit (a pseudo-random half of the values to each), and a
+# chunk ends after the first run of len(BOUNDARY) bytes that all map to 0.
+# Whether a place is a cut depends only on the bytes just before it, so
+# inserting or deleting data moves the cuts next to the change and leaves
+# every other chunk (and its hash) as it was; identical and near-identical
+# files share most of their chunks. Even a text file of digits uses values
+# on both sides of GEAR, so it is cut by content too. The test runs in C,
+# through bytes.translate() and bytes.find(). Chunks are MIN_CHUNK_SIZE to
+# MAX_CHUNK_SIZE bytes, about MIN_CHUNK_SIZE + 2 ** (len(BOUNDARY) + 1) on
+# average.
+#
+# Each distinct chunk is stored once, in a file named by its hash (SHA-256,
+# like integrity.py), and the stored file becomes a manifest: MANIFEST_HEADER
+# followed by the (hash, size) of its chunks in order. A rename moves the
+# manifest and no data. An index shared by every server process (SQLite)
+# counts the manifest entries that refer to each chunk; a chunk nothing
+# refers to any more is deleted RELEASE_GRACE seconds later, so downloads
+# still reading it can finish, unless a new file takes it up again first.
+# Manifests are replaced inside an index transaction, and recount() rebuilds
+# the counts from the manifests, which the server does on start-up in case
+# it died between the two.
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+SCAN_SIZE = 16 * 1024  # Bytes tested per translate(), so a cut found early saves the rest
+BOUNDARY = bytes(15)  # Bits that end a chunk
+DIGEST_SIZE = integrity.DIGEST_SIZE
+CHUNK_ENTRY = struct.Struct(f'!{DIGEST_SIZE}sI')  # hash, size
+MANIFEST_MAGIC = b'\x89TUDMAN'
+MANIFEST_HEADER = struct.Struct('!7sQI')  # magic, file size, chunk count
+ENTRY_COUNT = struct.Struct('!I')  # Leads a list of entries on the wire
+RELEASE_GRACE = 15 * 60  # Seconds an unreferenced chunk is kept
+INDEX_FILE = "index.sqlite"
+QUERY_BATCH = 500  # Hashes per SQL IN (...) list
+
+Chunk = collections.namedtuple('Chunk', 'digest offset size')
+# What identifies one version of a manifest-backed file, in place of an
+# os.stat() result: its content size, and the mtime and inode of the manifest
+StoredStat = collections.namedtuple('StoredStat', 'st_size st_mtime_ns st_ino')
+
+
+# Byte value -> bit: the values ordered by their SHA-256, the first half 0
+def _gear():
+    table = bytearray(256)
+    for rank, value in enumerate(sorted(range(256), key=lambda value: hashlib.sha256(bytes([value])).digest())):
+        table[value] = rank >= 128
+    return bytes(table)
+
+
+GEAR = _gear()
+
+
+def chunk_digest(data):
+    hasher = integrity.new_hasher()
+    hasher.update(data)
+    return hasher.digest()
+
+
+# Return the end offsets of the chunks of data (bytes, mmap, ...)
+def chunk_boundaries(data):
+    size = len(data)
+    ends = []
+    start = 0
+    while start < size:
+        position = start + MIN_CHUNK_SIZE - len(BOUNDARY)  # The run must end at least MIN_CHUNK_SIZE in
+        limit = min(start + MAX_CHUNK_SIZE, size)
+        end = limit
+        while position < limit:
+            stop = min(position + SCAN_SIZE, limit)
+            found = data[position:stop].translate(GEAR).find(BOUNDARY)
+            if found >= 0:
+                end = position + found + len(BOUNDARY)
+                break
+            position = stop - len(BOUNDARY) + 1  # A run may straddle the pieces
+            if stop == limit:
+                break
+        ends.append(end)
+        start = end
+    return ends
+
+
+# Cut data into Chunks
+def chunks_of(data):
+    chunks = []
+    start = 0
+    with memoryview(data) as view:
+        for end in chunk_boundaries(data):
+            chunks.append(Chunk(chunk_digest(view[start:end]), start, end - start))
+            start = end
+    return chunks
+
+
+# Cut the open binary file f into Chunks
+def chunk_file(f):
+    if not os.fstat(f.fileno()).st_size:
+        return []
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return chunks_of(data)
+
+
+# Entries on the wire: ENTRY_COUNT, then a CHUNK_ENTRY per chunk
+def pack_entries(entries):
+    return ENTRY_COUNT.pack(len(entries)) + b''.join(CHUNK_ENTRY.pack(digest, size) for digest, size in entries)
+
+
+def unpack_entries(data, count):
+    return [CHUNK_ENTRY.unpack_from(data, i * CHUNK_ENTRY.size) for i in range(count)]
+
+
+# One bit per item, first item in the top bit of the first byte
+def pack_bitmap(flags):
+    bitmap = bytearray(-(-len(flags) // 8))
+    for i, flag in enumerate(flags):
+        if flag:
+            bitmap[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(bitmap)
+
+
+def unpack_bitmap(bitmap, count):
+    return [bool(bitmap[i >> 3] & (0x80 >> (i & 7))) for i in range(count)]
+
+
+def pack_manifest(size, entries):
+    return MANIFEST_HEADER.pack(MANIFEST_MAGIC, size, len(entries)) + b''.join(
+        CHUNK_ENTRY.pack(digest, chunk_size) for digest, chunk_size in entries)
+
+
+# Return (file size, entries, os.stat of the manifest) for the manifest
+# open as f, or None if f holds an ordinary file
+def _load_manifest(f):
+    st = os.fstat(f.fileno())
+    if (st.st_size - MANIFEST_HEADER.size) % CHUNK_ENTRY.size:
+        return None
+    header = f.read(MANIFEST_HEADER.size)
+    if len(header) < MANIFEST_HEADER.size:
+        return None
+    magic, size, count = MANIFEST_HEADER.unpack(header)
+    if magic != MANIFEST_MAGIC or st.st_size != MANIFEST_HEADER.size + count * CHUNK_ENTRY.size:
+        return None
+    entries = unpack_entries(f.read(count * CHUNK_ENTRY.size), count)
+    if sum(chunk_size for _, chunk_size in entries) != size:
+        return None
+    return size, entries, st
+
+
+# Return (file size, entries) of the manifest at path, or None if path holds
+# an ordinary file or nothing
+def read_manifest(path):
+    try:
+        with open(path, 'rb') as f:
+            manifest = _load_manifest(f)
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    return manifest[:2] if manifest is not None else None
+
+
+# Open the stored file at path for reading: a ChunkedFile for a manifest,
+# else the file itself. Raises FileNotFoundError.
+def open_stored(path, store):
+    f = open(path, 'rb')
+    try:
+        manifest = _load_manifest(f)
+    except BaseException:
+        f.close()
+        raise
+    if manifest is None:
+        f.seek(0)
+        return f
+    f.close()
+    size, entries, st = manifest
+    return ChunkedFile(store, entries, StoredStat(size, st.st_mtime_ns, st.st_ino))
+
+
+# Stat what open_stored() returned
+def file_stat(f):
+    if isinstance(f, ChunkedFile):
+        return f.st
+    return os.fstat(f.fileno())
+
+
+# Stat the stored file at path like file_stat(). Only a file whose size fits
+# a manifest is read to tell. Raises FileNotFoundError.
+def stat_stored(path):
+    st = os.stat(path)
+    if (st.st_size - MANIFEST_HEADER.size) % CHUNK_ENTRY.size:
+        return st
+    with open(path, 'rb') as f:
+        manifest = _load_manifest(f)
+    if manifest is None:
+        return st
+    size, _, st = manifest
+    return StoredStat(size, st.st_mtime_ns, st.st_ino)
+
+
+# Send count bytes from offset of what open_stored() returned
+def send_file(sock, f, offset, count):
+    if isinstance(f, ChunkedFile):
+        f.sendfile(sock, offset, count)
+    else:
+        sock.sendfile(f, offset, count)
+
+
+# Read-only file object over the chunks of a manifest
+class ChunkedFile:
+    def __init__(self, store, entries, st):
+        self.store = store
+        self.entries = entries
+        self.st = st
+        self.starts = list(itertools.accumulate((size for _, size in entries), initial=0))  # One past the end too
+        self.position = 0
+        self.current = None  # (index, open chunk file)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.current is not None:
+            self.current[1].close()
+            self.current = None
+        self.closed = True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.st.st_size
+        self.position = max(offset, 0)
+        return self.position
+
+    # Return the open file of chunk index
+    def _chunk(self, index):
+        if self.current is None or self.current[0] != index:
+            f = open(self.store.chunk_path(self.entries[index][0]), 'rb')
+            if self.current is not None:
+                self.current[1].close()
+            self.current = (index, f)
+        return self.current[1]
+
+    def read(self, n=-1):
+        end = self.st.st_size if n is None or n < 0 else min(self.position + n, self.st.st_size)
+        pieces = []
+        while self.position < end:
+            index = bisect.bisect_right(self.starts, self.position) - 1
+            f = self._chunk(index)
+            f.seek(self.position - self.starts[index])
+            piece = f.read(min(end, self.starts[index + 1]) - self.position)
+            if not piece:
+                raise integrity.IntegrityError(f"Chunk {self.entries[index][0].hex()} is shorter than recorded")
+            pieces.append(piece)
+            self.position += len(piece)
+        return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+    # Send count bytes from offset with sendfile(), chunk by chunk
+    def sendfile(self, sock, offset, count):
+        end = min(offset + count, self.st.st_size)
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while offset < end:
+            n = min(end, self.starts[index + 1]) - offset
+            with open(self.store.chunk_path(self.entries[index][0]), 'rb') as f:
+                sock.sendfile(f, offset - self.starts[index], n)
+            offset += n
+            index += 1
+
+
+# The chunks under root and their index
+class ChunkStore:
+    def __init__(self, root):
+        self.root = root
+        self.local = threading.local()  # SQLite connections cannot be shared between threads
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.root, INDEX_FILE), timeout=60, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS chunks (digest BLOB PRIMARY KEY, size INTEGER NOT NULL, '
+                       'refs INTEGER NOT NULL, released REAL) WITHOUT ROWID')
+            self.local.db = db
+        return db
+
+    # Run the with block in a write transaction, serialized against every
+    # other thread and process; yields the connection
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    def chunk_path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name)
+
+    # Return which of the given hashes name chunks the store holds
+    def contains(self, digests):
+        db = self._db()
+        held = set()
+        for i in range(0, len(digests), QUERY_BATCH):
+            batch = digests[i:i + QUERY_BATCH]
+            held.update(row[0] for row in db.execute(
+                f'SELECT digest FROM chunks WHERE digest IN ({",".join("?" * len(batch))})', batch))
+        return [digest in held for digest in digests]
+
+    # Store the data of a chunk, unless it is there already. Nothing refers
+    # to it until a manifest is committed.
+    def write_chunk(self, digest, data):
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            f = open(temp_path, 'wb')
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(temp_path, 'wb')
+        with f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    # Replace what is at path with a manifest of entries ((hash, size) pairs),
+    # counting the references. Returns the indexes of entries whose chunks
+    # are missing, in which case nothing was changed; otherwise returns [] and
+    # the StoredStat of the new file.
+    def commit(self, path, entries):
+        with self._transaction() as db:
+            known = dict(self._sizes(db, [digest for digest, _ in entries]))
+            missing = [i for i, (digest, size) in enumerate(entries)
+                       if digest not in known and not os.path.exists(self.chunk_path(digest))]
+            if missing:
+                return missing, None
+            size = sum(chunk_size for _, chunk_size in entries)
+            temp_path = os.path.join(self.root, f"manifest.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(temp_path, 'wb') as f:
+                f.write(pack_manifest(size, entries))
+            st = os.stat(temp_path)  # Once the write reached the file, so stat_stored() agrees
+            old = read_manifest(path)
+            self._add_references(db, entries)
+            if old is not None:
+                self._release(db, old[1])
+            os.replace(temp_path, path)
+        return [], StoredStat(size, st.st_mtime_ns, st.st_ino)
+
+    # Cut the open file f into chunks and commit a manifest of them at path,
+    # like commit(). Returns the StoredStat of the new file.
+    def store_file(self, f, path):
+        f.flush()
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            chunks = chunks_of(data)
+            entries = [(chunk.digest, chunk.size) for chunk in chunks]
+            held = self.contains([digest for digest, _ in entries])
+            wanted = [chunk for chunk, present in zip(chunks, held) if not present]
+            with memoryview(data) as view:
+                while True:
+                    for chunk in wanted:
+                        self.write_chunk(chunk.digest, view[chunk.offset:chunk.offset + chunk.size])
+                    missing, st = self.commit(path, entries)
+                    if not missing:
+                        return st
+                    wanted = [chunks[i] for i in missing]  # Released and deleted since we looked
+        finally:
+            if size:
+                data.close()
+
+    # Move the file at old_path to new_path, releasing the chunks of a
+    # manifest it replaces. Raises FileNotFoundError.
+    def rename(self, old_path, new_path):
+        with self._transaction() as db:
+            old = read_manifest(new_path) if os.path.exists(old_path) else None
+            os.rename(old_path, new_path)
+            if old is not None:
+                self._release(db, old[1])
+
+    def _sizes(self, db, digests):
+        for i in range(0, len(digests), QUERY_BATCH):
+            batch = digests[i:i + QUERY_BATCH]
+            yield from db.execute(
+                f'SELECT digest, size FROM chunks WHERE digest IN ({",".join("?" * len(batch))})', batch)
+
+    def _add_references(self, db, entries):
+        counts = collections.Counter(entries)
+        db.executemany('INSERT INTO chunks (digest, size, refs) VALUES (?, ?, ?) '
+                       'ON CONFLICT (digest) DO UPDATE SET refs = refs + excluded.refs, released = NULL',
+                       [(digest, size, n) for (digest, size), n in counts.items()])
+
+    def _release(self, db, entries):
+        now = time.time()
+        counts = collections.Counter(digest for digest, _ in entries)
+        db.executemany('UPDATE chunks SET refs = max(refs - ?, 0), '
+                       'released = CASE WHEN refs <= ? THEN ? ELSE NULL END WHERE digest = ?',
+                       [(n, n, now, digest) for digest, n in counts.items()])
+        self._collect(db, now)
+
+    # Delete the chunks released more than RELEASE_GRACE seconds ago
+    def _collect(self, db, now):
+        expired = [row[0] for row in db.execute(
+            'DELETE FROM chunks WHERE refs = 0 AND released < ? RETURNING digest', (now - RELEASE_GRACE,))]
+        for digest in expired:
+            try:
+                os.remove(self.chunk_path(digest))
+            except FileNotFoundError:
+                pass
+
+    # Rebuild the index from the manifests at paths, dropping chunk files no
+    # manifest refers to and files left by writes that never finished. Only
+    # safe while nothing else uses the store. Returns the number of chunks.
+    def recount(self, paths):
+        counts = collections.Counter()
+        for path in paths:
+            manifest = read_manifest(path)
+            if manifest is not None:
+                counts.update(manifest[1])
+        with self._transaction() as db:
+            db.execute('DELETE FROM chunks')
+            self._add_references(db, counts.elements())
+        names = {digest.hex() for digest, _ in counts}
+        for entry in os.scandir(self.root):
+            if entry.is_dir():
+                for chunk in os.scandir(entry.path):
+                    if chunk.name not in names:
+                        os.remove(chunk.path)
+            elif entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+        return len(names)
+
+    # Figures for the STATS command: distinct chunks, the bytes they take
+    # and the bytes of the files made of them
+    def stats(self):
+        chunks, stored, logical, released = self._db().execute(
+            'SELECT count(*), coalesce(sum(size), 0), coalesce(sum(size * refs), 0),'
+            ' coalesce(sum(size * (refs = 0)), 0) FROM chunks').fetchone()
+        return {'chunks': chunks, 'bytes': stored, 'file_bytes': logical,
+                'saved_bytes': logical - (stored - released), 'released_bytes': released}
@@ -0,0 +1,191 @@
+import hashlib
+import mmap
+import struct
+import zlib
+
+# rsync-style delta transfer shared by client.py and server.py.
+#
+# The server splits its copy of a file into fixed-size blocks and publishes a
+# signature per block: a weak rolling checksum (Adler-32) and a strong hash
+# (BLAKE2b-128). The client slides a window over its version of the file; where
+# the window matches a server block it sends a COPY record instead of the
+# bytes, everywhere else it sends LITERAL data. The server replays the records
+# against its old copy to rebuild the new file.
+#
+# Signatures are computed over large chunks with zlib.adler32 and hashlib, both
+# running in C, so the server side keeps up with the disk. The client only
+# rolls the checksum byte by byte (in Python) through regions that do not
+# match; unchanged data is checked a block at a time.
+
+SIGNATURE = struct.Struct('!I16s')  # weak checksum, strong hash
+RECORD = struct.Struct('!BII')  # kind, value, count
+
+# Record kinds
+DELTA_LITERAL = 0  # value = number of literal bytes that follow
+DELTA_COPY = 1  # value = first block index, count = number of blocks
+DELTA_END = 2  # followed by the BLAKE2b-128 digest of the whole new file
+
+ADLER_MOD = 65521
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+READ_CHUNK = 4 * 1024 * 1024  # Bytes read at a time when computing signatures
+MAX_LITERAL = 1024 * 1024  # Largest literal record
+
+
+class DeltaError(Exception):
+    pass
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# Pick a block size around sqrt(file size), as rsync does, rounded to a power
+# of two
+def choose_block_size(file_size):
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and block_size * block_size < file_size:
+        block_size *= 2
+    return block_size
+
+
+# Compute the packed signatures of every block of an open binary file
+def compute_signatures(f, block_size):
+    chunk_size = max(READ_CHUNK // block_size, 1) * block_size
+    out = bytearray()
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        for start in range(0, len(chunk), block_size):
+            block = view[start:start + block_size]
+            out += SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+    return bytes(out)
+
+
+# Turn packed signatures into {weak checksum: [(block index, strong hash)]}
+def parse_signatures(payload):
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(payload)):
+        table.setdefault(weak, []).append((index, strong))
+    return table
+
+
+# Write the delta that turns the server's file (described by its signatures)
+# into the local file at path. Records go to the binary file object out.
+# Returns (literal bytes, copied blocks).
+def write_delta(path, signatures, block_size, out):
+    table = parse_signatures(signatures)
+    # Only full-size blocks can match inside the file; a short last block of
+    # the server's file is only ever useful at our very end.
+    block_count = len(signatures) // SIGNATURE.size
+    stats = [0, 0]
+    pending_copy = [0, 0]  # first block, count
+
+    def flush_copy():
+        if pending_copy[1]:
+            out.write(RECORD.pack(DELTA_COPY, pending_copy[0], pending_copy[1]))
+            stats[1] += pending_copy[1]
+            pending_copy[1] = 0
+
+    def emit_literal(data):
+        flush_copy()
+        for start in range(0, len(data), MAX_LITERAL):
+            piece = data[start:start + MAX_LITERAL]
+            out.write(RECORD.pack(DELTA_LITERAL, len(piece), 0))
+            out.write(piece)
+            stats[0] += len(piece)
+
+    def emit_copy(index):
+        if pending_copy[1] and pending_copy[0] + pending_copy[1] == index:
+            pending_copy[1] += 1
+        else:
+            flush_copy()
+            pending_copy[0], pending_copy[1] = index, 1
+
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        f.seek(0)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            view = memoryview(data)
+            digest = strong_hash(view)
+            position = 0  # Start of the window
+            literal_start = 0
+            weak = None
+            while position < size:
+                length = min(block_size, size - position)
+                if weak is None:
+                    weak = zlib.adler32(view[position:position + length])
+                match = None
+                candidates = table.get(weak)
+                if candidates:
+                    strong = strong_hash(view[position:position + length])
+                    for index, candidate in candidates:
+                        if candidate == strong and (length == block_size or index == block_count - 1):
+                            match = index
+                            break
+                if match is not None:
+                    if literal_start < position:
+                        emit_literal(view[literal_start:position])
+                    emit_copy(match)
+                    position += length
+                    literal_start = position
+                    weak = None
+                    continue
+                if length < block_size:
+                    break  # Tail shorter than a block and unmatched
+                # Roll the window one byte forward
+                out_byte = data[position]
+                if position + block_size < size:
+                    in_byte = data[position + block_size]
+                    a = ((weak & 0xFFFF) - out_byte + in_byte) % ADLER_MOD
+                    b = ((weak >> 16) - block_size * out_byte + a - 1) % ADLER_MOD
+                    weak = (b << 16) | a
+                else:
+                    weak = None  # Window now runs into the tail
+                position += 1
+            if literal_start < size:
+                emit_literal(view[literal_start:size])
+            flush_copy()
+            del view
+        finally:
+            if size:
+                data.close()
+    out.write(RECORD.pack(DELTA_END, 0, 0))
+    out.write(digest)
+    return stats[0], stats[1]
+
+
+# Rebuild a file from a delta stream. read_exact(n) returns the next n bytes
+# of the stream, basis is the open old copy and out receives the new file.
+# Returns the number of bytes written; raises DeltaError if the result does
+# not hash to the digest the client sent.
+def apply_delta(read_exact, basis, out, block_size):
+    digest = hashlib.blake2b(digest_size=16)
+    written = 0
+    while True:
+        kind, value, count = RECORD.unpack(read_exact(RECORD.size))
+        if kind == DELTA_LITERAL:
+            data = read_exact(value)
+            digest.update(data)
+            out.write(data)
+            written += len(data)
+        elif kind == DELTA_COPY:
+            basis.seek(value * block_size)
+            remaining = count * block_size
+            while remaining > 0:
+                data = basis.read(min(remaining, READ_CHUNK))
+                if not data:
+                    break  # Copy ran into the short last block
+                digest.update(data)
+                out.write(data)
+                written += len(data)
+                remaining -= len(data)
+        elif kind == DELTA_END:
+            if bytes(read_exact(16)) != digest.digest():
+                raise DeltaError("Rebuilt file does not match the client's copy")
+            return written
+        else:
+            raise DeltaError(f"Unknown delta record {kind}")
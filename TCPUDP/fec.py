@@ -0,0 +1,189 @@
+import struct
+
+# Forward error correction for UDP transfers (see udp_transfer.py).
+#
+# The DATA packets of a transfer are grouped into blocks of K consecutive
+# sequence numbers, and each block gets M repair packets. Repair packet j is
+# the XOR of the block's packets i with i % M == j, so every parity group
+# interleaves the block: the receiver rebuilds any loss pattern that leaves
+# at most one packet missing per group -- in particular any burst of up to M
+# consecutive packets -- without waiting for a retransmit.
+#
+# Payloads are XORed as Python integers (int.from_bytes), which runs the
+# whole packet through one C-level operation. A shorter packet (the last one
+# of the file) is padded with zeros; the repair also carries the XOR of the
+# group's payload lengths, so the rebuilt packet gets its exact length back.
+#
+# The receiver keeps the running XOR of what it received per group instead
+# of the packets themselves, so FEC needs no extra buffering.
+
+REPAIR_HEADER = struct.Struct('!BBBH')  # group, data packets in the block, M, XOR of lengths
+MAX_BLOCK = 255  # Largest K (and M) the header can describe
+
+# Defaults for the client's fec setting
+BLOCK_SIZE = 16  # K: data packets per block
+REPAIR_COUNT = 2  # M: repair packets per block
+
+
+class FecError(Exception):
+    pass
+
+
+def check_parameters(k, m):
+    if not 1 <= k <= MAX_BLOCK or not 1 <= m <= k:
+        raise FecError(f"Invalid FEC parameters K={k}, M={m}")
+
+
+# Format (k, m) for a UDP command, e.g. "fec=16,2"
+def format_option(k, m):
+    return f"fec={k},{m}"
+
+
+# Parse the text after "fec=" back into (k, m)
+def parse_option(text):
+    try:
+        k, m = (int(part) for part in text.split(','))
+    except ValueError:
+        raise FecError(f"Malformed FEC option {text}")
+    check_parameters(k, m)
+    return k, m
+
+
+# Sender side: fed every new DATA payload in sequence order, produces the
+# repair packet bodies of each block as soon as it is complete
+class BlockEncoder:
+    def __init__(self, k, m):
+        check_parameters(k, m)
+        self.k = k
+        self.m = m
+        self.block_start = 0
+        self.count = 0
+        self._reset()
+
+    def _reset(self):
+        self.parity = [0] * self.m
+        self.lengths = [0] * self.m
+        self.longest = [0] * self.m
+
+    # Add the payload of DATA packet seq; returns (block start, [repair
+    # bodies]) once it completed a block, else None
+    def add(self, seq, payload):
+        group = (seq - self.block_start) % self.m
+        self.parity[group] ^= int.from_bytes(payload, 'little')
+        self.lengths[group] ^= len(payload)
+        self.longest[group] = max(self.longest[group], len(payload))
+        self.count += 1
+        if self.count == self.k:
+            return self.flush()
+        return None
+
+    # Repairs for a partly filled last block (None if it is empty)
+    def flush(self):
+        if not self.count:
+            return None
+        repairs = []
+        for group in range(min(self.m, self.count)):
+            body = REPAIR_HEADER.pack(group, self.count, self.m, self.lengths[group])
+            repairs.append(body + self.parity[group].to_bytes(self.longest[group], 'little'))
+        block_start = self.block_start
+        self.block_start += self.count
+        self.count = 0
+        self._reset()
+        return block_start, repairs
+
+
+# What the receiver knows about one block
+class _Block:
+    __slots__ = ('received', 'parity', 'lengths', 'repairs', 'count')
+
+    def __init__(self, m):
+        self.received = 0  # Bitmap of the block's packets seen so far
+        self.parity = [0] * m  # XOR of the received payloads per group
+        self.lengths = [0] * m
+        self.repairs = {}  # group -> (parity, lengths XOR, payload size)
+        self.count = None  # Data packets in the block, known from a repair
+
+
+# Receiver side: fed every DATA payload the first time it is accepted and
+# every repair body; returns the packets it could rebuild
+class BlockDecoder:
+    def __init__(self, k, m):
+        check_parameters(k, m)
+        self.k = k
+        self.m = m
+        self.blocks = {}  # block start -> _Block
+        self.done_below = 0  # Blocks before this sequence number are complete
+        self.recovered = 0
+        self.repairs_received = 0
+
+    def _block(self, block_start):
+        if block_start < self.done_below:
+            return None
+        block = self.blocks.get(block_start)
+        if block is None:
+            block = self.blocks[block_start] = _Block(self.m)
+        return block
+
+    def _record(self, block, index, payload):
+        bit = 1 << index
+        if block.received & bit:
+            return False
+        block.received |= bit
+        group = index % self.m
+        block.parity[group] ^= int.from_bytes(payload, 'little')
+        block.lengths[group] ^= len(payload)
+        return True
+
+    # Rebuild the one missing packet of a group; returns (seq, payload) or None
+    def _try_group(self, block_start, block, group):
+        repair = block.repairs.get(group)
+        if repair is None:
+            return None
+        missing = [index for index in range(group, block.count, self.m) if not block.received & (1 << index)]
+        if len(missing) != 1:
+            return None
+        parity, lengths, size = repair
+        length = lengths ^ block.lengths[group]
+        if length > size:
+            return None  # Inconsistent repair; leave it to retransmission
+        payload = (parity ^ block.parity[group]).to_bytes(size, 'little')[:length]
+        self._record(block, missing[0], payload)
+        self.recovered += 1
+        return block_start + missing[0], payload
+
+    # A DATA payload was accepted for seq; returns [(seq, payload)] rebuilt
+    def add(self, seq, payload):
+        block_start = seq - seq % self.k
+        block = self._block(block_start)
+        if block is None or not self._record(block, seq - block_start, payload):
+            return []
+        if block.count is None:
+            return []
+        rebuilt = self._try_group(block_start, block, (seq - block_start) % self.m)
+        return [rebuilt] if rebuilt else []
+
+    # A repair body arrived for the block starting at block_start
+    def add_repair(self, block_start, body):
+        if len(body) < REPAIR_HEADER.size or block_start % self.k:
+            return []
+        group, count, m, lengths = REPAIR_HEADER.unpack_from(body)
+        if m != self.m or not 0 < count <= self.k or group >= m:
+            return []
+        block = self._block(block_start)
+        if block is None:
+            return []
+        self.repairs_received += 1
+        block.count = count
+        payload = body[REPAIR_HEADER.size:]
+        block.repairs[group] = (int.from_bytes(payload, 'little'), lengths, len(payload))
+        rebuilt = self._try_group(block_start, block, group)
+        return [rebuilt] if rebuilt else []
+
+    # Drop the state of blocks lying entirely below seq
+    def forget_below(self, seq):
+        done_below = seq - seq % self.k
+        if done_below <= self.done_below:
+            return
+        self.done_below = done_below
+        for block_start in [start for start in self.blocks if start < done_below]:
+            del self.blocks[block_start]
@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+# In-memory cache of small, frequently downloaded files for the server's GET
+# path. Entries hold the whole file content and are evicted least recently
+# used first once their total size exceeds the byte budget.
+#
+# Each entry remembers the size, mtime and inode of the file it was read
+# from and is only used while a fresh stat() still matches, so writes made by
+# other server processes (see --workers) can never be served stale. The
+# server also invalidates names it writes itself to free the memory early.
+
+
+class FileCache:
+    def __init__(self, budget, max_file_size):
+        self.budget = budget  # Bytes of file content kept in memory
+        self.max_file_size = max_file_size  # Larger files are never cached
+        self.entries = OrderedDict()  # filename -> (bytes, (size, mtime_ns, inode))
+        self.used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0  # Files loaded from disk into the cache
+        self.bypassed = 0  # GETs of files too large to cache
+        self.evictions = 0
+
+    # Return the cached content of filename, or None if it is not cached or
+    # the file changed since; st is a fresh os.stat() of the file
+    def get(self, filename, st):
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None or entry[1] != file_key(st):
+                return None
+            self.entries.move_to_end(filename)
+            self.hits += 1
+            return entry[0]
+
+    # Count a GET that streamed a file too large for the cache
+    def bypass(self):
+        with self.lock:
+            self.bypassed += 1
+
+    # Cache data just read from disk after get() found nothing; st is the
+    # os.fstat() of the file object the data was read from
+    def add(self, filename, data, st):
+        with self.lock:
+            self.misses += 1
+            if len(data) > self.max_file_size or len(data) > self.budget:
+                return
+            self._drop(filename)
+            self.entries[filename] = (data, file_key(st))
+            self.used += len(data)
+            while self.used > self.budget:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.used -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, *filenames):
+        with self.lock:
+            for filename in filenames:
+                self._drop(filename)
+
+    def _drop(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.used -= len(entry[0])
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.used,
+                'budget': self.budget,
+            }
+
+
+# What identifies one version of a file: replacing it (os.replace) changes
+# the inode, writing in place changes the size or mtime
+def file_key(st):
+    return st.st_size, st.st_mtime_ns, st.st_ino
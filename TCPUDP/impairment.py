@@ -0,0 +1,386 @@
+import argparse
+import copy
+import heapq
+import itertools
+import queue
+import random
+import select
+import socket
+import sys
+import threading
+import time
+
+# Network impairment relays for testing on one machine.
+#
+# UdpRelay and TcpRelay listen on a local port and forward everything to a
+# target (normally the server), applying an Impairment to each direction:
+#
+#   with UdpRelay(('127.0.0.1', 12346), Impairment(loss=0.02, delay=0.005, seed=7)) as relay:
+#       client.UDP_PORT = relay.port
+#       client.udp_send_file('big.bin')
+#       print(relay.stats())
+#
+# Datagrams can be lost, duplicated, delayed with jitter, held back so later
+# ones overtake them (reordering) and paced to a bandwidth cap with a
+# bounded queue that drops what overflows it. A TCP byte stream can only be
+# delayed and rate limited; loss and reordering are left to the kernel's TCP.
+# Both can have a byte flipped now and then (corrupt), standing in for errors
+# that get past the link and transport checksums. On TCP the byte may land
+# in a frame header, which the file server does not checksum; that
+# connection then breaks or stalls.
+#
+# Every random decision comes from a random.Random seeded per direction, so
+# a run sees the same sequence of decisions for the same sequence of
+# packets. The script can also run a relay from the command line:
+#
+#   python impairment.py udp 127.0.0.1:12346 --listen 13000 --loss 0.05 --delay 0.01
+
+POLL_INTERVAL = 0.05  # Seconds between checks for stop() while idle
+UPSTREAM_IDLE_TIMEOUT = 60  # Seconds before an idle UDP client mapping is dropped
+MAX_DATAGRAM = 65535
+TCP_CHUNK = 64 * 1024
+
+
+# Impairments applied to one direction of traffic. Times are in seconds,
+# probabilities between 0 and 1, bandwidth in bytes per second (None =
+# unlimited) and queue_limit in bytes waiting for the bandwidth cap.
+class Impairment:
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, reorder=0.0, reorder_delay=0.01,
+                 duplicate=0.0, bandwidth=None, queue_limit=1024 * 1024, corrupt=0.0, seed=None):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay  # Extra hold for a reordered datagram
+        self.duplicate = duplicate
+        self.bandwidth = bandwidth
+        self.queue_limit = queue_limit
+        self.corrupt = corrupt  # Probability a datagram (or piece of a stream) gets a byte flipped
+        self.seed = seed
+
+    # The same impairment with another seed, for the opposite direction
+    def reseeded(self, seed):
+        other = copy.copy(self)
+        other.seed = seed
+        return other
+
+
+# One direction of a relay: decides when (and whether) each packet goes out
+class Link:
+    def __init__(self, impairment):
+        self.impairment = impairment
+        self.rng = random.Random(impairment.seed)
+        self.link_free = 0.0  # When the bandwidth-capped link finishes its backlog
+        self.last_release = 0.0  # Stream mode keeps bytes in order
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.queue_dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.corrupted = 0
+
+    # When a packet entering the link at now has been put on the wire, or
+    # None if it overflows the queue (only datagrams are ever dropped)
+    def _transmit(self, size, now, droppable=True):
+        bandwidth = self.impairment.bandwidth
+        if not bandwidth:
+            return now
+        backlog = max(self.link_free - now, 0) * bandwidth
+        if droppable and backlog + size > self.impairment.queue_limit:
+            return None
+        self.link_free = max(now, self.link_free) + size / bandwidth
+        return self.link_free
+
+    def _delay(self):
+        imp = self.impairment
+        return max(imp.delay + (self.rng.uniform(-imp.jitter, imp.jitter) if imp.jitter else 0.0), 0.0)
+
+    # Release times for a datagram of size bytes arriving at now (empty if
+    # it is dropped, two entries if it is duplicated)
+    def schedule(self, size, now):
+        imp = self.impairment
+        self.packets += 1
+        self.bytes += size
+        if imp.loss and self.rng.random() < imp.loss:
+            self.dropped += 1
+            return []
+        copies = 1
+        if imp.duplicate and self.rng.random() < imp.duplicate:
+            copies = 2
+            self.duplicated += 1
+        times = []
+        for _ in range(copies):
+            sent = self._transmit(size, now)
+            if sent is None:
+                self.queue_dropped += 1
+                continue
+            release = sent + self._delay()
+            if imp.reorder and self.rng.random() < imp.reorder:
+                release += imp.reorder_delay
+                self.reordered += 1
+            times.append(release)
+        return times
+
+    # Release time for a piece of a byte stream; never earlier than the
+    # piece before it
+    def schedule_stream(self, size, now):
+        self.packets += 1
+        self.bytes += size
+        sent = self._transmit(size, now, droppable=False)
+        self.last_release = max(sent + self._delay(), self.last_release)
+        return self.last_release
+
+    # data, or a copy of it with one byte flipped
+    def damage(self, data):
+        if not self.impairment.corrupt or not data or self.rng.random() >= self.impairment.corrupt:
+            return data
+        self.corrupted += 1
+        damaged = bytearray(data)
+        damaged[self.rng.randrange(len(damaged))] ^= 1 << self.rng.randrange(8)
+        return bytes(damaged)
+
+    def stats(self):
+        return {
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'dropped': self.dropped,
+            'queue_dropped': self.queue_dropped,
+            'duplicated': self.duplicated,
+            'reordered': self.reordered,
+            'corrupted': self.corrupted,
+        }
+
+
+class _Relay:
+    def __init__(self, target, impairment, reverse, listen):
+        impairment = impairment or Impairment()
+        if reverse is None:
+            seed = None if impairment.seed is None else impairment.seed + 1
+            reverse = impairment.reseeded(seed)
+        self.target = target
+        self.forward = Link(impairment)  # Client to target
+        self.backward = Link(reverse)  # Target to client
+        self.listen = listen
+        self.sock = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    @property
+    def address(self):
+        return self.sock.getsockname()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        with self.lock:
+            return {'forward': self.forward.stats(), 'backward': self.backward.stats()}
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sock.close()
+
+
+# UDP relay. Each client address gets its own upstream socket, so the
+# target sees one peer per client and its replies can be routed back.
+class UdpRelay(_Relay):
+    def __init__(self, target, impairment=None, reverse=None, listen=('127.0.0.1', 0)):
+        super().__init__(target, impairment, reverse, listen)
+        self.upstreams = {}  # client address -> upstream socket
+        self.clients = {}  # upstream socket -> (client address, last activity)
+        self.pending = []  # heap of (release time, order, socket, data, address)
+        self.order = itertools.count()
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(self.listen)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def _upstream(self, client_addr, now):
+        upstream = self.upstreams.get(client_addr)
+        if upstream is None:
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            upstream.connect(self.target)
+            self.upstreams[client_addr] = upstream
+        self.clients[upstream] = (client_addr, now)
+        return upstream
+
+    def _queue(self, link, data, sock, addr, now):
+        with self.lock:
+            times = link.schedule(len(data), now)
+            data = link.damage(data)
+        for release in times:
+            heapq.heappush(self.pending, (release, next(self.order), sock, data, addr))
+
+    def _expire(self, now):
+        for upstream, (client_addr, last) in list(self.clients.items()):
+            if now - last > UPSTREAM_IDLE_TIMEOUT:
+                del self.clients[upstream]
+                del self.upstreams[client_addr]
+                upstream.close()
+
+    def _run(self):
+        last_expiry = time.monotonic()
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            timeout = POLL_INTERVAL
+            if self.pending:
+                timeout = min(max(self.pending[0][0] - now, 0), POLL_INTERVAL)
+            readable, _, _ = select.select([self.sock, *self.clients], [], [], timeout)
+            now = time.monotonic()
+            for sock in readable:
+                try:
+                    if sock is self.sock:
+                        data, client_addr = sock.recvfrom(MAX_DATAGRAM)
+                        self._queue(self.forward, data, self._upstream(client_addr, now), None, now)
+                    else:
+                        data = sock.recv(MAX_DATAGRAM)
+                        client_addr, _ = self.clients[sock]
+                        self.clients[sock] = (client_addr, now)
+                        self._queue(self.backward, data, self.sock, client_addr, now)
+                except ConnectionRefusedError:
+                    pass  # ICMP port unreachable from a stopped target
+            while self.pending and self.pending[0][0] <= now:
+                _, _, sock, data, addr = heapq.heappop(self.pending)
+                try:
+                    if addr is None:
+                        sock.send(data)
+                    else:
+                        sock.sendto(data, addr)
+                except OSError:
+                    pass  # A full socket buffer loses the datagram like a real network would
+            if now - last_expiry > UPSTREAM_IDLE_TIMEOUT:
+                self._expire(now)
+                last_expiry = now
+        for upstream in self.upstreams.values():
+            upstream.close()
+
+
+# TCP relay: each accepted connection is paired with a connection to the
+# target and both directions are delayed and rate limited
+class TcpRelay(_Relay):
+    def __init__(self, target, impairment=None, reverse=None, listen=('127.0.0.1', 0)):
+        super().__init__(target, impairment, reverse, listen)
+        self.connections = []
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.listen)
+        self.sock.listen(128)
+        self.sock.settimeout(POLL_INTERVAL)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                downstream, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            try:
+                upstream = socket.create_connection(self.target)
+            except OSError:
+                downstream.close()
+                continue
+            for sock in (downstream, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections += [downstream, upstream]
+            self._pipe(downstream, upstream, self.forward)
+            self._pipe(upstream, downstream, self.backward)
+        for sock in self.connections:
+            sock.close()
+
+    def _pipe(self, source, destination, link):
+        pieces = queue.Queue()
+
+        def reader():
+            try:
+                while True:
+                    data = source.recv(TCP_CHUNK)
+                    if not data:
+                        break
+                    with self.lock:
+                        release = link.schedule_stream(len(data), time.monotonic())
+                        data = link.damage(data)
+                    pieces.put((release, data))
+            except OSError:
+                pass
+            pieces.put(None)
+
+        def writer():
+            try:
+                while True:
+                    item = pieces.get()
+                    if item is None:
+                        destination.shutdown(socket.SHUT_WR)
+                        return
+                    release, data = item
+                    wait = release - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    destination.sendall(data)
+            except OSError:
+                source.close()  # Peer went away; stop the reader too
+
+        threading.Thread(target=reader, daemon=True).start()
+        threading.Thread(target=writer, daemon=True).start()
+
+
+# Build an Impairment from parsed command-line style options (any object
+# with the attributes below, such as an argparse namespace)
+def impairment_from_args(args):
+    return Impairment(loss=args.loss, delay=args.delay, jitter=args.jitter, reorder=args.reorder,
+                      duplicate=args.duplicate, bandwidth=args.bandwidth, corrupt=args.corrupt, seed=args.seed)
+
+
+def add_impairment_arguments(parser):
+    parser.add_argument('--loss', type=float, default=0.0, help="probability a datagram is dropped")
+    parser.add_argument('--delay', type=float, default=0.0, help="one-way delay in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="+/- random variation of the delay")
+    parser.add_argument('--reorder', type=float, default=0.0, help="probability a datagram is held back")
+    parser.add_argument('--duplicate', type=float, default=0.0, help="probability a datagram is sent twice")
+    parser.add_argument('--bandwidth', type=float, default=None, help="bytes per second in each direction")
+    parser.add_argument('--corrupt', type=float, default=0.0, help="probability a datagram or stream piece has a byte flipped")
+    parser.add_argument('--seed', type=int, default=None, help="seed for the random decisions")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Relay that impairs traffic to a local server")
+    parser.add_argument('protocol', choices=['udp', 'tcp'])
+    parser.add_argument('target', help="host:port to forward to")
+    parser.add_argument('--listen', type=int, default=0, help="local port to listen on")
+    add_impairment_arguments(parser)
+    args = parser.parse_args(argv)
+    host, port = args.target.rsplit(':', 1)
+    relay_class = UdpRelay if args.protocol == 'udp' else TcpRelay
+    relay = relay_class((host, int(port)), impairment_from_args(args), listen=('127.0.0.1', args.listen))
+    relay.start()
+    print(f"Relaying {args.protocol.upper()} 127.0.0.1:{relay.port} -> {args.target}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.stop()
+        print(relay.stats())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import struct
+import threading
+import zlib
+
+# End-to-end integrity checks for file transfers, shared by client.py,
+# server.py and udp_transfer.py.
+#
+# Data is checked in CHUNK_SIZE chunks, counted from the first byte of a
+# payload, with CRC32, and a whole file is identified by a strong hash
+# (SHA-256, the fastest of hashlib's on CPUs with SHA extensions).
+# StreamChecksum computes both as the bytes stream past on their way to or
+# from the disk, so no side reads a file a second time to check it.
+#
+# On the TCP connection a frame with FLAG_CHECKSUM (see protocol.py) carries,
+# after its payload, a trailer: the CRC32 of each chunk of the payload and
+# the DIGEST_SIZE-byte hash of the whole file (all zero bytes when the sender
+# does not know it). The receiver compares its own CRCs with the trailer, so
+# a corrupted transfer is narrowed down to the chunks that differ and only
+# those are sent again.
+#
+# The server keeps the hash and chunk CRCs of every stored file in a sidecar
+# record, keyed like the compressed copies by the size, mtime and inode of
+# the file, so later GETs send them without reading the file and a rename
+# carries them along.
+
+CHUNK_SIZE = 1024 * 1024  # Bytes covered by one CRC32
+CRC = struct.Struct('!I')
+DIGEST_SIZE = 32  # SHA-256, like summary.content_hasher()
+NO_DIGEST = bytes(DIGEST_SIZE)
+METADATA_KEY = struct.Struct('!QQQI')  # size, mtime_ns, inode of the file, chunk size
+READ_SIZE = 1024 * 1024
+
+
+class IntegrityError(RuntimeError):
+    pass
+
+
+def new_hasher():
+    return hashlib.sha256()
+
+
+# Number of chunks (and CRCs) covering length bytes
+def chunk_count(length, chunk_size=CHUNK_SIZE):
+    return -(-length // chunk_size)
+
+
+# Bytes of the trailer that follows a checksummed payload of length bytes
+def trailer_size(length):
+    return chunk_count(length) * CRC.size + DIGEST_SIZE
+
+
+# Chunk CRCs and, optionally, the whole-file hash of a stream of bytes fed
+# in pieces of any size
+class StreamChecksum:
+    def __init__(self, whole_file=True, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.hasher = new_hasher() if whole_file else None
+        self.crcs = []
+        self.crc = 0  # CRC32 of the chunk being filled
+        self.filled = 0  # Bytes in that chunk
+        self.size = 0
+
+    def update(self, data):
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.size += len(data)
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.chunk_size - self.filled)
+            self.crc = zlib.crc32(view[:n], self.crc)
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.chunk_size:
+                self.crcs.append(self.crc)
+                self.crc = 0
+                self.filled = 0
+
+    # CRCs of every chunk, the last (shorter) one included
+    def finish(self):
+        if self.filled:
+            self.crcs.append(self.crc)
+            self.crc = 0
+            self.filled = 0
+        return self.crcs
+
+    def digest(self):
+        return self.hasher.digest() if self.hasher is not None else NO_DIGEST
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+    def trailer(self):
+        return pack_trailer(self.finish(), self.digest())
+
+
+# Checksum count bytes of the open binary file f from offset (to the end of
+# the file when count is None)
+def checksum_file(f, offset=0, count=None, whole_file=True):
+    checksum = StreamChecksum(whole_file)
+    f.seek(offset)
+    while count is None or checksum.size < count:
+        data = f.read(READ_SIZE if count is None else min(READ_SIZE, count - checksum.size))
+        if not data:
+            break
+        checksum.update(data)
+    checksum.finish()
+    return checksum
+
+
+def pack_trailer(crcs, digest=NO_DIGEST):
+    return struct.pack(f'!{len(crcs)}I', *crcs) + digest
+
+
+# Split the trailer of a payload of length bytes into (CRCs, digest); the
+# digest is None when the sender did not know it
+def unpack_trailer(trailer, length):
+    count = chunk_count(length)
+    crcs = list(struct.unpack_from(f'!{count}I', trailer))
+    digest = bytes(trailer[count * CRC.size:])
+    return crcs, None if digest == NO_DIGEST else digest
+
+
+# (offset, size) ranges of a payload of length bytes starting at file offset
+# whose chunk CRCs differ, neighbouring chunks merged
+def bad_ranges(offset, length, ours, theirs, chunk_size=CHUNK_SIZE):
+    ranges = []
+    for i in range(chunk_count(length, chunk_size)):
+        if i < len(ours) and i < len(theirs) and ours[i] == theirs[i]:
+            continue
+        start = offset + i * chunk_size
+        size = min(chunk_size, offset + length - start)
+        if ranges and ranges[-1][0] + ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + size)
+        else:
+            ranges.append((start, size))
+    return ranges
+
+
+# ranges (a list of (offset, size)) without the count bytes from offset
+def subtract_range(ranges, offset, count):
+    end = offset + count
+    rest = []
+    for start, size in ranges:
+        if start < offset:
+            rest.append((start, min(start + size, offset) - start))
+        if start + size > end:
+            rest.append((max(start, end), start + size - max(start, end)))
+    return rest
+
+
+# Record the hash and chunk CRCs of the file described by st (an os.stat
+# result) at path
+def store_metadata(path, st, digest, crcs):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # Other threads and processes may store at once
+    with open(temp_path, 'wb') as f:
+        f.write(METADATA_KEY.pack(st.st_size, st.st_mtime_ns, st.st_ino, CHUNK_SIZE))
+        f.write(digest)
+        f.write(struct.pack(f'!{len(crcs)}I', *crcs))
+    os.replace(temp_path, path)
+
+
+# Return (digest, CRCs) recorded at path for the file described by st, or
+# None if there is no record or it belongs to an older version of the file
+def load_metadata(path, st):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if data[:METADATA_KEY.size] != METADATA_KEY.pack(st.st_size, st.st_mtime_ns, st.st_ino, CHUNK_SIZE):
+        return None
+    count = chunk_count(st.st_size)
+    if len(data) != METADATA_KEY.size + DIGEST_SIZE + count * CRC.size:
+        return None
+    digest = data[METADATA_KEY.size:METADATA_KEY.size + DIGEST_SIZE]
+    crcs = list(struct.unpack_from(f'!{count}I', data, METADATA_KEY.size + DIGEST_SIZE))
+    return digest, crcs
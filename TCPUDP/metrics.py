@@ -0,0 +1,307 @@
+import bisect
+import collections
+import http.server
+import os
+import sys
+import threading
+import time
+
+# Server instrumentation: request counters, latency histograms, byte counts,
+# in-flight connections and UDP transfer figures, reported through the STATS
+# command and, optionally, as Prometheus text over HTTP on localhost.
+#
+# The server times each request with time.perf_counter_ns() and hands the
+# start time to Metrics.record() once it is answered, which costs two clock
+# reads and one short locked update per request. Latencies go into
+# histograms with fixed bucket bounds (LATENCY_BUCKETS), so memory stays
+# constant and percentiles are estimated from the buckets the way
+# Prometheus' histogram_quantile() does; a histogram's count doubles as the
+# number of requests. A loop that is the only writer of its histogram (the
+# UDP server's, per datagram) takes it from Metrics.histogram() once and
+# calls observe() without the lock.
+#
+# Counters are per server process; with --workers every worker reports its
+# own, like the caches.
+#
+# SamplingProfiler is opt-in: a thread that looks at the stack of every other
+# thread at a fixed interval (sys._current_frames()) and counts them, which
+# is enough to find hot spots without slowing the code it watches. Threads
+# blocked in a system call show up at the call that waits (accept(),
+# recv_into(), ...).
+
+PROMETHEUS_PREFIX = 'tcpudp_'
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # Upper bounds (s)
+_BUCKET_BOUNDS_NS = [int(bound * 1e9) for bound in LATENCY_BUCKETS]
+UDP_COUNTERS = ('packets_sent', 'packets_received', 'retransmits', 'fast_retransmits', 'timeouts',
+                'duplicates', 'recovered')  # Summed over the stats() of finished UDP transfers
+PROFILE_INTERVAL = 0.01  # Seconds between profiler samples
+PROFILE_TOP = 10  # Functions listed in STATS
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum_ns', 'max_ns')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum_ns = 0
+        self.max_ns = 0
+
+    def observe(self, elapsed_ns):
+        self.counts[bisect.bisect_left(_BUCKET_BOUNDS_NS, elapsed_ns)] += 1
+        self.count += 1
+        self.sum_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    # Estimate the q quantile (0..1) in seconds, interpolating inside the
+    # bucket it falls in; never more than the largest value seen
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        largest = self.max_ns / 1e9
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(LATENCY_BUCKETS):
+                    return largest
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                return min(lower + (LATENCY_BUCKETS[i] - lower) * (rank - seen) / n, largest)
+            seen += n
+        return largest
+
+    def snapshot(self):
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+        return {
+            'count': self.count,
+            'mean_ms': ms(self.sum_ns / self.count / 1e9) if self.count else None,
+            'p50_ms': ms(self.quantile(0.5)),
+            'p90_ms': ms(self.quantile(0.9)),
+            'p99_ms': ms(self.quantile(0.99)),
+            'max_ms': ms(self.max_ns / 1e9),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.latency = {}  # operation -> Histogram
+        # transport -> bytes from / to clients: everything on the wire for TCP,
+        # file bytes of finished transfers for UDP
+        self.bytes_received = collections.Counter()
+        self.bytes_sent = collections.Counter()
+        self.connections = 0  # TCP connections being served
+        self.connections_total = 0
+        self.udp_sessions = 0  # UDP transfers in progress
+        self.udp_transfers = collections.Counter()  # 'completed' / 'failed' / 'expired'
+        self.udp = collections.Counter()  # UDP_COUNTERS of finished transfers
+        self.errors = collections.Counter()  # (where, exception type) -> count
+
+    # The histogram of an operation, created on first use
+    def histogram(self, operation):
+        with self.lock:
+            histogram = self.latency.get(operation)
+            if histogram is None:
+                histogram = self.latency[operation] = Histogram()
+            return histogram
+
+    # Count a request of the given operation that started at started_ns
+    # (time.perf_counter_ns()) and finished at finished_ns (default: now)
+    def record(self, operation, started_ns, finished_ns=None):
+        elapsed = (finished_ns or time.perf_counter_ns()) - started_ns
+        histogram = self.latency.get(operation) or self.histogram(operation)
+        with self.lock:
+            histogram.observe(elapsed)
+
+    def count_bytes(self, transport, received=0, sent=0):
+        with self.lock:
+            self.bytes_received[transport] += received
+            self.bytes_sent[transport] += sent
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def udp_session_opened(self):
+        with self.lock:
+            self.udp_sessions += 1
+
+    # A UDP transfer ended with the given outcome; stats is its endpoint's
+    # stats()
+    def udp_session_closed(self, outcome, stats):
+        with self.lock:
+            self.udp_sessions -= 1
+            self.udp_transfers[outcome] += 1
+            for name in UDP_COUNTERS:
+                self.udp[name] += stats.get(name, 0)
+
+    # Count an exception caught at the given place (e.g. 'tcp', 'udp')
+    def record_error(self, where, error):
+        with self.lock:
+            self.errors[(where, type(error).__name__)] += 1
+
+    # The figures as nested dicts of plain values, for the STATS reply
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': {operation: histogram.count for operation, histogram in self.latency.items()},
+                'latency': {operation: histogram.snapshot() for operation, histogram in self.latency.items()},
+                'bytes': {f'{transport}_{direction}': count
+                          for direction, counts in (('received', self.bytes_received), ('sent', self.bytes_sent))
+                          for transport, count in counts.items()},
+                'connections': {'in_flight': self.connections, 'total': self.connections_total,
+                                'udp_sessions': self.udp_sessions},
+                'udp': {**{f'transfers_{outcome}': n for outcome, n in self.udp_transfers.items()},
+                        **{name: self.udp[name] for name in UDP_COUNTERS}},
+                'errors': {f'{where}:{name}': n for (where, name), n in self.errors.items()},
+            }
+
+    def uptime(self):
+        return time.monotonic() - self.started
+
+    # The figures in the Prometheus text exposition format. gauges maps a
+    # section name to a dict of further numeric values to export (cache
+    # statistics and the like).
+    def prometheus_text(self, gauges=None):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            name = PROMETHEUS_PREFIX + name
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape(str(label))}"' for key, label in labels)
+                lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else f'{name}{suffix} {value}')
+
+        with self.lock:
+            metric('requests_total', 'counter', 'Requests served by operation.',
+                   [('', [('op', op)], histogram.count) for op, histogram in sorted(self.latency.items())])
+            samples = []
+            for op, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += n
+                    samples.append(('_bucket', [('op', op), ('le', bound)], cumulative))
+                samples.append(('_sum', [('op', op)], histogram.sum_ns / 1e9))
+                samples.append(('_count', [('op', op)], histogram.count))
+            metric('request_duration_seconds', 'histogram', 'Time to serve a request by operation.', samples)
+            metric('bytes_received_total', 'counter', 'Bytes received from clients (TCP: on the wire, UDP: file bytes).',
+                   [('', [('transport', t)], n) for t, n in sorted(self.bytes_received.items())])
+            metric('bytes_sent_total', 'counter', 'Bytes sent to clients (TCP: on the wire, UDP: file bytes).',
+                   [('', [('transport', t)], n) for t, n in sorted(self.bytes_sent.items())])
+            metric('connections_in_flight', 'gauge', 'TCP connections being served.', [('', [], self.connections)])
+            metric('connections_total', 'counter', 'TCP connections accepted.', [('', [], self.connections_total)])
+            metric('udp_sessions_in_flight', 'gauge', 'UDP transfers in progress.', [('', [], self.udp_sessions)])
+            metric('udp_transfers_total', 'counter', 'Finished UDP transfers by outcome.',
+                   [('', [('outcome', outcome)], n) for outcome, n in sorted(self.udp_transfers.items())])
+            for name in UDP_COUNTERS:
+                metric(f'udp_{name}_total', 'counter', f'UDP {name.replace("_", " ")} of finished transfers.',
+                       [('', [], self.udp[name])])
+            metric('errors_total', 'counter', 'Exceptions caught while serving clients.',
+                   [('', [('where', where), ('type', name)], n) for (where, name), n in sorted(self.errors.items())])
+            metric('uptime_seconds', 'gauge', 'Seconds since the server started.',
+                   [('', [], round(self.uptime(), 3))])
+        for section, values in (gauges or {}).items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metric(f'{section}_{key}', 'gauge', f'{section} {key}.', [('', [], value)])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Opt-in sampling profiler: counts the stacks of every other thread each
+# interval seconds
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()  # "file:function;file:function;..." (outermost first) -> samples
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        labels = {}  # code object -> "file:function"
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            stacks = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = f'{os.path.basename(code.co_filename)}:{code.co_name}'
+                    stack.append(label)
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            frames = None  # Let the frames go before sleeping
+            with self.lock:
+                self.stacks.update(stacks)
+
+    # Stacks in the "collapsed" format flamegraph.pl and speedscope read
+    def collapsed(self):
+        with self.lock:
+            return ''.join(f'{stack} {n}\n' for stack, n in self.stacks.most_common())
+
+    # The n functions most often found running (innermost frame), with their
+    # share of all the stacks sampled
+    def top(self, n=PROFILE_TOP):
+        leaves = collections.Counter()
+        with self.lock:
+            for stack, count in self.stacks.items():
+                leaves[stack.rpartition(';')[2]] += count
+        total = sum(leaves.values())
+        return {label: f'{count} ({count / total:.1%})' for label, count in leaves.most_common(n)}
+
+
+# Serve /metrics (Prometheus text from metrics_text()) and, when a profiler
+# is given, /profile (its collapsed stacks) over HTTP on a daemon thread
+def start_http_exporter(host, port, metrics_text, profiler=None):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = metrics_text().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif self.path == '/profile' and profiler is not None:
+                body = profiler.collapsed().encode('utf-8')
+                content_type = 'text/plain; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes would flood the server's output
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True).start()
+    return server
@@ -0,0 +1,169 @@
+import struct
+from collections import namedtuple
+
+# Protocol v2 framing for the TCP control/data connection, shared by client.py
+# and server.py.
+#
+# A v1 request starts with one byte: a 3-bit opcode and a 5-bit filename
+# length. The byte 0xFF (opcode 7, length 31) is reserved as the start of the
+# v2 HELLO; a client sends HELLO right after connecting and the server answers
+# with the version it will speak. A v1 client never sends that byte, so it
+# keeps working unchanged.
+#
+# After the handshake every request and response is a frame: FRAME_HEADER,
+# then name_length bytes of UTF-8 filename, then payload_length bytes of
+# payload (file data, a new filename, summary text, ...). Responses carry a
+# status code in place of the opcode and echo the request ID.
+#
+# When FLAG_RANGE is set, RANGE follows the name: the file offset of the first
+# payload byte (or, for a GET request, of the first byte wanted) and a size.
+# For a GET request the size is the number of bytes wanted (0 = to the end of
+# the file); everywhere else it is the size of the whole file.
+#
+# The upper four bits of the flags name the codec of a compressed payload
+# (see compression.py); the payload length is then the uncompressed size. On
+# a GET request they name the codec the client would like the reply in.
+#
+# FLAG_CHECKSUM on an uncompressed payload means a trailer of chunk CRCs and
+# the whole-file hash follows it (see integrity.py); on a GET request it asks
+# for the reply in that form. A PUT that fails the check is answered with
+# STATUS_CORRUPT and the bad (offset, size) ranges as RANGE records; the
+# client resends just those with FLAG_PATCH and finishes with a COMMIT
+# carrying FLAG_PATCH and the file's hash.
+#
+# A deduplicating upload (see dedup.py) asks with OP_CHUNKS which of the
+# file's chunks the server holds, then sends OP_PUT_CHUNKS: the (hash, size)
+# entry of every chunk (dedup.pack_entries), a bitmap flagging the chunks
+# whose data follows, and that data. Chunks the server turns out to lack come back as
+# a bitmap with STATUS_MISSING, to be sent again the same way.
+
+HELLO_MAGIC = b'\xffTU'
+VERSION = 2
+FRAME_HEADER = struct.Struct('!BBHIQ')  # opcode/status, flags, name length, request ID, payload length
+RANGE = struct.Struct('!QQ')  # offset, size
+MAX_NAME_SIZE = 0xffff  # Bytes of a file name, the most the header's name length can tell
+MAX_CHUNK_QUERY = 64 * 1024  # Chunk hashes in one OP_CHUNKS request
+
+# Flags
+FLAG_RANGE = 0x01
+FLAG_STRIPE = 0x02  # PUT: one stripe of a striped upload, finished by OP_COMMIT
+FLAG_CHECKSUM = 0x04  # A checksum trailer follows the payload
+FLAG_PATCH = 0x08  # PUT: rewrite a range of an upload that failed its checksums
+CODEC_SHIFT = 4  # flags >> CODEC_SHIFT = codec ID
+
+# Opcodes
+OP_PUT = 0
+OP_GET = 1
+OP_CHANGE = 2  # name = old filename, payload = new filename
+OP_SUMMARY = 3
+OP_HELP = 4
+OP_STAT = 5  # Reply range: staged bytes of an interrupted upload, size of the stored file
+OP_COMMIT = 6  # Move a completed striped (or, with FLAG_PATCH, patched) upload into place
+OP_SIGNATURES = 8  # Block signatures of a stored file (see delta.py)
+OP_DELTA = 9  # Rebuild a stored file from a delta stream
+OP_STATS = 10  # Reply payload: server statistics as JSON text
+OP_CHUNKS = 11  # payload = chunk hashes; reply payload: bitmap of the chunks the server holds
+OP_PUT_CHUNKS = 12  # Upload a file as its list of chunks plus the ones the server lacks
+OP_CLOSE = 7
+OPCODE_NAMES = {value: name[3:] for name, value in list(globals().items()) if name.startswith('OP_')}
+
+# Status codes (same meaning as the v1 response codes in client.py)
+STATUS_OK = 0
+STATUS_FILE = 1  # payload is the requested file
+STATUS_NOT_FOUND = 2
+STATUS_UNKNOWN = 3
+STATUS_FAILED = 4
+STATUS_SUMMARY_FAILED = 5
+STATUS_HELP = 6  # payload is the help text
+STATUS_CORRUPT = 7  # payload: RANGE records of the data that failed its checksums
+STATUS_MISSING = 8  # payload: bitmap of the chunks of a PUT_CHUNKS the server still needs
+
+Frame = namedtuple('Frame', 'opcode flags request_id name payload_length offset size', defaults=(0, 0))
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Read exactly n bytes from a socket
+def recv_exact(sock, n):
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise RuntimeError("Socket connection broken")
+        received += count
+    return data
+
+
+# Client side of the version handshake; returns the version the server chose
+def client_hello(sock, version=VERSION):
+    sock.sendall(HELLO_MAGIC + bytes([version]))
+    reply = recv_exact(sock, len(HELLO_MAGIC) + 1)
+    if bytes(reply[:len(HELLO_MAGIC)]) != HELLO_MAGIC:
+        raise ProtocolError("Server does not support protocol v2")
+    return reply[-1]
+
+
+# Server side of the handshake, called once the 0xFF byte was read
+def server_hello(sock):
+    rest = recv_exact(sock, len(HELLO_MAGIC))  # Remaining magic + client version
+    if bytes(rest[:-1]) != HELLO_MAGIC[1:]:
+        raise ProtocolError("Bad HELLO")
+    version = min(rest[-1], VERSION)
+    sock.sendall(HELLO_MAGIC + bytes([version]))
+    return version
+
+
+# Encode a frame header, name and optional range; the payload is sent
+# separately
+def pack_frame(opcode, request_id, name='', payload_length=0, flags=0, offset=None, size=0):
+    name_bytes = name.encode('utf-8')
+    if len(name_bytes) > MAX_NAME_SIZE:
+        raise ProtocolError("Filename too long")
+    if offset is None:
+        return FRAME_HEADER.pack(opcode, flags, len(name_bytes), request_id, payload_length) + name_bytes
+    flags |= FLAG_RANGE
+    return (FRAME_HEADER.pack(opcode, flags, len(name_bytes), request_id, payload_length)
+            + name_bytes + RANGE.pack(offset, size))
+
+
+# Flags carrying a codec ID
+def codec_flags(codec_id):
+    return codec_id << CODEC_SHIFT
+
+
+def frame_codec(frame):
+    return frame.flags >> CODEC_SHIFT
+
+
+# Pack and unpack a list of (offset, size) ranges, e.g. for STATUS_CORRUPT
+def pack_ranges(ranges):
+    return b''.join(RANGE.pack(offset, size) for offset, size in ranges)
+
+
+def unpack_ranges(data):
+    return [RANGE.unpack_from(data, i) for i in range(0, len(data) - len(data) % RANGE.size, RANGE.size)]
+
+
+# Read a frame header and name; returns None on a clean end of stream. The
+# caller reads frame.payload_length payload bytes itself.
+def read_frame(sock):
+    header = bytearray(FRAME_HEADER.size)
+    view = memoryview(header)
+    received = 0
+    while received < FRAME_HEADER.size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            if received == 0:
+                return None
+            raise RuntimeError("Socket connection broken")
+        received += count
+    opcode, flags, name_length, request_id, payload_length = FRAME_HEADER.unpack_from(header)
+    name = recv_exact(sock, name_length).decode('utf-8') if name_length else ''
+    if flags & FLAG_RANGE:
+        offset, size = RANGE.unpack(recv_exact(sock, RANGE.size))
+        return Frame(opcode, flags, request_id, name, payload_length, offset, size)
+    return Frame(opcode, flags, request_id, name, payload_length)
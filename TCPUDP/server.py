@@ -1,8 +1,28 @@
 
+import concurrent.futures
+import fcntl
+import json
+import signal
 import socket
 import os
+import struct
 import sys
+import tempfile
 import threading
+import traceback
+import time
+
+import compression
+import dedup
+import delta
+import fec
+import file_cache
+import integrity
+import metrics
+import protocol
+import summary
+import udp_io
+import udp_transfer
 
 # Default values for IP, port, and debug flag
 IP = "127.0.0.1"
@@ -14,54 +34,342 @@ DEBUG = True
 UPLOAD_FOLDER_DESTINATION = "uploads"
 DOWNLOAD_FOLDER_DESTINATION = "downloads"
 BUFFER_SIZE = 1024
+TCP_BUFFER_SIZE = 256 * 1024  # Bytes per recv_into() on TCP transfers
 FILE_INFO_SIZE = 1  # Byte size for file info
 
+# UDP session table limits. Each session buffers at most one window of
+# datagrams; a session is only admitted while the windows of all live
+# sessions, at their negotiated payload sizes, fit the memory budget.
+UDP_SESSION_IDLE_TIMEOUT = udp_transfer.IDLE_TIMEOUT  # Seconds without traffic before a session is dropped
+UDP_SESSION_MEMORY_BUDGET = 64 * 1024 * 1024
+UDP_CONGESTION_CONTROL = udp_transfer.CONGESTION_CONTROL  # Algorithm used when sending files over UDP
+UDP_OFFLOAD = True  # Batch datagrams with UDP GSO/GRO where the kernel supports it
+UDP_STORE_THREADS = 2  # Threads storing finished UDP uploads, so the UDP thread keeps serving the rest
+udp_store_executor = concurrent.futures.ThreadPoolExecutor(UDP_STORE_THREADS, thread_name_prefix='udp-store')
+
+# Concurrency limits for the TCP server
+LISTEN_BACKLOG = 128  # Pending connections queued by the kernel
+MAX_CONNECTIONS = 64  # Client connections handled in parallel
+CONNECTION_IDLE_TIMEOUT = 300  # Seconds a persistent connection may sit idle
+
+# Multi-process mode (--workers N): N forked server processes share the TCP
+# and UDP ports through SO_REUSEPORT, and a supervisor process replaces any
+# that crash
+WORKERS = 1
+WORKER_RESTART_DELAY = 1  # Seconds to wait before replacing a worker that died right after starting
+WORKER_SHUTDOWN_TIMEOUT = 10  # Seconds workers get to exit after SIGTERM before being killed
+
 # Constants
 UPLOAD_FOLDER_DESTINATION = "uploads"
+STAGING_FOLDER = ".partial"  # Under UPLOAD_FOLDER_DESTINATION, holds unfinished uploads
+STRIPE_SUFFIX = ".stripes"  # Staging file of a striped upload
+RECEIVED_SUFFIX = ".received"  # Ranges of a striped upload its stripes have brought so far
+DELTA_SUFFIX = ".delta"  # Staging file of a file being rebuilt from a delta
+CORRUPT_SUFFIX = ".corrupt"  # Ranges of a staged upload that failed their checksums
+
+# SUMMARY results cache
+SUMMARY_CACHE_FILE = ".summary_cache.sqlite"  # Database under UPLOAD_FOLDER_DESTINATION, shared by all workers
+SUMMARY_ON_UPLOAD = True  # Compute summaries while PUT data streams in
+V1_SUMMARY_LENGTH = 0b11111  # Longest text a v1 SUMMARY reply can carry (5-bit length); v2 gets the full statistics
+summary_cache = None
+summary_cache_lock = threading.Lock()
+
+# Compressed-at-rest copies. A compressed upload's record stream is kept next
+# to the file and GETs asking for that codec are answered from it with
+# sendfile(), without compressing again; a compressed GET stores one the
+# same way. The plain file stays the primary copy for everything else.
+STORE_COMPRESSED = True
+COMPRESSED_FOLDER = ".compressed"  # Under UPLOAD_FOLDER_DESTINATION
+COMPRESSED_KEY = struct.Struct('!QQQ')  # size, mtime_ns, inode of the file the copy was made from
+
+# End-to-end integrity (see integrity.py)
+INTEGRITY_FOLDER = ".integrity"  # Under UPLOAD_FOLDER_DESTINATION, hash and chunk CRCs of stored files
+
+# Deduplicating storage (see dedup.py): a stored file is a manifest of
+# content-defined chunks, each distinct chunk kept once however many files
+# contain it. With DEDUP_STORAGE off uploads are stored whole; manifests
+# stored before stay readable either way.
+DEDUP_STORAGE = True
+CHUNK_FOLDER = ".chunks"  # Under UPLOAD_FOLDER_DESTINATION, the chunks and their index
+chunk_store = None
+chunk_store_lock = threading.Lock()
+
+# Hot-file cache: GET serves small files straight from memory
+FILE_CACHE_BUDGET = 64 * 1024 * 1024  # Bytes of file content kept in memory (0 disables the cache)
+FILE_CACHE_MAX_FILE_SIZE = 1024 * 1024  # Larger files are always streamed with sendfile()
+hot_files = None
+hot_files_lock = threading.Lock()
+
+# Instrumentation (see metrics.py)
+METRICS_HOST = "127.0.0.1"  # The metrics endpoint is only ever served on localhost
+METRICS_PORT = 0  # Port of the Prometheus text endpoint (0 = off); workers use METRICS_PORT + their slot
+PROFILE_INTERVAL = 0  # Seconds between sampling profiler samples (0 = off)
+V1_OPERATIONS = ('PUT', 'GET', 'CHANGE', 'SUMMARY', 'HELP')  # By v1 opcode
+server_metrics = metrics.Metrics()
+profiler = None
+
 FILE_INFO_SIZE = 1  # Byte size for file info
 
 #-------------------------- UDP ----------------------------------
-# Function to receive file via UDP
-def udp_receive_file(server_socket, filename, client_addr):
-    filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, filename)
-    with open(filepath, 'wb') as f:
-        while True:
-            bytes_read, _ = server_socket.recvfrom(BUFFER_SIZE)
-            if bytes_read == b'END':
-                break
-            f.write(bytes_read)
-            server_socket.sendto(b'ACK', client_addr)
-
-# Function to send file via UDP
-def udp_send_file(server_socket, filename, client_addr):
-    filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, filename)
-    if not os.path.isfile(filepath):
-        server_socket.sendto(b'File not found', client_addr)
-        return
+# State of one UDP transfer. The UDP server keeps these in a table keyed by
+# (client address, transfer ID) so concurrent transfers never see each
+# other's datagrams.
+class UdpSession:
+    def __init__(self, endpoint, f, filename, ready_packet):
+        self.endpoint = endpoint
+        self.f = f
+        self.filename = filename
+        self.ready_packet = ready_packet
+        self.started = time.perf_counter_ns()
+        self.finished = None  # When a received file was complete (the session lingers after)
+        self.outcome = None  # 'failed' or 'expired' once given up on
+        self.last_activity = time.monotonic()
+        self.linger_until = None
+        self.deadline = self.last_activity
+        self.memory = 0  # Bytes one window of its datagrams takes, set by udp_open_session()
 
-    with open(filepath, 'rb') as f:
-        while True:
-            bytes_read = f.read(BUFFER_SIZE)
-            if not bytes_read:
-                server_socket.sendto(b'END', client_addr)
-                break
-            server_socket.sendto(bytes_read, client_addr)
-            _, _ = server_socket.recvfrom(BUFFER_SIZE)  # Wait for ACK
+    def close(self):
+        if isinstance(self.endpoint, udp_transfer.WindowReceiver) and self.endpoint.storing is not None:
+            return  # The store thread closes the file when it is done with it
+        if not self.f.closed:
+            self.f.close()
+
+# Function to receive file via UDP (opens a session for a "put" command).
+# The data goes to the staging file, like a TCP upload, and replaces the
+# file only once complete; returns None if another upload holds the name.
+# Storing the complete file (chunking and hashing it with DEDUP_STORAGE)
+# runs on udp_store_executor; the FIN is acknowledged once it is done.
+def udp_receive_file(filename, transfer_id, fec_params=None, payload_size=udp_transfer.PAYLOAD_SIZE):
+    f = open_staging_file(staging_path(filename))
+    if f is None:
+        return None
+    f.truncate(0)
+
+    def store():
+        try:
+            checksum = receiver.checksum
+            st = store_upload(f, staging_path(filename), filename)  # Still holding the staging lock
+            integrity.store_metadata(integrity_path(filename), st, checksum.digest(), checksum.finish())
+        finally:
+            f.close()
 
+    def complete():
+        return udp_store_executor.submit(store)
 
-# Function for the UDP server thread
-def udp_server():
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_socket:
+    receiver = udp_transfer.WindowReceiver(f, transfer_id, udp_transfer.window_for(payload_size),
+                                           on_complete=complete, fec_params=fec_params)
+    ready = udp_transfer.encode_packet(udp_transfer.PACKET_READY, transfer_id)
+    return UdpSession(receiver, f, filename, ready)
+
+# Function to send file via UDP (opens a session for a "get" command)
+def udp_send_file(filename, transfer_id, fec_params=None, payload_size=udp_transfer.PAYLOAD_SIZE):
+    try:
+        f = open_stored(filename)
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+
+    sender = udp_transfer.WindowSender(f, transfer_id, udp_transfer.window_for(payload_size), payload_size,
+                                       congestion_control=UDP_CONGESTION_CONTROL, fec_params=fec_params)
+    ready = udp_transfer.encode_packet(udp_transfer.PACKET_READY, transfer_id)
+    return UdpSession(sender, f, filename, ready)
+
+# Function to run a session's timers; returns False once it should be dropped
+def udp_service_session(datagram_io, client_addr, session, now):
+    endpoint = session.endpoint
+    try:
+        datagram_io.send(endpoint.poll(now), client_addr)
+    except udp_transfer.TransferError as e:
+        if DEBUG:
+            print(f"[UDP] Transfer of {session.filename} with {client_addr} failed: {e}")
+        # Tell the peer instead of leaving it to time out
+        datagram_io.sendto(udp_transfer.encode_packet(udp_transfer.PACKET_ERROR, endpoint.transfer_id, 0,
+                                                      str(e).encode()), client_addr)
+        session.outcome = 'failed'
+        return False
+    # The client waits for our FIN_ACK while a finished upload is being stored
+    storing = isinstance(endpoint, udp_transfer.WindowReceiver) and endpoint.storing is not None
+    if now - session.last_activity > UDP_SESSION_IDLE_TIMEOUT and not storing:
+        if DEBUG:
+            print(f"[UDP] Session for {session.filename} with {client_addr} expired")
+        session.outcome = 'expired'
+        return False
+    if endpoint.done:
+        if isinstance(endpoint, udp_transfer.WindowSender):
+            session.close()
+            if DEBUG:
+                print(f"[UDP] Sent {session.filename} to {client_addr} ({endpoint.describe()})")
+            return False
+        if session.linger_until is None:
+            # Stay around briefly to re-acknowledge a retransmitted FIN
+            session.linger_until = now + udp_transfer.LINGER_TIME
+            session.finished = time.perf_counter_ns()
+            if DEBUG:
+                print(f"[UDP] Received {session.filename} from {client_addr} ({endpoint.describe()})")
+        if now >= session.linger_until:
+            return False
+        session.deadline = session.linger_until
+        return True
+    session.deadline = now + endpoint.next_timeout(now)
+    if not storing:
+        session.deadline = min(session.deadline, session.last_activity + UDP_SESSION_IDLE_TIMEOUT)
+    return True
+
+# Function to tell the bytes a session's window of payload_size datagrams can buffer
+def udp_session_memory(payload_size):
+    return udp_transfer.window_for(payload_size) * payload_size
+
+# Function to start a new session for a CMD datagram ("put <name>" or
+# "get <name>", optionally followed by "fec=K,M" and "payload=N")
+def udp_open_session(datagram_io, sessions, key, body):
+    client_addr, transfer_id = key
+    try:
+        command, filename, *options = bytes(body).decode().split()
+        fec_params = None
+        payload_size = udp_transfer.PAYLOAD_SIZE
+        for option in options:
+            name, _, value = option.partition('=')
+            if name == 'fec':
+                fec_params = fec.parse_option(value)
+            elif name == 'payload':
+                payload_size = int(value)
+                if not 0 < payload_size <= udp_transfer.MAX_PAYLOAD_SIZE:
+                    raise ValueError(f"Payload size {payload_size} out of range")
+    except (ValueError, fec.FecError):
+        reply = b'Malformed command'
+    else:
+        memory = udp_session_memory(payload_size)
+        if sum(session.memory for session in sessions.values()) + memory > UDP_SESSION_MEMORY_BUDGET:
+            reply = b'Server busy'
+        elif command == 'put':
+            session = udp_receive_file(filename, transfer_id, fec_params, payload_size)
+            if session is None:
+                reply = b'Upload already in progress'
+            else:
+                sessions[key] = session
+                reply = None
+        elif command == 'get':
+            session = udp_send_file(filename, transfer_id, fec_params, payload_size)
+            if session is None:
+                reply = b'File not found'
+            else:
+                sessions[key] = session
+                reply = None
+        else:
+            reply = b'Unknown command'
+    if reply is not None:
+        datagram_io.sendto(udp_transfer.encode_packet(udp_transfer.PACKET_ERROR, transfer_id, 0, reply), client_addr)
+        return None
+    sessions[key].memory = memory
+    server_metrics.udp_session_opened()
+    datagram_io.sendto(sessions[key].ready_packet, client_addr)
+    return sessions[key]
+
+# Function to drop a session that ended and account for its transfer
+def udp_close_session(sessions, key):
+    session = sessions.pop(key)
+    session.close()
+    endpoint = session.endpoint
+    outcome = session.outcome or ('completed' if endpoint.done else 'failed')
+    stats = endpoint.stats()
+    server_metrics.udp_session_closed(outcome, stats)
+    if outcome != 'completed':
+        return
+    if isinstance(endpoint, udp_transfer.WindowSender):
+        server_metrics.record('UDP_GET', session.started)
+        server_metrics.count_bytes('udp', sent=stats['bytes_sent'])
+    else:
+        server_metrics.record('UDP_PUT', session.started, session.finished)
+        server_metrics.count_bytes('udp', received=stats['bytes_received'])
+
+# Function to open the UDP server socket on IP and UDP_PORT (0 picks a free
+# port, which getsockname() tells)
+def open_udp_socket():
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        if WORKERS > 1:
+            # The kernel hashes each client address to one worker, so all
+            # datagrams of a transfer reach the process holding its session
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         udp_socket.bind((IP, UDP_PORT))
-        print(f"[*] UDP Server is listening on {IP}:{UDP_PORT}")
+    except BaseException:
+        udp_socket.close()
+        raise
+    return udp_socket
+
+# Function for the UDP server thread; serves the socket of open_udp_socket(),
+# opened here unless given
+def udp_server(udp_socket=None):
+    sessions = {}
+    with udp_socket or open_udp_socket() as udp_socket:
+        datagram_io = udp_io.DatagramIO(udp_socket, offload=UDP_OFFLOAD)
+        print(f"[*] UDP Server is listening on {IP}:{udp_socket.getsockname()[1]}")
 
+        next_wakeup = None
+        replies = {}  # client address -> answers held back until a received batch is read
+        datagram_timing = server_metrics.histogram('UDP_DATAGRAM')  # Only this thread writes it
         while True:
-            msg, client_addr = udp_socket.recvfrom(BUFFER_SIZE)
-            command, filename = msg.decode().split()
-            if command == 'put':
-                udp_receive_file(udp_socket, filename, client_addr)
-            elif command == 'get':
-                udp_send_file(udp_socket, filename, client_addr)
+            if replies and not datagram_io.pending:
+                for client_addr, datagrams in replies.items():
+                    datagram_io.send(udp_transfer.coalesce_acks(datagrams), client_addr)
+                replies = {}
+            timeout = None
+            if sessions:
+                timeout = max(next_wakeup - time.monotonic(), 0.001)
+            udp_socket.settimeout(timeout)
+            try:
+                msg, client_addr = datagram_io.recvfrom()
+            except socket.timeout:
+                msg = None
+            now = time.monotonic()
+
+            if msg is not None:
+                started = time.perf_counter_ns()
+                packet = udp_transfer.decode_packet(msg)
+                if packet is None:
+                    continue
+                kind, transfer_id, seq, body = packet
+                key = (client_addr, transfer_id)
+                session = sessions.get(key)
+                try:
+                    if kind == udp_transfer.PACKET_CMD:
+                        if session is None:
+                            session = udp_open_session(datagram_io, sessions, key, body)
+                        else:
+                            datagram_io.sendto(session.ready_packet, client_addr)  # Our READY was lost
+                    elif session is not None:
+                        session.last_activity = now
+                        replies.setdefault(client_addr, []).extend(session.endpoint.handle(kind, seq, body, now))
+                except Exception as e:
+                    server_metrics.record_error('udp', e)
+                    if DEBUG:
+                        print(f"[UDP] Error: {e}")
+                    if isinstance(e, udp_transfer.TransferError):
+                        # Tell the peer instead of leaving it to time out
+                        datagram_io.sendto(udp_transfer.encode_packet(udp_transfer.PACKET_ERROR, transfer_id, 0,
+                                                                      str(e).encode()), client_addr)
+                    if key in sessions:
+                        sessions[key].outcome = 'failed'
+                        udp_close_session(sessions, key)
+                    continue
+                datagram_timing.observe(time.perf_counter_ns() - started)
+                if session is None:
+                    continue  # Stray datagram from a transfer that already ended
+                if udp_service_session(datagram_io, client_addr, session, now):
+                    if next_wakeup is None or session.deadline < next_wakeup:
+                        next_wakeup = session.deadline
+                    if now < next_wakeup:
+                        continue
+                else:
+                    udp_close_session(sessions, key)
+
+            # A timer is due somewhere: run every session and find the next one
+            next_wakeup = None
+            for key, session in list(sessions.items()):
+                if udp_service_session(datagram_io, key[0], session, now):
+                    if next_wakeup is None or session.deadline < next_wakeup:
+                        next_wakeup = session.deadline
+                else:
+                    udp_close_session(sessions, key)
 
 
 
@@ -69,45 +377,604 @@ def udp_server():
 
 #-------------------------- UDP ----------------------------------
 
-# Function to handle the PUT command
-def put_file(client, filename, received_file_size):
+# Function to get the staging path that holds an upload until it completes
+def staging_path(filename):
+    return os.path.join(UPLOAD_FOLDER_DESTINATION, STAGING_FOLDER, filename)
+
+# Function to move a finished upload, the file f staged at staged_path, into
+# place under filename: cut into chunks behind a manifest with
+# DEDUP_STORAGE, else renamed as it is. Called with the staging lock held, if
+# any. Returns the stat identifying the stored version (see dedup.file_stat).
+def store_upload(f, staged_path, filename):
     filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, filename)
-    with open(filepath, "wb") as f:
-        bytes_recd = 0
-        while bytes_recd < received_file_size:
-            chunk = client.recv(min(received_file_size - bytes_recd, 2048))
-            if not chunk:
-                raise RuntimeError("Socket connection broken")
-            f.write(chunk)
-            bytes_recd += len(chunk)
-    return '000' + '00000'  # Successful PUT
+    if DEDUP_STORAGE:
+        st = get_chunk_store().store_file(f, filepath)
+        os.remove(staged_path)
+    else:
+        f.flush()
+        st = os.fstat(f.fileno())  # The file we wrote, whatever else lands at filepath later
+        get_chunk_store().rename(staged_path, filepath)  # Releases the chunks of a manifest it replaces
+    get_file_cache().invalidate(filename)
+    return st
 
-# Function to handle the GET command
-def get_file(client, filename):
+# Function to handle the PUT command. The bytes from offset up to
+# received_file_size are appended to the staging file, which is moved into
+# place once the upload is complete; an interrupted upload keeps what arrived
+# so the client can resume it from there.
+# With a codec the payload is a compressed record stream (see
+# compression.py) that is decompressed on the fly. When checksummed, a
+# trailer of chunk CRCs follows the payload (see integrity.py); chunks that
+# fail the check are reported back and the upload stays staged until the
+# client has patched them.
+# Returns the response code and the list of corrupted (offset, size) ranges.
+def put_file(client, filename, received_file_size, offset=0, codec=compression.CODEC_NONE, checksummed=False):
+    partial_path = staging_path(filename)
+    buffer = memoryview(bytearray(TCP_BUFFER_SIZE))  # Reused for every recv_into
+
+    def read_exact(n):
+        return protocol.recv_exact(client, n)
+
+    f = None
+    if (not offset or staged_size(filename) >= offset) and (not codec or codec in compression.codecs):
+        f = open_staging_file(partial_path)
+    if f is None:
+        # Nothing to resume from, an unknown codec, or another upload of the
+        # same name is in progress; drain the payload to keep the stream in sync
+        if codec:
+            compression.discard_compressed(read_exact)
+        else:
+            discard_bytes(client, received_file_size - offset, buffer)
+        if checksummed:
+            discard_bytes(client, integrity.trailer_size(received_file_size - offset), buffer)
+        return '100' + '00000', []  # Unsuccessful PUT
+    f.seek(offset)
+    f.truncate()
+    record_corrupt_ranges(filename, [])  # Any bad bytes lay at or after offset
+    # Summarize the data as it streams past so a SUMMARY right after the
+    # upload is answered from the cache (a resumed upload misses the earlier
+    # bytes and is summarized on demand instead). The chunk CRCs and hash are
+    # taken along the way too, to check the upload and to serve later GETs.
+    parser = summary.SummaryParser() if SUMMARY_ON_UPLOAD and not offset else None
+    checksum = integrity.StreamChecksum(whole_file=not offset)
+    compressed_copy = None
+    if codec:
+        if STORE_COMPRESSED and not offset:
+            compressed_copy = open_compressed_copy()
+        tee = compressed_copy.write if compressed_copy is not None else None
+        pieces = compression.receive_compressed(read_exact, codec, tee)
+    else:
+        pieces = receive_pieces(client, received_file_size - offset, buffer)
+    try:
+        with f:
+            bytes_recd = offset
+            for piece in pieces:
+                bytes_recd += len(piece)
+                if bytes_recd > received_file_size:
+                    raise protocol.ProtocolError("Compressed payload is larger than announced")
+                f.write(piece)
+                checksum.update(piece)
+                if parser is not None:
+                    parser.feed(piece)
+            if checksummed:
+                length = received_file_size - offset
+                crcs, digest = integrity.unpack_trailer(
+                    protocol.recv_exact(client, integrity.trailer_size(length)), length)
+            if bytes_recd != received_file_size:
+                return '100' + '00000', []  # Compressed payload ended early; what arrived stays staged
+            f.flush()
+            if checksummed:
+                bad_ranges = integrity.bad_ranges(offset, length, checksum.finish(), crcs)
+                if bad_ranges:
+                    record_corrupt_ranges(filename, bad_ranges)
+                    return '111' + '00000', bad_ranges  # Corrupted upload, kept staged for put_patch()
+                if digest is not None and not offset and digest != checksum.digest():
+                    f.truncate(0)
+                    return '100' + '00000', []  # The CRCs cannot tell where; start over
+            st = store_upload(f, partial_path, filename)  # Still holding the staging lock
+            if not offset:
+                integrity.store_metadata(integrity_path(filename), st, checksum.digest(), checksum.finish())
+            if compressed_copy is not None:
+                store_compressed_copy(compressed_copy, filename, codec, st)
+                compressed_copy = None
+    finally:
+        if compressed_copy is not None:
+            discard_compressed_copy(compressed_copy)
+    stats = parser.finish() if parser is not None else None
+    if stats is not None:
+        text = stats.format() if stats.count else None
+        get_summary_cache().store(filename, st, checksum.hexdigest(), text)
+    return '000' + '00000', []  # Successful PUT
+
+# Function to rewrite a range of an upload that failed its checksums. The
+# staging file put_file() kept is patched in place and the range checked
+# against its trailer again; commit_patched() then moves the file into place.
+# Returns the response code and the ranges that are still corrupted.
+def put_patch(client, filename, offset, count, file_size):
+    buffer = memoryview(bytearray(TCP_BUFFER_SIZE))
+    f = open_staging_file(staging_path(filename))
+    if f is not None and (os.fstat(f.fileno()).st_size != file_size or offset + count > file_size):
+        f.close()
+        f = None
+    if f is None:
+        discard_bytes(client, count + integrity.trailer_size(count), buffer)
+        return '100' + '00000', []  # No such staged upload, or it is in use
+    checksum = integrity.StreamChecksum(whole_file=False)
+    with f:
+        f.seek(offset)
+        for piece in receive_pieces(client, count, buffer):
+            f.write(piece)
+            checksum.update(piece)
+        crcs, _ = integrity.unpack_trailer(protocol.recv_exact(client, integrity.trailer_size(count)), count)
+        bad_ranges = integrity.bad_ranges(offset, count, checksum.finish(), crcs)
+        corrupt = integrity.subtract_range(corrupt_ranges(filename), offset, count)
+        record_corrupt_ranges(filename, sorted(corrupt + bad_ranges))
+    if bad_ranges:
+        return '111' + '00000', bad_ranges
+    return '000' + '00000', []  # Range patched
+
+# Function to finish a patched upload. Only here, after a corruption, is the
+# staging file read back to hash it; it is moved into place if the hash
+# matches the client's.
+def commit_patched(filename, file_size, digest):
+    f = open_staging_file(staging_path(filename))
+    if f is None:
+        return '100' + '00000'  # Another upload of the same name is in progress
+    with f:
+        if os.fstat(f.fileno()).st_size != file_size or corrupt_ranges(filename):
+            return '100' + '00000'  # Wrong size, or ranges still to be patched
+        checksum = integrity.checksum_file(f)
+        if checksum.digest() != digest:
+            f.truncate(0)
+            return '100' + '00000'  # Still corrupted somewhere; the client starts over
+        st = store_upload(f, staging_path(filename), filename)
+        integrity.store_metadata(integrity_path(filename), st, checksum.digest(), checksum.crcs)
+    return '000' + '00000'  # Successful COMMIT
+
+# Function to yield the next total_size bytes from the socket, in pieces
+# that are only valid until the next one is requested
+def receive_pieces(client, total_size, buffer):
+    while total_size > 0:
+        n = client.recv_into(buffer, min(total_size, len(buffer)))
+        if not n:
+            raise RuntimeError("Socket connection broken")
+        total_size -= n
+        yield buffer[:n]
+
+# Function to get the path of the compressed copy of a file (codec
+# CODEC_NONE marks a file known not to compress)
+def compressed_path(filename, codec):
+    name = compression.codecs[codec].name if codec else 'none'
+    return os.path.join(UPLOAD_FOLDER_DESTINATION, COMPRESSED_FOLDER, f"{filename}.{name}")
+
+# Function to start writing a compressed copy of a file; the key is filled
+# in by store_compressed_copy() once the file is complete
+def open_compressed_copy():
+    fd, temp_path = tempfile.mkstemp(dir=os.path.join(UPLOAD_FOLDER_DESTINATION, COMPRESSED_FOLDER))
+    os.close(fd)
+    f = open(temp_path, 'wb')  # Opened by path so f.name is the path
+    f.write(bytes(COMPRESSED_KEY.size))
+    return f
+
+# Function to move a finished compressed copy of the file described by st
+# (an os.stat result) into place
+def store_compressed_copy(f, filename, codec, st):
+    with f:
+        f.seek(0)
+        f.write(COMPRESSED_KEY.pack(st.st_size, st.st_mtime_ns, st.st_ino))
+    os.replace(f.name, compressed_path(filename, codec))
+
+def discard_compressed_copy(f):
+    f.close()
+    os.remove(f.name)
+
+# Function to open the compressed copy of a file if it was made from the
+# file described by st; returns it positioned after the key, or None
+def find_compressed_copy(filename, codec, st):
+    try:
+        f = open(compressed_path(filename, codec), 'rb')
+    except FileNotFoundError:
+        return None
+    if f.read(COMPRESSED_KEY.size) != COMPRESSED_KEY.pack(st.st_size, st.st_mtime_ns, st.st_ino):
+        f.close()
+        return None  # Left over from an older version of the file
+    return f
+
+# Function to get the path of the record holding a file's hash and chunk CRCs
+def integrity_path(filename):
+    return os.path.join(UPLOAD_FOLDER_DESTINATION, INTEGRITY_FOLDER, filename)
+
+# Function to get (hash, chunk CRCs) of the file described by st, given as
+# the open file f or its content data. They are recorded when the file is
+# uploaded; a file that arrived some other way is checksummed on first use.
+def file_checksums(filename, st, f=None, data=None):
+    path = integrity_path(filename)
+    checksums = integrity.load_metadata(path, st)
+    if checksums is None:
+        if data is not None:
+            checksum = integrity.StreamChecksum()
+            checksum.update(data)
+            checksum.finish()
+        else:
+            checksum = integrity.checksum_file(f)
+        checksums = checksum.digest(), checksum.crcs
+        integrity.store_metadata(path, st, *checksums)
+    return checksums
+
+# Function to build the checksum trailer for count bytes of a file from
+# offset. The recorded CRCs serve any range on chunk boundaries; other
+# ranges are checksummed as they are.
+def checksum_trailer(filename, st, offset, count, f=None, data=None):
+    digest, crcs = file_checksums(filename, st, f, data)
+    end = offset + count
+    if not offset % integrity.CHUNK_SIZE and (not end % integrity.CHUNK_SIZE or end == st.st_size):
+        first = offset // integrity.CHUNK_SIZE
+        crcs = crcs[first:first + integrity.chunk_count(count)]
+    elif data is not None:
+        checksum = integrity.StreamChecksum(whole_file=False)
+        checksum.update(data[offset:end])
+        crcs = checksum.finish()
+    else:
+        crcs = integrity.checksum_file(f, offset, count, whole_file=False).crcs
+    return integrity.pack_trailer(crcs, digest)
+
+# Function to answer a v2 GET in compressed form. Returns False, having sent
+# nothing, when the data does not compress well and should go out as it is.
+# Raises FileNotFoundError.
+def get_compressed(client_socket, frame, codec):
+    with open_stored(frame.name) as f:
+        st = dedup.file_stat(f)
+        offset = min(frame.offset, st.st_size)
+        count = st.st_size - offset
+        if frame.size:
+            count = min(count, frame.size)
+        if count < compression.MIN_COMPRESS_SIZE:
+            return False
+        whole_file = STORE_COMPRESSED and count == st.st_size
+        if frame.flags & protocol.FLAG_RANGE:
+            header = protocol.pack_frame(protocol.STATUS_FILE, frame.request_id, frame.name, count,
+                                         flags=protocol.codec_flags(codec), offset=offset, size=st.st_size)
+        else:
+            header = protocol.pack_frame(protocol.STATUS_FILE, frame.request_id, frame.name, count,
+                                         flags=protocol.codec_flags(codec))
+        if whole_file:
+            stored = find_compressed_copy(frame.name, codec, st)
+            if stored is not None:
+                with stored:
+                    size = os.fstat(stored.fileno()).st_size - COMPRESSED_KEY.size
+                    client_socket.sendall(header)
+                    client_socket.sendfile(stored, COMPRESSED_KEY.size, size)
+                return True
+            marker = find_compressed_copy(frame.name, compression.CODEC_NONE, st)
+            if marker is not None:
+                marker.close()
+                return False
+        if compression.choose_codec(f, offset, count, codec) == compression.CODEC_NONE:
+            if whole_file:
+                store_compressed_copy(open_compressed_copy(),
+                                      frame.name, compression.CODEC_NONE, st)
+            return False
+        client_socket.sendall(header)
+        copy = open_compressed_copy() if whole_file else None
+
+        def send(record):
+            client_socket.sendall(record)
+            if copy is not None:
+                copy.write(record)
+
+        try:
+            compression.send_compressed(f, count, codec, send)
+        except BaseException:
+            if copy is not None:
+                discard_compressed_copy(copy)
+            raise
+        if copy is not None:
+            store_compressed_copy(copy, frame.name, codec, st)
+    return True
+
+# Function to open a staging file for writing, locked (flock) against a
+# concurrent upload of the same name from any thread or server process.
+# Returns None while another upload holds the lock. With lock=fcntl.LOCK_SH
+# the uploads sharing one file (the stripes of a striped upload) hold it
+# together, and only keep out an exclusive holder.
+def open_staging_file(path, lock=fcntl.LOCK_EX):
+    while True:
+        f = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        try:
+            fcntl.flock(f, lock | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()  # The upload that held the lock moved the file away; start over
+
+# Buffer payloads we drop are read into; shared by all threads, as nothing
+# ever reads what lands in it
+discard_buffer = memoryview(bytearray(TCP_BUFFER_SIZE))
+
+# Function to read and drop n bytes of a payload we cannot use
+def discard_bytes(client, n, buffer):
+    while n > 0:
+        count = client.recv_into(buffer, min(n, len(buffer)))
+        if not count:
+            raise RuntimeError("Socket connection broken")
+        n -= count
+
+# Function to report how many bytes of an interrupted upload are staged
+def staged_size(filename):
+    partial_path = staging_path(filename)
+    if not os.path.exists(partial_path):
+        return 0
+    corrupt = corrupt_ranges(filename)
+    if corrupt:
+        return min(offset for offset, _ in corrupt)  # Only the bytes before the first bad one count
+    return os.path.getsize(partial_path)
+
+# Function to get the ranges of a staged upload that failed their checksums
+def corrupt_ranges(filename):
+    try:
+        with open(staging_path(filename) + CORRUPT_SUFFIX, 'rb') as f:
+            return protocol.unpack_ranges(f.read())
+    except FileNotFoundError:
+        return []
+
+# Function to record the corrupted ranges of a staged upload (none once it
+# is whole again); called with the staging lock held
+def record_corrupt_ranges(filename, ranges):
+    path = staging_path(filename) + CORRUPT_SUFFIX
+    if not ranges:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    with open(path, 'wb') as f:
+        f.write(protocol.pack_ranges(ranges))
+
+# Function to add the count bytes at offset to the ranges a striped upload
+# of file_size bytes has received, and return them. A staging file of another
+# size is resized for this upload, which starts with nothing received.
+# Stripes on other connections and workers update the ranges too, so they
+# are read and written under a lock of their own.
+def record_stripe(filename, file_size, f, offset=0, count=0):
+    path = staging_path(filename) + STRIPE_SUFFIX + RECEIVED_SUFFIX
+    with open(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as received:
+        fcntl.flock(received, fcntl.LOCK_EX)
+        ranges = []
+        if os.fstat(f.fileno()).st_size != file_size:
+            f.truncate(file_size)
+        else:
+            ranges = protocol.unpack_ranges(received.read())
+        merged = []
+        for start, size in sorted(ranges + [(offset, count)]):
+            if merged and start <= sum(merged[-1]):
+                merged[-1] = (merged[-1][0], max(sum(merged[-1]), start + size) - merged[-1][0])
+            elif size:
+                merged.append((start, size))
+        received.seek(0)
+        received.truncate()
+        received.write(protocol.pack_ranges(merged))
+    return merged
+
+# Function to receive one stripe of a striped upload. Stripes arrive on
+# parallel connections in any order, so each one is written with pwrite()
+# into a staging file sized for the whole upload, under a shared lock that
+# keeps commit_stripes() out meanwhile; commit_stripes() moves it into place
+# once the stripes have brought every byte.
+def put_stripe(client, filename, offset, count, file_size):
+    f = open_staging_file(staging_path(filename) + STRIPE_SUFFIX, fcntl.LOCK_SH)
+    if f is None:
+        discard_bytes(client, count, discard_buffer)
+        return '100' + '00000'  # The upload is being committed
+    with f:
+        record_stripe(filename, file_size, f)
+        fd = f.fileno()
+        buffer = memoryview(bytearray(TCP_BUFFER_SIZE))
+        position = offset
+        end = offset + count
+        try:
+            while position < end:
+                n = client.recv_into(buffer, min(end - position, TCP_BUFFER_SIZE))
+                if not n:
+                    raise RuntimeError("Socket connection broken")
+                written = 0
+                while written < n:
+                    written += os.pwrite(fd, buffer[written:n], position + written)
+                position += n
+        finally:
+            record_stripe(filename, file_size, f, offset, position - offset)  # What did arrive counts
+    return '000' + '00000'  # Stripe stored
+
+# Function to finish a striped upload once all stripes are stored
+def commit_stripes(filename, file_size):
+    stripe_path = staging_path(filename) + STRIPE_SUFFIX
+    if not os.path.exists(stripe_path):
+        return '010' + '00000'  # Nothing staged under that name
+    f = open_staging_file(stripe_path)
+    if f is None:
+        return '100' + '00000'  # Stripes are still being received
+    with f:
+        if os.fstat(f.fileno()).st_size != file_size:
+            return '100' + '00000'  # Staged upload has the wrong size
+        if record_stripe(filename, file_size, f) != [(0, file_size)] and file_size:
+            return '100' + '00000'  # Some stripe never arrived
+        store_upload(f, stripe_path, filename)
+        os.remove(stripe_path + RECEIVED_SUFFIX)
+    return '000' + '00000'  # Successful COMMIT
+
+# Function to handle the SIGNATURES command: block signatures of a stored
+# file, for a client preparing a delta upload
+def send_signatures(client, request_id, filename, block_size):
+    try:
+        f = open_stored(filename)
+    except (FileNotFoundError, IsADirectoryError):
+        send_response(client, request_id, protocol.STATUS_NOT_FOUND)
+        return
+    with f:
+        file_size = dedup.file_stat(f).st_size
+        if not block_size:
+            block_size = delta.choose_block_size(file_size)
+        signatures = delta.compute_signatures(f, block_size)
+    client.sendall(protocol.pack_frame(protocol.STATUS_OK, request_id, payload_length=len(signatures),
+                                       offset=block_size, size=file_size) + signatures)
+
+# Function to handle the DELTA command: rebuild a stored file from its old
+# copy and the client's delta stream, then swap it in atomically
+def put_delta(client, filename, block_size, payload_length):
     filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, filename)
     if not os.path.exists(filepath):
+        discard_bytes(client, payload_length, discard_buffer)
+        return '010' + '00000'  # No old copy to patch
+    consumed = 0
+
+    def read_exact(n):
+        nonlocal consumed
+        consumed += n
+        if consumed > payload_length:
+            raise protocol.ProtocolError("Delta stream overruns its frame")
+        return protocol.recv_exact(client, n)
+
+    rebuilt_path = staging_path(filename) + DELTA_SUFFIX
+    out = open_staging_file(rebuilt_path)
+    if out is None:
+        discard_bytes(client, payload_length, discard_buffer)
+        return '100' + '00000'  # The same file is already being patched
+    with out:
+        out.truncate()
+        try:
+            with open_stored(filename) as basis:
+                delta.apply_delta(read_exact, basis, out, block_size)
+        except delta.DeltaError as e:
+            if DEBUG:
+                print(f"Delta for {filename} rejected: {e}")
+            os.remove(rebuilt_path)
+            discard_bytes(client, payload_length - consumed, discard_buffer)
+            return '100' + '00000'  # Unsuccessful DELTA
+        store_upload(out, rebuilt_path, filename)
+    return '000' + '00000'  # Successful DELTA
+
+# Function to handle the PUT_CHUNKS command: a file sent as the list of its
+# chunks plus the data of those the client found the server lacks (see
+# OP_CHUNKS). Each chunk received is checked against its hash before it is
+# stored. Returns the status and, for STATUS_MISSING, which chunks the server
+# still needs: those that failed the check or were deleted since the client
+# asked.
+def put_chunks(client, filename, payload_length):
+    count, = dedup.ENTRY_COUNT.unpack(protocol.recv_exact(client, dedup.ENTRY_COUNT.size))
+    listing_size = count * dedup.CHUNK_ENTRY.size
+    if dedup.ENTRY_COUNT.size + listing_size + -(-count // 8) > payload_length:
+        raise protocol.ProtocolError("Chunk list overruns its frame")
+    listing = protocol.recv_exact(client, listing_size + -(-count // 8))
+    entries = dedup.unpack_entries(listing, count)
+    sent = dedup.unpack_bitmap(listing[listing_size:], count)
+    data_size = sum(size for (_, size), flag in zip(entries, sent) if flag)
+    if (dedup.ENTRY_COUNT.size + len(listing) + data_size != payload_length
+            or any(size > dedup.MAX_CHUNK_SIZE for _, size in entries)):
+        raise protocol.ProtocolError("Chunk list does not match its frame")
+    store = get_chunk_store()
+    needed = [False] * count
+    for i, ((digest, size), flag) in enumerate(zip(entries, sent)):
+        if flag:
+            data = protocol.recv_exact(client, size)
+            if dedup.chunk_digest(data) == digest:
+                store.write_chunk(digest, data)
+            else:
+                needed[i] = True
+    if not any(needed):
+        missing, _ = store.commit(os.path.join(UPLOAD_FOLDER_DESTINATION, filename), entries)
+        for i in missing:
+            needed[i] = True
+    if any(needed):
+        return protocol.STATUS_MISSING, needed
+    get_file_cache().invalidate(filename)
+    return protocol.STATUS_OK, []
+
+# Function to get the store holding the chunks of deduplicated files
+def get_chunk_store():
+    global chunk_store
+    with chunk_store_lock:
+        if chunk_store is None:
+            chunk_store = dedup.ChunkStore(os.path.join(UPLOAD_FOLDER_DESTINATION, CHUNK_FOLDER))
+    return chunk_store
+
+# Function to open a stored file for reading, whether it is kept whole or as
+# a manifest of chunks (see dedup.open_stored). Raises FileNotFoundError.
+def open_stored(filename):
+    return dedup.open_stored(os.path.join(UPLOAD_FOLDER_DESTINATION, filename), get_chunk_store())
+
+# Function to get the hot-file cache used by GET
+def get_file_cache():
+    global hot_files
+    with hot_files_lock:
+        if hot_files is None:
+            hot_files = file_cache.FileCache(FILE_CACHE_BUDGET, FILE_CACHE_MAX_FILE_SIZE)
+    return hot_files
+
+# Function to open a file for GET. Returns (file_size, data, f): the content
+# of a small file comes back as data (from the hot-file cache when possible)
+# with f None; larger files come back open as f, to be streamed with
+# sendfile(), with data None. Raises FileNotFoundError.
+def open_for_get(filename):
+    filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, filename)
+    cache = get_file_cache()
+    if FILE_CACHE_BUDGET:
+        data = cache.get(filename, dedup.stat_stored(filepath))
+        if data is not None:
+            return len(data), data, None
+    f = open_stored(filename)
+    st = dedup.file_stat(f)
+    if not FILE_CACHE_BUDGET or st.st_size > FILE_CACHE_MAX_FILE_SIZE:
+        cache.bypass()
+        return st.st_size, None, f
+    with f:
+        data = f.read()
+    cache.add(filename, data, st)
+    return len(data), data, None
+
+# Function to handle the GET command
+def get_file(client, filename):
+    try:
+        file_size, data, f = open_for_get(filename)
+    except (FileNotFoundError, IsADirectoryError):
         return '010' + '00000'  # File not found
-    file_size = os.path.getsize(filepath)
     filename_length = len(filename)
     response = '001' + f'{filename_length:05b}'
-    client.send(bytes([int(response, 2)]))
-    client.send(filename.encode('utf-8'))
-    client.send(file_size.to_bytes(4, 'big'))
-    with open(filepath, 'rb') as f:
-        while True:
-            chunk = f.read(2048)
-            if not chunk:
-                break
-            client.send(chunk)
+    header = bytes([int(response, 2)]) + filename.encode('utf-8') + file_size.to_bytes(4, 'big')
+    if data is not None:
+        client.sendall(header + data)
+    else:
+        with f:
+            client.sendall(header)
+            # sendfile() lets the kernel copy page cache straight to the socket
+            dedup.send_file(client, f, 0, file_size)
     return '001' + '00000'  # Successful GET
 
 # Function to handle the CHANGE command
 def change_name(client, old_filename, new_filename):
     old_filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, old_filename)
     new_filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, new_filename)
-    if not os.path.exists(old_filepath):
+    try:
+        # No separate existence check: os.rename() is atomic, so a CHANGE
+        # racing with another worker's CHANGE or PUT cannot half-succeed. A
+        # manifest is renamed like any file; its chunks stay where they are.
+        get_chunk_store().rename(old_filepath, new_filepath)
+    except FileNotFoundError:
         return '010' + '00000'  # File not found
-    os.rename(old_filepath, new_filepath)
+    for codec in [compression.CODEC_NONE, *compression.codecs]:
+        try:
+            # Compressed copies stay valid: a rename keeps the inode and mtime
+            os.rename(compressed_path(old_filename, codec), compressed_path(new_filename, codec))
+        except FileNotFoundError:
+            pass
+    try:
+        os.rename(integrity_path(old_filename), integrity_path(new_filename))  # Keyed by inode and mtime too
+    except FileNotFoundError:
+        pass
+    get_file_cache().invalidate(old_filename, new_filename)
+    get_summary_cache().rename(old_filename, new_filename)
     return '000' + '00000'  # Successful CHANGE
 
 # Function to handle the HELP command
@@ -115,18 +982,71 @@ def help_command():
     commands = "Available commands: PUT, GET, CHANGE, SUMMARY, HELP"
     return '110' + f'{len(commands):05b}', commands
 
-# Function to handle the SUMMARY command
+# Function to collect the statistics of the server's caches
+def cache_stats():
+    summaries = get_summary_cache()
+    return {
+        'file_cache': get_file_cache().stats(),
+        'summary_cache': {'hits': summaries.hits, 'misses': summaries.misses, 'entries': len(summaries)},
+        'chunk_store': get_chunk_store().stats(),
+    }
+
+# Function to collect server statistics for the STATS command
+def server_stats():
+    stats = {
+        'worker': os.getpid(),  # Caches and counters are per server process
+        'uptime_s': round(server_metrics.uptime(), 3),
+        **server_metrics.snapshot(),
+        **cache_stats(),
+    }
+    if profiler is not None:
+        stats['profile'] = profiler.top()
+    return stats
+
+# Function to render the metrics endpoint's page
+def metrics_text():
+    return server_metrics.prometheus_text(cache_stats())
+
+# Function to get the summary cache, opening its database on first use
+def get_summary_cache():
+    global summary_cache
+    with summary_cache_lock:
+        if summary_cache is None:
+            store_path = os.path.join(UPLOAD_FOLDER_DESTINATION, SUMMARY_CACHE_FILE)
+            summary_cache = summary.SummaryCache(store_path)
+    return summary_cache
+
+# Function to compute the summary text of an uploaded file. Cached results
+# are reused while the file is unchanged or, by the hash recorded when it was
+# uploaded, holds the same content; otherwise the file is summarized in one
+# streaming pass with constant memory (see summary.py).
+def summarize_file(filename):
+    filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, filename)
+    cache = get_summary_cache()
+    st = dedup.stat_stored(filepath)
+    checksums = integrity.load_metadata(integrity_path(filename), st)
+    hit, text = cache.lookup(filename, st, checksums[0].hex() if checksums is not None else None)
+    if not hit:
+        hasher = summary.content_hasher()
+        with open_stored(filename) as f:
+            st = dedup.file_stat(f)
+            stats = summary.summarize_file(f, hasher=hasher)
+        text = stats.format() if stats.count else None
+        cache.store(filename, st, hasher.hexdigest(), text)
+    if text is None:
+        raise ValueError("File contains no numbers")
+    return text
+
+# Function to handle the SUMMARY command of protocol v1, whose reply only has
+# room for the Max/Min/Avg line
 def handle_summary(client, filename):
     filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, filename)
     if not os.path.exists(filepath):
         return '011' + '00000'  # File not found
     try:
-        with open(filepath, 'r') as f:
-            numbers = [float(line.strip()) for line in f if line.strip()]
-        maximum = max(numbers)
-        minimum = min(numbers)
-        average = sum(numbers) / len(numbers)
-        summary_data = f"Max: {maximum}, Min: {minimum}, Avg: {average}\n"
+        summary_data = summary.v1_text(summarize_file(filename), V1_SUMMARY_LENGTH)
+        if summary_data is None:
+            raise ValueError("Summary does not fit in a v1 reply")
         summary_length = len(summary_data)
         response = '010' + f'{summary_length:05b}'
         client.send(bytes([int(response, 2)]))
@@ -137,56 +1057,441 @@ def handle_summary(client, filename):
         return '011' + '00000'  # Error during summary operation
     return '010' + '00000'  # Successful SUMMARY
 
-# Main server function
-def start_server():
-    os.makedirs(UPLOAD_FOLDER_DESTINATION, exist_ok=True)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+# Function to serve one request; returns False once the client is done
+def handle_request(client_socket):
+    received_info = client_socket.recv(FILE_INFO_SIZE)
+    if not received_info:
+        return False  # Client closed the connection
+    byte_info = int.from_bytes(received_info, 'big')
+    opcode = byte_info >> 5
+    started = time.perf_counter_ns()
+    response = ""
+    if opcode == 0:  # PUT
+        filename_size = byte_info & 0b11111
+        filename = protocol.recv_exact(client_socket, filename_size).decode('utf-8')
+        file_size = int.from_bytes(protocol.recv_exact(client_socket, 4), 'big')
+        response, _ = put_file(client_socket, filename, file_size)
+    elif opcode == 1:  # GET
+        filename_size = byte_info & 0b11111
+        filename = protocol.recv_exact(client_socket, filename_size).decode('utf-8')
+        response = get_file(client_socket, filename)
+    elif opcode == 2:  # CHANGE
+        old_filename_size = byte_info & 0b11111
+        old_filename = protocol.recv_exact(client_socket, old_filename_size).decode('utf-8')
+        new_filename_size = int.from_bytes(protocol.recv_exact(client_socket, 1), 'big')
+        new_filename = protocol.recv_exact(client_socket, new_filename_size).decode('utf-8')
+        response = change_name(client_socket, old_filename, new_filename)
+    elif opcode == 3:  # SUMMARY
+        filename_size = byte_info & 0b11111
+        filename = protocol.recv_exact(client_socket, filename_size).decode('utf-8')
+        response = handle_summary(client_socket, filename)
+    elif opcode == 4:  # HELP
+        response, help_text = help_command()
+        client_socket.sendall(bytes([int(response, 2)]) + help_text.encode('utf-8'))
+        server_metrics.record('HELP', started)
+        return True
+    elif opcode == 7 and byte_info & 0b11111 == 0b11111:  # Protocol v2 HELLO
+        protocol.server_hello(client_socket)
+        while handle_frame(client_socket):
+            pass
+        return False
+    elif opcode == 7:  # CLOSE
+        return False
+    else:
+        response = '011' + '00000'  # Unknown request
+    client_socket.sendall(bytes([int(response, 2)]))
+    server_metrics.record(V1_OPERATIONS[opcode] if opcode < len(V1_OPERATIONS) else 'UNKNOWN', started)
+    return True
+
+# Function to send a v2 response frame with an in-memory payload
+def send_response(client_socket, request_id, status, payload=b''):
+    client_socket.sendall(protocol.pack_frame(status, request_id, payload_length=len(payload)) + payload)
+
+# Function to serve one protocol v2 frame; returns False once the client is done
+def handle_frame(client_socket):
+    frame = protocol.read_frame(client_socket)
+    if frame is None or frame.opcode == protocol.OP_CLOSE:
+        return False
+    started = time.perf_counter_ns()
+    serve_frame(client_socket, frame)
+    server_metrics.record(protocol.OPCODE_NAMES.get(frame.opcode, 'UNKNOWN'), started)
+    return True
+
+# Function to answer the request of a v2 frame whose header has been read
+def serve_frame(client_socket, frame):
+    request_id = frame.request_id
+    filename = frame.name
+    if frame.opcode == protocol.OP_PUT and frame.flags & protocol.FLAG_PATCH:
+        response, bad_ranges = put_patch(client_socket, filename, frame.offset, frame.payload_length, frame.size)
+        send_response(client_socket, request_id, int(response, 2) >> 5, protocol.pack_ranges(bad_ranges))
+    elif frame.opcode == protocol.OP_PUT and frame.flags & protocol.FLAG_STRIPE:
+        if frame.offset + frame.payload_length > frame.size:
+            discard_bytes(client_socket, frame.payload_length, discard_buffer)
+            response = '100' + '00000'  # Stripe lies outside the file
+        else:
+            response = put_stripe(client_socket, filename, frame.offset, frame.payload_length, frame.size)
+        send_response(client_socket, request_id, int(response, 2) >> 5)
+    elif frame.opcode == protocol.OP_COMMIT and frame.flags & protocol.FLAG_PATCH:
+        if frame.payload_length != integrity.DIGEST_SIZE:
+            raise protocol.ProtocolError("COMMIT payload is not a digest")
+        digest = bytes(protocol.recv_exact(client_socket, frame.payload_length))
+        send_response(client_socket, request_id, int(commit_patched(filename, frame.size, digest), 2) >> 5)
+    elif frame.opcode == protocol.OP_COMMIT:
+        send_response(client_socket, request_id, int(commit_stripes(filename, frame.size), 2) >> 5)
+    elif frame.opcode == protocol.OP_PUT:
+        codec = protocol.frame_codec(frame)
+        checksummed = bool(frame.flags & protocol.FLAG_CHECKSUM)
+        if frame.flags & protocol.FLAG_RANGE:
+            offset, file_size = frame.offset, frame.size
+        else:
+            offset, file_size = 0, frame.payload_length
+        if offset + frame.payload_length != file_size:
+            if codec:
+                compression.discard_compressed(lambda n: protocol.recv_exact(client_socket, n))
+            else:
+                discard_bytes(client_socket, frame.payload_length, discard_buffer)
+            if checksummed:
+                protocol.recv_exact(client_socket, integrity.trailer_size(frame.payload_length))
+            response, bad_ranges = '100' + '00000', []  # Payload does not end the file
+        else:
+            response, bad_ranges = put_file(client_socket, filename, file_size, offset, codec, checksummed)
+        send_response(client_socket, request_id, int(response, 2) >> 5, protocol.pack_ranges(bad_ranges))
+    elif frame.opcode == protocol.OP_GET:
+        codec = protocol.frame_codec(frame)
+        try:
+            if codec in compression.codecs and get_compressed(client_socket, frame, codec):
+                return
+            file_size, data, f = open_for_get(filename)
+        except (FileNotFoundError, IsADirectoryError):
+            send_response(client_socket, request_id, protocol.STATUS_NOT_FOUND)
+            return
+        offset = min(frame.offset, file_size)
+        count = file_size - offset
+        if frame.size:
+            count = min(count, frame.size)
+        flags = frame.flags & protocol.FLAG_CHECKSUM
+        if frame.flags & protocol.FLAG_RANGE:
+            header = protocol.pack_frame(protocol.STATUS_FILE, request_id, filename, count, flags,
+                                         offset=offset, size=file_size)
+        else:
+            header = protocol.pack_frame(protocol.STATUS_FILE, request_id, filename, count, flags)
+        if data is not None:
+            trailer = b''
+            if flags:
+                st = dedup.stat_stored(os.path.join(UPLOAD_FOLDER_DESTINATION, filename))
+                trailer = checksum_trailer(filename, st, offset, count, data=data)
+            client_socket.sendall(header + data[offset:offset + count] + trailer)
+        else:
+            with f:
+                trailer = checksum_trailer(filename, dedup.file_stat(f), offset, count, f) if flags else b''
+                client_socket.sendall(header)
+                dedup.send_file(client_socket, f, offset, count)
+                client_socket.sendall(trailer)
+    elif frame.opcode == protocol.OP_STAT:
+        # offset = bytes of an interrupted upload, size = size of the stored file
+        filepath = os.path.join(UPLOAD_FOLDER_DESTINATION, filename)
+        if os.path.exists(filepath):
+            status, file_size = protocol.STATUS_OK, dedup.stat_stored(filepath).st_size
+        else:
+            status, file_size = protocol.STATUS_NOT_FOUND, 0
+        header = protocol.pack_frame(status, request_id, offset=staged_size(filename), size=file_size)
+        client_socket.sendall(header)
+    elif frame.opcode == protocol.OP_SIGNATURES:
+        send_signatures(client_socket, request_id, filename, frame.size)
+    elif frame.opcode == protocol.OP_DELTA:
+        response = put_delta(client_socket, filename, frame.offset, frame.payload_length)
+        send_response(client_socket, request_id, int(response, 2) >> 5)
+    elif frame.opcode == protocol.OP_CHUNKS:
+        if frame.payload_length > protocol.MAX_CHUNK_QUERY * dedup.DIGEST_SIZE:
+            raise protocol.ProtocolError("Too many chunk hashes in one request")
+        if not DEDUP_STORAGE or frame.payload_length % dedup.DIGEST_SIZE:
+            discard_bytes(client_socket, frame.payload_length, discard_buffer)
+            send_response(client_socket, request_id, protocol.STATUS_UNKNOWN if not DEDUP_STORAGE
+                          else protocol.STATUS_FAILED)
+            return
+        digests = bytes(protocol.recv_exact(client_socket, frame.payload_length))
+        digests = [digests[i:i + dedup.DIGEST_SIZE] for i in range(0, len(digests), dedup.DIGEST_SIZE)]
+        send_response(client_socket, request_id, protocol.STATUS_OK,
+                      dedup.pack_bitmap(get_chunk_store().contains(digests)))
+    elif frame.opcode == protocol.OP_PUT_CHUNKS:
+        if not DEDUP_STORAGE:
+            discard_bytes(client_socket, frame.payload_length, discard_buffer)
+            send_response(client_socket, request_id, protocol.STATUS_UNKNOWN)
+            return
+        status, needed = put_chunks(client_socket, filename, frame.payload_length)
+        send_response(client_socket, request_id, status, dedup.pack_bitmap(needed) if needed else b'')
+    elif frame.opcode == protocol.OP_CHANGE:
+        if frame.payload_length > protocol.MAX_NAME_SIZE:
+            raise protocol.ProtocolError("New filename too long")
+        new_filename = protocol.recv_exact(client_socket, frame.payload_length).decode('utf-8')
+        response = change_name(client_socket, filename, new_filename)
+        send_response(client_socket, request_id, int(response, 2) >> 5)
+    elif frame.opcode == protocol.OP_SUMMARY:
+        try:
+            summary_data = summarize_file(filename)
+        except FileNotFoundError:
+            send_response(client_socket, request_id, protocol.STATUS_NOT_FOUND)
+        except Exception as e:
+            if DEBUG:
+                print(f"Error while summarizing file: {e}")
+            send_response(client_socket, request_id, protocol.STATUS_SUMMARY_FAILED)
+        else:
+            send_response(client_socket, request_id, protocol.STATUS_OK, summary_data.encode('utf-8'))
+    elif frame.opcode == protocol.OP_STATS:
+        send_response(client_socket, request_id, protocol.STATUS_OK, json.dumps(server_stats()).encode('utf-8'))
+    elif frame.opcode == protocol.OP_HELP:
+        _, help_text = help_command()
+        send_response(client_socket, request_id, protocol.STATUS_HELP, help_text.encode('utf-8'))
+    else:
+        discard_bytes(client_socket, frame.payload_length, discard_buffer)  # Skip the payload
+        send_response(client_socket, request_id, protocol.STATUS_UNKNOWN)
+
+# A client socket that adds the bytes sent and received through it to the
+# byte metrics as they pass, so failed, cut-short and compressed transfers
+# count what actually went over the wire
+class CountingSocket:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def recv(self, bufsize, *flags):
+        data = self.sock.recv(bufsize, *flags)
+        server_metrics.count_bytes('tcp', received=len(data))
+        return data
+
+    def recv_into(self, buffer, nbytes=0, *flags):
+        n = self.sock.recv_into(buffer, nbytes, *flags)
+        server_metrics.count_bytes('tcp', received=n)
+        return n
+
+    def send(self, data, *flags):
+        n = self.sock.send(data, *flags)
+        server_metrics.count_bytes('tcp', sent=n)
+        return n
+
+    def sendall(self, data, *flags):
+        self.sock.sendall(data, *flags)
+        server_metrics.count_bytes('tcp', sent=len(data))
+
+    def sendfile(self, file, offset=0, count=None):
+        n = self.sock.sendfile(file, offset, count)
+        server_metrics.count_bytes('tcp', sent=n)
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+# Function to handle a client connection (runs on a worker thread). The
+# connection stays open for any number of requests until the client sends
+# CLOSE or disconnects; responses go out in request order, so clients may
+# pipeline requests without waiting for each reply.
+def handle_client(client_socket, address):
+    if DEBUG:
+        print(f"[+] Connection established with {address}")
+    client_socket.settimeout(CONNECTION_IDLE_TIMEOUT)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Replies go out as written
+    server_metrics.connection_opened()
+    client_socket = CountingSocket(client_socket)
+    try:
+        while handle_request(client_socket):
+            pass
+    except Exception as e:
+        server_metrics.record_error('tcp', e)
+        if DEBUG:
+            print(f"Error: {e}")
+            if not isinstance(e, OSError):
+                traceback.print_exc()  # Not just the client going away
+    finally:
+        server_metrics.connection_closed()
+        client_socket.close()
+
+# Function to open the listening TCP socket on IP and TCP_PORT (0 picks a
+# free port, which getsockname() tells)
+def open_listener():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if WORKERS > 1:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Kernel spreads connections over workers
         s.bind((IP, TCP_PORT))  # Use TCP_PORT here instead of PORT
-        s.listen(2)
+        s.listen(LISTEN_BACKLOG)
+    except BaseException:
+        s.close()
+        raise
+    return s
+
+# Main server function; serves the socket of open_listener(), opened here
+# unless given
+def start_server(listener=None):
+    os.makedirs(os.path.join(UPLOAD_FOLDER_DESTINATION, STAGING_FOLDER), exist_ok=True)
+    os.makedirs(os.path.join(UPLOAD_FOLDER_DESTINATION, COMPRESSED_FOLDER), exist_ok=True)
+    os.makedirs(os.path.join(UPLOAD_FOLDER_DESTINATION, INTEGRITY_FOLDER), exist_ok=True)
+    os.makedirs(os.path.join(UPLOAD_FOLDER_DESTINATION, CHUNK_FOLDER), exist_ok=True)
+    with listener or open_listener() as s:
         if DEBUG:
             print(f"[*] Server is listening on {IP}:{TCP_PORT}")  # Use TCP_PORT here
+        connection_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+        def serve_client(client_socket, address):
+            try:
+                handle_client(client_socket, address)
+            finally:
+                connection_slots.release()
+
         while True:
-            client_socket, address = s.accept()
+            # Block here (leaving further clients in the listen backlog) once
+            # MAX_CONNECTIONS handlers are already running.
+            connection_slots.acquire()
+            try:
+                client_socket, address = s.accept()
+            except BaseException:
+                connection_slots.release()
+                raise
+            worker = threading.Thread(target=serve_client, args=(client_socket, address), daemon=True)
+            worker.start()
+
+# Function to create the folders under UPLOAD_FOLDER_DESTINATION and rebuild
+# the chunk index from the stored manifests, in case a server died halfway
+# through storing a file; runs once, before any worker serves requests
+def prepare_storage():
+    for folder in (STAGING_FOLDER, COMPRESSED_FOLDER, INTEGRITY_FOLDER, CHUNK_FOLDER):
+        os.makedirs(os.path.join(UPLOAD_FOLDER_DESTINATION, folder), exist_ok=True)
+    store = dedup.ChunkStore(os.path.join(UPLOAD_FOLDER_DESTINATION, CHUNK_FOLDER))
+    try:
+        with os.scandir(UPLOAD_FOLDER_DESTINATION) as entries:
+            chunks = store.recount([entry.path for entry in entries if entry.is_file()])
+    finally:
+        store.close()
+    if DEBUG:
+        print(f"[*] Chunk store holds {chunks} chunks")
+
+# Function to start the optional metrics endpoint and sampling profiler of
+# this server process; slot numbers the worker in --workers mode
+def start_instrumentation(slot=0):
+    global server_metrics, profiler
+    server_metrics = metrics.Metrics()  # A forked worker starts counting afresh
+    if PROFILE_INTERVAL:
+        profiler = metrics.SamplingProfiler(PROFILE_INTERVAL)
+        profiler.start()
+    if METRICS_PORT:
+        port = METRICS_PORT + slot
+        metrics.start_http_exporter(METRICS_HOST, port, metrics_text, profiler)
+        print(f"[*] Metrics are served on http://{METRICS_HOST}:{port}/metrics")
+
+# Function to run one server: the UDP server thread plus the TCP accept loop
+def run_server(slot=0):
+    start_instrumentation(slot)
+    threading.Thread(target=udp_server, daemon=True).start()
+    start_server()
+
+# Function to fork a worker process for the given slot; returns its pid
+def spawn_worker(slot):
+    pid = os.fork()
+    if pid:
+        return pid
+    exit_code = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the supervisor, which stops us
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        run_server(slot)
+    except SystemExit:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(exit_code)
+
+# Function to run the supervisor of --workers mode: start the workers,
+# replace any that exit, and stop them all on SIGINT/SIGTERM. Workers keep
+# no state that others depend on: files are replaced atomically, uploads are
+# serialized by flock on their staging files, and the caches validate every
+# entry against the file on disk.
+def run_supervisor(worker_count):
+    prepare_storage()
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    workers = {}  # pid -> (start time, slot)
+    try:
+        for slot in range(worker_count):
+            workers[spawn_worker(slot)] = (time.monotonic(), slot)
+        if DEBUG:
+            print(f"[*] Supervisor started {worker_count} workers: {', '.join(map(str, workers))}")
+        while True:
+            pid, status = os.wait()
+            entry = workers.pop(pid, None)
+            if entry is None:
+                continue
+            started, slot = entry
             if DEBUG:
-                print(f"[+] Connection established with {address}")
+                print(f"[!] Worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, restarting it")
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)  # Do not spin on a worker that cannot start
+            workers[spawn_worker(slot)] = (time.monotonic(), slot)  # Same slot, same metrics port
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        stop_workers(workers)
+
+# Function to stop worker processes: SIGTERM, then SIGKILL for any still
+# running after WORKER_SHUTDOWN_TIMEOUT
+def stop_workers(workers):
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    remaining = set(workers)
+    while remaining:
+        for pid in list(remaining):
             try:
-                received_info = client_socket.recv(FILE_INFO_SIZE)
-                byte_info = int.from_bytes(received_info, 'big')
-                opcode = byte_info >> 5
-                response = ""
-                if opcode == 0:  # PUT
-                    filename_size = byte_info & 0b11111
-                    filename = client_socket.recv(filename_size).decode('utf-8')
-                    file_size = int.from_bytes(client_socket.recv(4), 'big')
-                    response = put_file(client_socket, filename, file_size)
-                elif opcode == 1:  # GET
-                    filename_size = byte_info & 0b11111
-                    filename = client_socket.recv(filename_size).decode('utf-8')
-                    response = get_file(client_socket, filename)
-                elif opcode == 2:  # CHANGE
-                    old_filename_size = byte_info & 0b11111
-                    old_filename = client_socket.recv(old_filename_size).decode('utf-8')
-                    new_filename_size = int.from_bytes(client_socket.recv(1), 'big')
-                    new_filename = client_socket.recv(new_filename_size).decode('utf-8')
-                    response = change_name(client_socket, old_filename, new_filename)
-                elif opcode == 3:  # SUMMARY
-                    filename_size = byte_info & 0b11111
-                    filename = client_socket.recv(filename_size).decode('utf-8')
-                    response = handle_summary(client_socket, filename)
-                elif opcode == 4:  # HELP
-                    response, help_text = help_command()
-                    client_socket.send(bytes([int(response, 2)]))
-                    client_socket.send(help_text.encode('utf-8'))
-                    continue
-                client_socket.send(bytes([int(response, 2)]))
-            except Exception as e:
-                if DEBUG:
-                    print(f"Error: {e}")
-            finally:
-                client_socket.close()
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                remaining.discard(pid)
+        if remaining and time.monotonic() > deadline:
+            for pid in remaining:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            deadline = float('inf')
+        elif remaining:
+            time.sleep(0.05)
+    if DEBUG:
+        print("[*] All workers stopped")
+
+# Function to remove "--name value" from a list of arguments; returns the
+# value, or default when the option is absent
+def take_option(args, name, default):
+    if name not in args:
+        return default
+    index = args.index(name)
+    value = args[index + 1]
+    del args[index:index + 2]
+    return value
 
 if __name__ == "__main__":
-    if len(sys.argv) > 2:
-        TCP_PORT = int(sys.argv[1])  # This sets TCP_PORT based on command-line argument
-        DEBUG = bool(int(sys.argv[2]))
-    start_server()
\ No newline at end of file
+    args = sys.argv[1:]
+    WORKERS = int(take_option(args, '--workers', WORKERS))
+    UDP_PORT = int(take_option(args, '--udp-port', UDP_PORT))
+    METRICS_PORT = int(take_option(args, '--metrics-port', METRICS_PORT))
+    PROFILE_INTERVAL = float(take_option(args, '--profile', PROFILE_INTERVAL))
+    if len(args) > 1:
+        TCP_PORT = int(args[0])  # This sets TCP_PORT based on command-line argument
+        DEBUG = bool(int(args[1]))
+    if len(args) > 2:
+        MAX_CONNECTIONS = int(args[2])
+    if len(args) > 3:
+        LISTEN_BACKLOG = int(args[3])
+    if WORKERS > 1:
+        run_supervisor(WORKERS)
+    else:
+        prepare_storage()
+        run_server()
\ No newline at end of file
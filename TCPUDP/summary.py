@@ -0,0 +1,300 @@
+import hashlib
+import math
+import mmap
+import sqlite3
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:  # Pure-Python parsing is used instead
+    np = None
+
+# Streaming statistics for the SUMMARY command.
+#
+# A file is parsed in BLOCK_SIZE pieces cut at line boundaries (through mmap,
+# so nothing but the current block is resident). Each block is parsed in one
+# go -- by NumPy when it is installed, otherwise with map(float, ...) -- and
+# reduced to count/min/max/mean/M2, which are merged into the running totals
+# with Chan's parallel variance formula. Memory stays constant whatever the
+# file size, and lines that are not numbers are counted and reported instead
+# of failing the whole request.
+
+BLOCK_SIZE = 8 * 1024 * 1024
+MAX_REPORTED_LINES = 10  # Malformed line numbers listed in the summary
+GIVE_UP_MALFORMED = 1000  # Upload-time parsing stops after this many bad lines
+CACHE_ENTRIES = 1024  # Summaries kept by SummaryCache
+
+
+# Running count/min/max/mean/variance over a stream of numbers
+class SummaryStats:
+    def __init__(self):
+        self.count = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared differences from the mean
+        self.lines = 0
+        self.malformed = 0
+        self.malformed_lines = []
+
+    # Fold in a block already reduced to (count, min, max, mean, M2)
+    def merge(self, count, minimum, maximum, mean, m2):
+        if not count:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.minimum = min(self.minimum, minimum)
+        self.maximum = max(self.maximum, maximum)
+
+    def add_values(self, values):
+        if np is not None and isinstance(values, np.ndarray):
+            if values.size:
+                mean = float(values.mean())
+                self.merge(values.size, float(values.min()), float(values.max()), mean,
+                           float(((values - mean) ** 2).sum()))
+            return
+        if values:
+            mean = math.fsum(values) / len(values)
+            m2 = math.fsum([(x - mean) * (x - mean) for x in values])
+            self.merge(len(values), min(values), max(values), mean, m2)
+
+    # Parse a block of complete lines (without its final newline)
+    def add_lines(self, block):
+        lines = block.split(b'\n')
+        first_line = self.lines + 1
+        self.lines += len(lines)
+        try:
+            if np is not None:
+                values = np.array(lines).astype(np.float64)
+            else:
+                values = list(map(float, lines))
+        except ValueError:
+            values = self._parse_slowly(lines, first_line)
+        self.add_values(values)
+
+    # Per-line fallback for blocks with blank or malformed lines
+    def _parse_slowly(self, lines, first_line):
+        values = []
+        for number, line in enumerate(lines, first_line):
+            if not line.strip():
+                continue
+            try:
+                values.append(float(line))
+            except ValueError:
+                self.malformed += 1
+                if len(self.malformed_lines) < MAX_REPORTED_LINES:
+                    self.malformed_lines.append(number)
+        return values
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+    def format(self):
+        if not self.count:
+            raise ValueError("File contains no numbers")
+        text = (f"Max: {self.maximum}, Min: {self.minimum}, Avg: {self.mean}, "
+                f"Std: {self.stddev}, Count: {self.count}")
+        if self.malformed:
+            shown = ", ".join(str(n) for n in self.malformed_lines)
+            more = ", ..." if self.malformed > len(self.malformed_lines) else ""
+            text += f", Malformed lines: {self.malformed} ({shown}{more})"
+        return text + "\n"
+
+
+# Incremental parser for data that arrives in arbitrary chunks (e.g. from a
+# socket); keeps the unfinished last line until the next chunk completes it.
+# It gives up (abandoned = True) on data that is clearly not a list of
+# numbers, so binary uploads do not pay for line-by-line parsing.
+class SummaryParser:
+    def __init__(self):
+        self.stats = SummaryStats()
+        self.tail = b''
+        self.abandoned = False
+
+    def feed(self, chunk):
+        if self.abandoned:
+            return
+        data = self.tail + bytes(chunk) if self.tail else bytes(chunk)
+        cut = data.rfind(b'\n')
+        if cut < 0:
+            self.tail = data
+            if len(data) > BLOCK_SIZE:
+                self.abandoned = True  # No line breaks at all
+            return
+        self.tail = data[cut + 1:]
+        if b'\0' in data:
+            self.abandoned = True
+            return
+        self.stats.add_lines(data[:cut])
+        if self.stats.malformed > GIVE_UP_MALFORMED:
+            self.abandoned = True
+
+    def finish(self):
+        if self.tail and not self.abandoned:
+            self.stats.add_lines(self.tail)
+            self.tail = b''
+        return None if self.abandoned else self.stats
+
+
+# Summarize a file on disk in one pass with constant memory. When a hashlib
+# object is given, it is fed every byte of the file along the way.
+def summarize_path(path, block_size=BLOCK_SIZE, hasher=None):
+    with open(path, 'rb') as f:
+        return summarize_file(f, block_size, hasher)
+
+
+# Summarize an open binary file like summarize_path(). A file object without
+# a descriptor to map (such as a dedup.ChunkedFile) is read block by block.
+def summarize_file(f, block_size=BLOCK_SIZE, hasher=None):
+    if not hasattr(f, 'fileno'):
+        return _summarize_stream(f, block_size, hasher)
+    stats = SummaryStats()
+    size = f.seek(0, 2)
+    if size:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[size - 1] == ord('\n'):
+                size -= 1  # The final newline does not start another line
+            position = 0
+            while position < size:
+                end = min(position + block_size, size)
+                if end < size:
+                    cut = data.rfind(b'\n', position, end)
+                    if cut < 0:  # A single line longer than a block
+                        cut = data.find(b'\n', end)
+                    end = size if cut < 0 else cut
+                block = data[position:end]
+                if hasher is not None:
+                    hasher.update(block)
+                    hasher.update(data[end:end + 1])  # The newline we cut at
+                stats.add_lines(block)
+                position = end + 1
+    return stats
+
+
+def _summarize_stream(f, block_size, hasher):
+    stats = SummaryStats()
+    f.seek(0)
+    tail = b''  # Start of a line the last block cut through
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        if hasher is not None:
+            hasher.update(data)
+        data = tail + data
+        cut = data.rfind(b'\n')
+        if cut < 0:  # A single line longer than a block
+            tail = data
+            continue
+        stats.add_lines(data[:cut])
+        tail = data[cut + 1:]
+    if tail:
+        stats.add_lines(tail)
+    return stats
+
+
+# Shorten the text of SummaryStats.format() to the Max/Min/Avg line of the
+# original protocol v1 reply, at most limit bytes long: the numbers keep
+# their full precision when that fits and lose digits until it does. Returns
+# None if even one significant digit is too long.
+def v1_text(text, limit):
+    values = [float(field.split(': ', 1)[1]) for field in text.split(', ', 3)[:3]]
+    candidates = [f"Max: {values[0]}, Min: {values[1]}, Avg: {values[2]}\n"]
+    candidates += [f"Max: {values[0]:.{digits}g}, Min: {values[1]:.{digits}g}, Avg: {values[2]:.{digits}g}\n"
+                   for digits in range(6, 0, -1)]
+    for candidate in candidates:
+        if len(candidate.encode('utf-8')) <= limit:
+            return candidate
+    return None
+
+
+# Hash used to identify file contents in SummaryCache (the same one
+# integrity.py keeps for every stored file)
+def content_hasher():
+    return hashlib.sha256()
+
+
+# LRU cache of SUMMARY replies, kept in an SQLite database so that each
+# store or rename touches one row and every server process shares the same
+# entries. Entries are keyed by filename and only used while the file's size,
+# mtime and inode still match those recorded with the entry, so any later
+# write or rename -- including one made by another server process --
+# invalidates them without the cache having to be told. The content hash is
+# kept with each entry too: a file rewritten with the same content (its new
+# hash known from the upload) still hits, and the entry takes its new stat.
+class SummaryCache:
+    def __init__(self, store_path, capacity=CACHE_ENTRIES):
+        self.store_path = store_path
+        self.capacity = capacity
+        self.local = threading.local()  # SQLite connections cannot be shared between threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.store_path, timeout=60, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')  # A lost entry is only recomputed
+            db.execute('CREATE TABLE IF NOT EXISTS summaries (name TEXT PRIMARY KEY, size INTEGER, '
+                       'mtime_ns INTEGER, inode INTEGER, hash TEXT, text TEXT, used INTEGER)')
+            db.execute('CREATE INDEX IF NOT EXISTS summaries_used ON summaries (used)')
+            self.local.db = db
+        return db
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    def __len__(self):
+        return self._db().execute('SELECT count(*) FROM summaries').fetchone()[0]
+
+    # Return (hit, text) for filename; text is None when the summary failed.
+    # st is a fresh stat of the file (an os.stat result or dedup.StoredStat)
+    # and content_hash the hex content_hasher() digest of the file, if known.
+    def lookup(self, filename, st, content_hash=None):
+        db = self._db()
+        row = db.execute('SELECT size, mtime_ns, inode, hash, text FROM summaries WHERE name = ?',
+                         (filename,)).fetchone()
+        hit = row is not None and (row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino)
+                                   or (content_hash is not None and row[3] == content_hash))
+        if hit:
+            db.execute('UPDATE summaries SET size = ?, mtime_ns = ?, inode = ?, used = ? WHERE name = ?',
+                       (st.st_size, st.st_mtime_ns, st.st_ino, time.time_ns(), filename))
+        with self.lock:
+            if not hit:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        return True, row[4]
+
+    # Record the summary of filepath as it was when st (an os.stat result)
+    # was taken, dropping the least recently used entries beyond capacity
+    def store(self, filename, st, content_hash, text):
+        db = self._db()
+        db.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (filename, st.st_size, st.st_mtime_ns, st.st_ino, content_hash, text, time.time_ns()))
+        db.execute('DELETE FROM summaries WHERE name IN '
+                   '(SELECT name FROM summaries ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.capacity,))
+
+    def rename(self, old_filename, new_filename):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM summaries WHERE name = ?', (new_filename,))
+            db.execute('UPDATE summaries SET name = ? WHERE name = ?', (new_filename, old_filename))
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def invalidate(self, filename):
+        self._db().execute('DELETE FROM summaries WHERE name = ?', (filename,))
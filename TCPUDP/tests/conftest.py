@@ -0,0 +1,55 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client
+import protocol
+import server
+
+server.DEBUG = False
+client.VERBOSE = False
+
+
+# Run every test in a scratch directory, where the server keeps its uploads
+# folder and the client its downloads folder
+@pytest.fixture(autouse=True, scope='session')
+def workdir(tmp_path_factory):
+    path = tmp_path_factory.mktemp('work')
+    previous = os.getcwd()
+    os.chdir(path)
+    server.prepare_storage()
+    yield path
+    os.chdir(previous)
+
+
+# Start an in-process TCP server on a free port; returns its address. The
+# accept loop runs on a daemon thread for the rest of the session.
+@pytest.fixture
+def start_server(monkeypatch):
+    def start(max_connections=server.MAX_CONNECTIONS):
+        monkeypatch.setattr(server, 'TCP_PORT', 0)
+        monkeypatch.setattr(server, 'MAX_CONNECTIONS', max_connections)
+        listener = server.open_listener()
+        addr = listener.getsockname()
+        threading.Thread(target=server.start_server, args=(listener,), daemon=True).start()
+        with client.ServerConnection(addr) as conn:  # Served, so start_server() has read MAX_CONNECTIONS
+            conn.help()
+            assert conn.result()[1] == protocol.STATUS_HELP
+        return addr
+    return start
+
+
+
+# Start an in-process UDP server on a free port; returns its address
+@pytest.fixture
+def start_udp_server(monkeypatch):
+    def start():
+        monkeypatch.setattr(server, 'UDP_PORT', 0)
+        udp_socket = server.open_udp_socket()
+        threading.Thread(target=server.udp_server, args=(udp_socket,), daemon=True).start()
+        return udp_socket.getsockname()
+    return start
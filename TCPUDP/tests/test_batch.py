@@ -0,0 +1,70 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import batch
+import server
+
+MANIFEST = """# comment
+
+put a.bin
+PUT b.bin b2.bin udp
+get b2.bin out
+change a.bin c.bin
+summary c.bin
+"""
+
+
+def test_parse_manifest():
+    operations = batch.parse_manifest(MANIFEST)
+    assert [(op.line, op.command, op.args, op.transport) for op in operations] == [
+        (3, 'put', ['a.bin'], 'tcp'), (4, 'put', ['b.bin', 'b2.bin'], 'udp'), (5, 'get', ['b2.bin', 'out'], 'tcp'),
+        (6, 'change', ['a.bin', 'c.bin'], 'tcp'), (7, 'summary', ['c.bin'], 'tcp')]
+    for text in ['delete a.bin', 'get a.bin out dedup', 'change a.bin', 'summary a b']:
+        with pytest.raises(batch.ManifestError):
+            batch.parse_manifest(text)
+
+
+def run_batch(tmp_path, name, manifest, addr, udp_addr):
+    script = os.path.join(os.path.dirname(os.path.abspath(batch.__file__)), 'batch.py')
+    path = tmp_path / f'{name}.txt'
+    path.write_text(manifest)
+    report = tmp_path / f'{name}.json'
+    run = subprocess.run([sys.executable, script, str(path), '--host', addr[0], '--port', str(addr[1]),
+                          '--udp-port', str(udp_addr[1]), '--concurrency', '3', '--json', str(report)],
+                         cwd=tmp_path, stdout=subprocess.DEVNULL)
+    return run.returncode, json.loads(report.read_text())
+
+
+# Uploads over each transport, then downloads, a rename and a summary; a
+# missing file fails its line and the exit status without stopping the rest
+def test_manifest_runs(start_server, start_udp_server, tmp_path):
+    addr = start_server()
+    udp_addr = start_udp_server()
+    files = {}
+    for transport in batch.TRANSPORTS:
+        files[transport] = tmp_path / f'batch_{transport}.txt'
+        files[transport].write_text(''.join(f'{i}\n' for i in range(20000)))
+    uploads = ''.join(f'put {path} batch_{transport}.bin {transport}\n' for transport, path in files.items())
+    code, report = run_batch(tmp_path, 'uploads', uploads, addr, udp_addr)
+    assert code == 0 and report['failed'] == 0
+    assert report['commands']['put']['ok'] == 3
+    assert report['bytes'] == sum(path.stat().st_size for path in files.values())
+
+    downloads = ''
+    for transport in batch.TRANSPORTS:
+        over = 'udp' if transport == 'udp' else 'tcp'  # Deduplication only applies to uploads
+        downloads += f'get batch_{transport}.bin {tmp_path / f"copy_{transport}"} {over}\n'
+    downloads += 'change batch_dedup.bin batch_renamed.bin\nsummary batch_tcp.bin\nget batch_missing.bin\n'
+    code, report = run_batch(tmp_path, 'downloads', downloads, addr, udp_addr)
+    assert code == 1
+    assert report['operations'] == 6 and report['failed'] == 1
+    assert [failure['line'] for failure in report['failures']] == [6]
+    assert {command: figures['ok'] for command, figures in report['commands'].items()} == {
+        'get': 3, 'change': 1, 'summary': 1}
+    for transport, path in files.items():
+        assert (tmp_path / f'copy_{transport}').read_bytes() == path.read_bytes()
+    assert os.path.exists(os.path.join(server.UPLOAD_FOLDER_DESTINATION, 'batch_renamed.bin'))
@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+
+import benchmark
+
+
+def cell(op, mb_per_s, p99_ms, errors=0):
+    return {'transport': 'tcp', 'op': op, 'size': 1024, 'buffer': 65536, 'concurrency': 1,
+            'bytes': 1024, 'mb_per_s': mb_per_s, 'ops_per_s': 0, 'p99_ms': p99_ms, 'errors': errors}
+
+
+def test_sizes_parse_and_format():
+    assert [benchmark.parse_size(text) for text in ['512', '64K', '1M', '1.5M', '4GB']] == [
+        512, 64 * 1024, 1024 ** 2, 3 * 1024 ** 2 // 2, 4 * 1024 ** 3]
+    assert [benchmark.format_size(size) for size in [512, 64 * 1024, 1024 ** 3, 1536]] == ['512', '64K', '1G', '1536']
+
+
+# A cell regresses when it got slower than the tolerance allows, its p99
+# latency rose too much or it saw more errors
+def test_compare_flags_regressions():
+    baseline = {'results': [cell('put', 100, 10), cell('get', 100, 10), cell('change', 100, 10),
+                            cell('summary', 100, 10)]}
+    results = [cell('put', 95, 10), cell('get', 80, 10), cell('change', 100, 20), cell('summary', 100, 10, errors=1),
+               cell('striped-put', 1, 1)]
+    rows, regressions = benchmark.compare(results, baseline, 0.10, 0.25)
+    assert [(row['op'], row['regression']) for row in rows] == [
+        ('put', False), ('get', True), ('change', True), ('summary', True)]
+    assert regressions == 3
+
+
+# A small run measures every transport, operation, size and concurrency
+# combination without errors, and exits 1 against a much faster baseline
+def test_benchmark_run_and_comparison(tmp_path):
+    script = os.path.join(os.path.dirname(os.path.abspath(benchmark.__file__)), 'benchmark.py')
+    options = ['--sizes', '1K,64K', '--concurrency', '1,2', '--repeat', '2']
+    output = tmp_path / 'run.json'
+    subprocess.run([sys.executable, script, *options, '--output', str(output)], check=True, cwd=tmp_path,
+                   stderr=subprocess.DEVNULL)
+    results = json.loads(output.read_text())['results']
+    expected = {('tcp', op, size, concurrency)
+                for op in benchmark.TCP_OPS for size in [1024, 64 * 1024] for concurrency in [1, 2]
+                if op not in benchmark.SIZE_INDEPENDENT_OPS or size == 1024}
+    expected |= {('udp', op, size, concurrency)
+                 for op in benchmark.UDP_OPS for size in [1024, 64 * 1024] for concurrency in [1, 2]}
+    assert {(c['transport'], c['op'], c['size'], c['concurrency']) for c in results} == expected
+    assert all(c['errors'] == 0 and c['ops'] == 2 * c['concurrency'] for c in results)
+
+    for c in results:
+        c['mb_per_s'] *= 10
+        c['ops_per_s'] *= 10
+    faster = tmp_path / 'faster.json'
+    faster.write_text(json.dumps({'results': results}))
+    run = subprocess.run([sys.executable, script, *options, '--compare', str(faster), '--output',
+                          str(tmp_path / 'compared.json')], cwd=tmp_path, stderr=subprocess.DEVNULL)
+    assert run.returncode == 1
+    comparison = json.loads((tmp_path / 'compared.json').read_text())['comparison']
+    assert len(comparison) == len(results) and all(row['regression'] for row in comparison)
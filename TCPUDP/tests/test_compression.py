@@ -0,0 +1,60 @@
+import io
+import os
+
+import pytest
+
+import client
+import compression
+import protocol
+import server
+
+
+# A stream of raw compressed into one record, as a hostile sender could
+# make it (send_compressed() puts READ_SIZE raw bytes in each)
+def one_record(raw, codec):
+    compressor = compression.codecs[codec].compressor()
+    data = compressor.compress(raw) + compressor.flush()
+    return compression.CHUNK_HEADER.pack(len(data)) + data + compression.CHUNK_HEADER.pack(0)
+
+
+# A small record that expands enormously comes out in pieces of at most
+# OUTPUT_LIMIT bytes, whatever the codec
+@pytest.mark.parametrize('codec', sorted(compression.codecs))
+def test_decompressed_pieces_are_bounded(codec):
+    raw = bytes(64 * 1024 * 1024)
+    stream = io.BytesIO(one_record(raw, codec) + b'next frame')
+    total = 0
+    for piece in compression.receive_compressed(stream.read, codec):
+        assert len(piece) <= compression.OUTPUT_LIMIT
+        total += len(piece)
+    assert total == len(raw)
+    assert stream.read() == b'next frame'  # The end record was consumed, nothing after it
+
+
+@pytest.mark.parametrize('codec', sorted(compression.codecs))
+def test_corrupt_record_raises_compression_error(codec):
+    stream = io.BytesIO(compression.CHUNK_HEADER.pack(5) + b'xxxxx' + compression.CHUNK_HEADER.pack(0))
+    with pytest.raises(compression.CompressionError):
+        list(compression.receive_compressed(stream.read, codec))
+
+
+# A compressible file goes up and comes back compressed with each codec, and
+# is stored and returned unchanged
+@pytest.mark.parametrize('codec', sorted(compression.codecs))
+def test_compressed_round_trip_through_the_server(start_server, codec):
+    addr = start_server()
+    name = f'compressed_{codec}.txt'
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', name)
+    data = b''.join(b'line %d of a fairly repetitive text file\n' % i for i in range(100000))
+    with open(path, 'wb') as f:
+        f.write(data)
+    with client.ServerConnection(addr) as conn:
+        conn.put(name, codec=codec, path=path)
+        assert conn.result()[1] == protocol.STATUS_OK
+        conn.get(name, codec=codec, path=path + '.copy')
+        assert conn.result()[1] == protocol.STATUS_FILE
+    with server.open_stored(name) as stored:
+        assert stored.read() == data
+    with open(path + '.copy', 'rb') as copy:
+        assert copy.read() == data
@@ -0,0 +1,95 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import client
+import protocol
+
+CLIENTS = 8
+STEPS = 4  # A slow client makes this many requests...
+STEP_DELAY = 0.1  # ...this many seconds apart, on one connection
+FILE_SIZE = 64 * 1024
+
+
+# Upload a file in STEPS versions, STEP_DELAY apart, and download the last
+# one back, all on one v2 connection; each step waits for the server's reply
+def slow_put_get(addr, name):
+    path = os.path.join('downloads', name)
+    os.makedirs('downloads', exist_ok=True)
+    with client.ServerConnection(addr) as conn:
+        for _ in range(STEPS):
+            time.sleep(STEP_DELAY)
+            data = os.urandom(FILE_SIZE)
+            with open(path, 'wb') as f:
+                f.write(data)
+            conn.put(name, path=path)
+            assert conn.result()[1] == protocol.STATUS_OK
+        os.remove(path)
+        conn.get(name, path=path)
+        assert conn.result()[1] == protocol.STATUS_FILE
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+
+def test_parallel_clients_take_about_as_long_as_one(start_server):
+    addr = start_server()
+    single = timed(slow_put_get, addr, 'single.bin')
+
+    failures = []
+
+    def run(i):
+        try:
+            slow_put_get(addr, f'parallel{i}.bin')
+        except Exception as e:  # Reported below, on the test's thread
+            failures.append(e)
+
+    def run_all():
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(CLIENTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    parallel = timed(run_all)
+    assert not failures
+    # Served one after another they would take CLIENTS times as long
+    assert parallel < 2 * single, f"{CLIENTS} clients took {parallel:.2f} s, one took {single:.2f} s"
+
+
+# Connect and complete the v2 handshake; raises socket.timeout if the
+# server does not answer within timeout seconds
+def hello(addr, timeout):
+    sock = socket.create_connection(addr, timeout=timeout)
+    try:
+        protocol.client_hello(sock)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def test_max_connections_limits_active_sessions(start_server):
+    addr = start_server(max_connections=2)
+    held = [hello(addr, 5), hello(addr, 5)]
+    try:
+        waiting = socket.create_connection(addr)  # Accepted by the kernel, not yet by the server
+        waiting.settimeout(0.5)
+        waiting.sendall(protocol.HELLO_MAGIC + bytes([protocol.VERSION]))
+        with pytest.raises(socket.timeout):
+            waiting.recv(1)
+        held.pop().close()  # Frees a slot
+        waiting.settimeout(5)
+        assert bytes(protocol.recv_exact(waiting, len(protocol.HELLO_MAGIC) + 1))[:-1] == protocol.HELLO_MAGIC
+        held.append(waiting)
+    finally:
+        for sock in held:
+            sock.close()
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+import client
+import impairment
+import udp_transfer
+from udp_transfer import INITIAL_CWND, MIN_CWND
+
+
+def test_reno_slow_start_loss_and_timeout():
+    cc = udp_transfer.new_congestion_control('reno', 100)
+    assert cc.cwnd == INITIAL_CWND
+    cc.on_ack(INITIAL_CWND, 0.01, 0)
+    assert cc.cwnd == 2 * INITIAL_CWND  # Doubles every round trip
+    cc.on_loss(2 * INITIAL_CWND, 0)
+    assert cc.cwnd == cc.ssthresh == INITIAL_CWND
+    cc.on_ack(INITIAL_CWND, 0.01, 0)
+    assert cc.cwnd == pytest.approx(INITIAL_CWND + 1, abs=0.1)  # One packet more per round trip
+    cc.on_timeout(cc.cwnd, 0)
+    assert cc.cwnd == 1 and cc.ssthresh == pytest.approx((INITIAL_CWND + 1) / 2, abs=0.1)
+    cc.on_loss(1, 0)
+    assert cc.cwnd == MIN_CWND
+    for _ in range(100):
+        cc.on_ack(cc.max_cwnd, 0.01, 0)
+    assert cc.cwnd == cc.max_cwnd
+
+
+def test_pacing_rates():
+    reno = udp_transfer.new_congestion_control('reno', 100)
+    assert reno.pacing_rate(None) is None
+    assert reno.pacing_rate(0.1) == pytest.approx(udp_transfer.SLOW_START_PACING_GAIN * INITIAL_CWND / 0.1)
+    reno.on_loss(INITIAL_CWND, 0)
+    assert reno.pacing_rate(0.1) == pytest.approx(udp_transfer.PACING_GAIN * reno.cwnd / 0.1)
+    fixed = udp_transfer.new_congestion_control('fixed', 100)
+    assert fixed.cwnd == 100 and fixed.pacing_rate(0.1) is None
+    with pytest.raises(udp_transfer.TransferError):
+        udp_transfer.new_congestion_control('vegas', 100)
+
+
+# The bucket holds a small burst, refills at the rate and goes negative for
+# retransmissions rather than holding them back
+def test_pacer_token_bucket():
+    pacer = udp_transfer.Pacer()
+    assert pacer.ready() and pacer.wait_time() == 0
+    pacer.refill(1000, 0.0)
+    burst = max(1000 * udp_transfer.PACING_QUANTUM, udp_transfer.MIN_PACING_BURST)
+    for _ in range(int(burst)):
+        assert pacer.ready()
+        pacer.spend()
+    assert not pacer.ready()
+    pacer.spend()
+    assert pacer.wait_time() == pytest.approx((1 - pacer.tokens) / 1000)
+    pacer.refill(1000, 0.01)
+    assert pacer.ready() and pacer.tokens == pytest.approx(burst)
+
+
+def test_rtt_estimator():
+    rtt = udp_transfer.RttEstimator()
+    assert rtt.rto == udp_transfer.INITIAL_RTO
+    rtt.sample(0.1)
+    assert rtt.srtt == 0.1 and rtt.rto == pytest.approx(0.3)
+    for _ in range(50):
+        rtt.sample(0.0001)
+    assert rtt.rto == udp_transfer.MIN_RTO
+    for _ in range(10):
+        rtt.backoff()
+    assert rtt.rto == udp_transfer.MAX_RTO
+
+
+# Behind a bandwidth cap with a short queue, the paced Reno sender keeps its
+# window near what the link carries instead of overflowing the queue
+def test_upload_through_bandwidth_cap_loses_little(start_udp_server, monkeypatch):
+    monkeypatch.setattr(client, 'UDP_CONGESTION_CONTROL', 'reno')
+    addr = start_udp_server()
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', 'capped.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(1024 * 1024))
+    link = impairment.Impairment(bandwidth=4 * 1024 * 1024, queue_limit=32 * 1024, seed=17)
+    with impairment.UdpRelay(addr, link) as relay:
+        assert client.udp_send_file('capped.bin', path, relay.address)
+        forward = relay.stats()['forward']
+    assert forward['queue_dropped'] < forward['packets'] / 10
@@ -0,0 +1,57 @@
+import os
+
+import client
+import protocol
+import server
+
+
+def stats(addr):
+    with client.ServerConnection(addr) as conn:
+        conn.stats()
+        stats = conn.result()[2]
+    return stats['bytes'].get('tcp_received', 0), stats['chunk_store']
+
+
+def upload(addr, name, data):
+    with open(os.path.join(client.UPLOAD_FOLDER, name), 'wb') as f:
+        f.write(data)
+    before, store_before = stats(addr)
+    assert client.dedup_put(addr, name) == protocol.STATUS_OK
+    after, store_after = stats(addr)
+    with server.open_stored(name) as stored:
+        assert stored.read() == data
+    return after - before, store_after['bytes'] - store_before['bytes']
+
+
+# dedup_put sends only the chunks the server lacks: an edited copy costs
+# about the chunks around the edit, an identical one just the chunk list
+def test_dedup_put_sends_only_new_chunks(start_server, monkeypatch):
+    addr = start_server()
+    os.makedirs('dedup_uploads', exist_ok=True)
+    monkeypatch.setattr(client, 'UPLOAD_FOLDER', 'dedup_uploads')
+    monkeypatch.setattr(client, 'resumable_put', None)  # No falling back to a plain upload
+    data = os.urandom(4 * 1024 * 1024)
+    received, stored = upload(addr, 'dedup_original.bin', data)
+    assert received > len(data) and stored >= len(data) * 0.9
+
+    edited = data[:2 * 1024 * 1024] + b'an insertion' + data[2 * 1024 * 1024:]
+    received, stored = upload(addr, 'dedup_edited.bin', edited)
+    assert received < 1024 * 1024 and stored < 1024 * 1024
+
+    received, stored = upload(addr, 'dedup_copy.bin', data)
+    assert received < 64 * 1024 and stored == 0
+    with client.ServerConnection(addr) as conn:
+        conn.get('dedup_copy.bin', path=os.path.join('dedup_uploads', 'copy'))
+        assert conn.result()[1] == protocol.STATUS_FILE
+    with open(os.path.join('dedup_uploads', 'copy'), 'rb') as f:
+        assert f.read() == data
+
+
+# Chunk queries for large files go out in batches the server accepts
+def test_chunk_queries_are_batched(start_server, monkeypatch):
+    addr = start_server()
+    os.makedirs('dedup_uploads', exist_ok=True)
+    monkeypatch.setattr(client, 'UPLOAD_FOLDER', 'dedup_uploads')
+    monkeypatch.setattr(client, 'resumable_put', None)  # No falling back to a plain upload
+    monkeypatch.setattr(protocol, 'MAX_CHUNK_QUERY', 4)
+    upload(addr, 'dedup_batched.bin', os.urandom(2 * 1024 * 1024))
@@ -0,0 +1,40 @@
+import os
+
+import client
+import protocol
+import server
+
+
+def tcp_received(addr):
+    with client.ServerConnection(addr) as conn:
+        conn.stats()
+        return conn.result()[2]['bytes'].get('tcp_received', 0)
+
+
+# A file edited in a few places is rebuilt from the server's old copy plus
+# the changed bytes, without falling back to a whole upload
+def test_delta_put_sends_only_the_changes(start_server, monkeypatch):
+    addr = start_server()
+    os.makedirs('delta_uploads', exist_ok=True)
+    monkeypatch.setattr(client, 'UPLOAD_FOLDER', 'delta_uploads')
+    path = os.path.join('delta_uploads', 'edited.bin')
+    old = os.urandom(2 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        f.write(old)
+    with client.ServerConnection(addr) as conn:
+        conn.put('edited.bin', path=path)
+        assert conn.result()[1] == protocol.STATUS_OK
+
+    new = old[:1000] + b'inserted' + old[1000:500000] + b'X' * 100 + old[500100:] + b'appended'
+    with open(path, 'wb') as f:
+        f.write(new)
+
+    def whole_upload(addr, filename):
+        raise AssertionError("delta_put fell back to a whole upload")
+
+    monkeypatch.setattr(client, 'resumable_put', whole_upload)
+    before = tcp_received(addr)
+    assert client.delta_put(addr, 'edited.bin') == protocol.STATUS_OK
+    assert tcp_received(addr) - before < len(new) // 10
+    with server.open_stored('edited.bin') as stored:
+        assert stored.read() == new
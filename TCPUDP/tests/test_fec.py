@@ -0,0 +1,94 @@
+import os
+import random
+
+import pytest
+
+import client
+import fec
+import impairment
+import server
+
+
+def encode(payloads, k, m):
+    encoder = fec.BlockEncoder(k, m)
+    repairs = []
+    for seq, payload in enumerate(payloads):
+        block = encoder.add(seq, payload)
+        if block:
+            repairs.append(block)
+    block = encoder.flush()
+    if block:
+        repairs.append(block)
+    return repairs
+
+
+# Feed the decoder every payload but the lost ones, then the repairs;
+# returns {seq: payload} of what it rebuilt
+def decode(payloads, repairs, lost, k, m):
+    decoder = fec.BlockDecoder(k, m)
+    rebuilt = {}
+    for seq, payload in enumerate(payloads):
+        if seq not in lost:
+            rebuilt.update(decoder.add(seq, payload))
+    for block_start, bodies in repairs:
+        for body in bodies:
+            rebuilt.update(decoder.add_repair(block_start, body))
+    assert decoder.recovered == len(rebuilt)
+    return rebuilt
+
+
+def random_payloads(count, size=100, seed=18):
+    rng = random.Random(seed)
+    payloads = [rng.randbytes(size) for _ in range(count - 1)]
+    return payloads + [rng.randbytes(size // 3)]  # A short last packet, like the end of a file
+
+
+# Any burst of up to M consecutive losses is rebuilt, including the short
+# last packet of a partly filled block
+@pytest.mark.parametrize('lost', [{0, 1}, {6, 7}, {3}, {18, 19}, {19}])
+def test_bursts_up_to_m_are_rebuilt(lost):
+    payloads = random_payloads(20)
+    rebuilt = decode(payloads, encode(payloads, 8, 2), lost, 8, 2)
+    assert rebuilt == {seq: payloads[seq] for seq in lost}
+
+
+# Two losses in one parity group are left to retransmission
+def test_two_losses_in_one_group_are_not_rebuilt():
+    payloads = random_payloads(8)
+    assert decode(payloads, encode(payloads, 8, 2), {0, 2}, 8, 2) == {}
+    assert decode(payloads, encode(payloads, 8, 2), {0, 2, 5}, 8, 2) == {5: payloads[5]}
+
+
+def test_option_parsing():
+    assert fec.parse_option('16,2') == (16, 2)
+    assert fec.parse_option(fec.format_option(4, 4)[len('fec='):]) == (4, 4)
+    for text in ['16', '2,4', '0,0', '256,1', 'a,b']:
+        with pytest.raises(fec.FecError):
+            fec.parse_option(text)
+
+
+# With FEC on, transfers through a lossy link come through intact both ways
+def test_fec_transfers_through_lossy_relay(start_udp_server, monkeypatch):
+    monkeypatch.setattr(client, 'UDP_FEC', (fec.BLOCK_SIZE, fec.REPAIR_COUNT))
+    decoders = []
+
+    class RecordedDecoder(fec.BlockDecoder):
+        def __init__(self, k, m):
+            super().__init__(k, m)
+            decoders.append(self)
+
+    monkeypatch.setattr(fec, 'BlockDecoder', RecordedDecoder)
+    addr = start_udp_server()
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', 'fec.bin')
+    data = os.urandom(512 * 1024)
+    with open(path, 'wb') as f:
+        f.write(data)
+    with impairment.UdpRelay(addr, impairment.Impairment(loss=0.03, seed=18)) as relay:
+        assert client.udp_send_file('fec.bin', path, relay.address)
+        assert client.udp_receive_file('fec.bin', path + '.copy', relay.address)
+    assert len(decoders) == 2 and all(decoder.recovered for decoder in decoders)
+    with server.open_stored('fec.bin') as stored:
+        assert stored.read() == data
+    with open(path + '.copy', 'rb') as copy:
+        assert copy.read() == data
@@ -0,0 +1,57 @@
+import os
+from types import SimpleNamespace
+
+import client
+import file_cache
+import protocol
+
+
+def stat(size, inode):
+    return SimpleNamespace(st_size=size, st_mtime_ns=1, st_ino=inode)
+
+
+def file_cache_counters(conn):
+    conn.stats()
+    cache = conn.result()[2]['file_cache']
+    return cache['hits'], cache['misses']
+
+
+# Repeated GETs are served from memory; an overwrite replaces what they see
+def test_get_hits_the_cache_until_the_file_is_overwritten(start_server):
+    addr = start_server()
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', 'hot.txt')
+    copy = path + '.copy'
+    with client.ServerConnection(addr) as conn:
+        for content in [b'first version', b'second, longer version']:
+            with open(path, 'wb') as f:
+                f.write(content)
+            conn.put('hot.txt', path=path)
+            assert conn.result()[1] == protocol.STATUS_OK
+            hits, misses = file_cache_counters(conn)
+            for _ in range(3):
+                conn.get('hot.txt', path=copy)
+                assert conn.result()[1] == protocol.STATUS_FILE
+                with open(copy, 'rb') as f:
+                    assert f.read() == content
+            assert file_cache_counters(conn) == (hits + 2, misses + 1)
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = file_cache.FileCache(budget=300, max_file_size=200)
+    for inode, name in enumerate(['a', 'b', 'c']):
+        cache.add(name, bytes(100), stat(100, inode))
+    assert cache.get('a', stat(100, 0)) is not None
+    cache.add('d', bytes(100), stat(100, 3))
+    assert cache.get('b', stat(100, 1)) is None
+    for inode, name in [(0, 'a'), (2, 'c'), (3, 'd')]:
+        assert cache.get(name, stat(100, inode)) is not None
+    assert cache.stats()['evictions'] == 1 and cache.stats()['bytes'] == 300
+
+
+def test_stale_and_oversized_files_are_not_served():
+    cache = file_cache.FileCache(budget=1000, max_file_size=200)
+    cache.add('stale', bytes(100), stat(100, 1))
+    assert cache.get('stale', stat(100, 2)) is None  # Replaced on disk by another process
+    cache.add('big', bytes(300), stat(300, 3))
+    assert cache.get('big', stat(300, 3)) is None
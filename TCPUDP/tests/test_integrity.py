@@ -0,0 +1,80 @@
+import os
+
+import client
+import integrity
+import protocol
+import server
+
+
+def write_file(name, size):
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def stored_bytes(name):
+    with server.open_stored(name) as f:
+        return f.read()
+
+
+# Socket that records how many bytes went through sendall() and sendfile()
+class SpySocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.sendall_bytes = 0
+        self.sendfile_bytes = 0
+
+    def sendall(self, data):
+        self.sendall_bytes += len(data)
+        return self.sock.sendall(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = self.sock.sendfile(file, offset, count)
+        self.sendfile_bytes += sent
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+# Checksummed uploads keep the zero-copy path: the file goes out with
+# sendfile() and only the frame header and trailer through sendall()
+def test_checksummed_put_sends_the_file_with_sendfile(start_server, monkeypatch):
+    monkeypatch.setattr(client, 'CHECKSUMS', True)
+    addr = start_server()
+    size = 3 * 1024 * 1024 + 5
+    path = write_file('zero_copy.bin', size)
+    with client.ServerConnection(addr) as conn:
+        conn.sock = spy = SpySocket(conn.sock)
+        conn.put('zero_copy.bin', path=path)
+        assert conn.result()[1] == protocol.STATUS_OK
+    assert spy.sendfile_bytes == size
+    assert spy.sendall_bytes < 1024
+    with open(path, 'rb') as f:
+        assert stored_bytes('zero_copy.bin') == f.read()
+
+
+# An upload whose data does not match its CRC trailer is kept staged, the
+# bad chunks are reported, and patching just those completes it
+def test_corrupted_chunks_are_reported_and_patched(start_server):
+    addr = start_server()
+    size = 3 * integrity.CHUNK_SIZE + 100
+    path = write_file('patched.bin', size)
+    with open(path, 'rb') as f:
+        data = f.read()
+    damaged = bytearray(data)
+    damaged[integrity.CHUNK_SIZE + 5] ^= 0x40
+    damaged[size - 1] ^= 0x01
+    checksum = integrity.StreamChecksum()
+    checksum.update(data)
+    with client.ServerConnection(addr) as conn:
+        conn._send('put', protocol.OP_PUT, 'patched.bin', bytes(damaged) + checksum.trailer(), size,
+                   flags=protocol.FLAG_CHECKSUM)
+        _, status, bad_ranges = conn.result()
+        assert status == protocol.STATUS_CORRUPT
+        assert bad_ranges == [(integrity.CHUNK_SIZE, integrity.CHUNK_SIZE), (3 * integrity.CHUNK_SIZE, 100)]
+        assert not os.path.exists(os.path.join(server.UPLOAD_FOLDER_DESTINATION, 'patched.bin'))
+        assert conn.repair_put('patched.bin', bad_ranges, path) == protocol.STATUS_OK
+    assert stored_bytes('patched.bin') == data
@@ -0,0 +1,154 @@
+import os
+import re
+import socket
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import client
+import compression
+import metrics
+import protocol
+import server
+
+
+def tcp_received(conn):
+    conn.stats()
+    return conn.result()[2]['bytes'].get('tcp_received', 0)
+
+
+def tcp_sent(conn):
+    conn.stats()
+    return conn.result()[2]['bytes'].get('tcp_sent', 0)
+
+
+# Bytes are counted as they arrive: an upload cut short counts what came,
+# not the size it announced
+def test_cut_short_upload_counts_the_bytes_received(start_server):
+    addr = start_server()
+    name = b'cut.bin'
+    sent = bytes([len(name)]) + name + (1024 * 1024).to_bytes(4, 'big') + bytes(1000)  # v1 PUT of 1 MiB
+    with client.ServerConnection(addr) as conn:
+        before = tcp_received(conn)
+        with socket.create_connection(addr) as sock:
+            sock.sendall(sent)
+        expected = before + len(sent) + protocol.FRAME_HEADER.size  # And the next STATS request
+        deadline = time.monotonic() + 5
+        while (received := tcp_received(conn)) < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+            expected += protocol.FRAME_HEADER.size
+        assert received == expected
+
+
+# A compressed upload or download counts its compressed bytes, not the file
+# size, the first time and when served from the stored compressed copy
+def test_compressed_transfers_count_the_bytes_on_the_wire(start_server):
+    addr = start_server()
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', 'zeros.bin')
+    with open(path, 'wb') as f:
+        f.write(bytes(1024 * 1024))
+    with client.ServerConnection(addr) as conn:
+        before = tcp_received(conn)
+        conn.put('zeros.bin', codec=compression.CODEC_ZLIB, path=path)
+        assert conn.result()[1] == protocol.STATUS_OK
+        assert tcp_received(conn) - before < 64 * 1024
+        for _ in range(2):
+            before = tcp_sent(conn)
+            conn.get('zeros.bin', codec=compression.CODEC_ZLIB, path=path + '.copy')
+            assert conn.result()[1] == protocol.STATUS_FILE
+            assert tcp_sent(conn) - before < 64 * 1024
+
+
+# An uncompressed download counts the file, its frame header and the replies
+# to the STATS requests around it
+def test_download_counts_the_bytes_sent(start_server):
+    addr = start_server()
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', 'sent.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(3 * 1024 * 1024))
+    with client.ServerConnection(addr) as conn:
+        conn.put('sent.bin', path=path)
+        assert conn.result()[1] == protocol.STATUS_OK
+        before = tcp_sent(conn)
+        conn.get('sent.bin', path=path + '.copy')
+        assert conn.result()[1] == protocol.STATUS_FILE
+        sent = tcp_sent(conn) - before
+    assert 3 * 1024 * 1024 < sent < 3 * 1024 * 1024 + 64 * 1024
+
+
+def server_stats(addr):
+    with client.ServerConnection(addr) as conn:
+        conn.stats()
+        _, status, stats = conn.result()
+    assert status == protocol.STATUS_OK
+    return stats
+
+
+# STATS answers with JSON counting requests, their latency, connections,
+# UDP transfers, errors and the caches
+def test_stats_reports_requests_transfers_and_errors(start_server, start_udp_server):
+    addr = start_server()
+    udp_addr = start_udp_server()
+    before = server_stats(addr)
+    assert {'worker', 'uptime_s', 'requests', 'latency', 'bytes', 'connections', 'udp', 'errors',
+            'file_cache', 'summary_cache', 'chunk_store'} <= before.keys()
+
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', 'counted.bin')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(10000))
+    with client.ServerConnection(addr) as conn:
+        conn.put('counted.bin', path=path)
+        conn.get('counted.bin', path=path + '.copy')
+        conn.results()
+    assert client.udp_receive_file('counted.bin', path + '.udp', udp_addr)
+    with socket.create_connection(addr) as sock:
+        protocol.client_hello(sock)
+        sock.sendall(protocol.pack_frame(protocol.OP_CHANGE, 1, 'counted.bin', protocol.MAX_NAME_SIZE + 1))
+        assert sock.recv(1) == b''  # Refused as a protocol error
+
+    deadline = time.monotonic() + 5
+    while True:
+        stats = server_stats(addr)
+        if stats['udp'].get('transfers_completed', 0) > before['udp'].get('transfers_completed', 0):
+            break
+        assert time.monotonic() < deadline, "UDP transfer was never accounted for"
+        time.sleep(0.05)
+    for op in ['PUT', 'GET']:
+        assert stats['requests'][op] == before['requests'].get(op, 0) + 1
+        assert stats['latency'][op]['count'] == stats['requests'][op]
+        assert 0 <= stats['latency'][op]['p50_ms'] <= stats['latency'][op]['max_ms']
+    assert stats['requests']['UDP_GET'] == before['requests'].get('UDP_GET', 0) + 1
+    assert stats['connections']['total'] >= before['connections']['total'] + 3
+    assert stats['errors']['tcp:ProtocolError'] == before['errors'].get('tcp:ProtocolError', 0) + 1
+    assert stats['bytes']['udp_sent'] >= before['bytes'].get('udp_sent', 0) + 10000
+
+
+# The exporter serves the counters in the Prometheus text format, with
+# cumulative latency buckets per operation
+def test_prometheus_endpoint(start_server):
+    addr = start_server()
+    server_stats(addr)
+    exporter = metrics.start_http_exporter('127.0.0.1', 0, server.metrics_text)
+    url = f'http://127.0.0.1:{exporter.server_address[1]}'
+    try:
+        with urllib.request.urlopen(url + '/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            text = response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/nothing')
+    finally:
+        exporter.shutdown()
+        exporter.server_close()
+    prefix = metrics.PROMETHEUS_PREFIX
+    assert f'# TYPE {prefix}request_duration_seconds histogram' in text
+    requests = int(re.search(rf'^{prefix}requests_total{{op="STATS"}} (\d+)$', text, re.M).group(1))
+    bucket = rf'^{prefix}request_duration_seconds_bucket{{op="STATS",le="[^"]+"}} (\d+)$'
+    buckets = [int(n) for n in re.findall(bucket, text, re.M)]
+    assert requests >= 1 and buckets == sorted(buckets) and buckets[-1] == requests
+    for line in text.splitlines():
+        assert line.startswith('#') or re.fullmatch(r'[a-z_]+(\{[^}]*\})? -?[0-9.e+-]+', line), line
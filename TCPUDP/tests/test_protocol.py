@@ -0,0 +1,84 @@
+import itertools
+import os
+import socket
+import tracemalloc
+
+import client
+import protocol
+
+BIG_PAYLOAD = 64 * 1024 * 1024
+
+
+def hello(addr):
+    sock = socket.create_connection(addr, timeout=5)
+    protocol.client_hello(sock)
+    return sock
+
+
+# Frame headers carry 64-bit sizes and offsets and 32-bit request IDs
+def test_frame_round_trip():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(protocol.pack_frame(protocol.OP_GET, 0xFFFFFFFF, 'n' * 1000, 5 << 32, offset=3 << 40, size=7 << 40))
+        frame = protocol.read_frame(right)
+    assert frame == protocol.Frame(protocol.OP_GET, protocol.FLAG_RANGE, 0xFFFFFFFF, 'n' * 1000, 5 << 32,
+                                   3 << 40, 7 << 40)
+
+
+# Names longer than the 31 bytes v1 allows, and request IDs wrapping around
+# 32 bits, work end to end
+def test_long_names_and_wrapping_request_ids(start_server):
+    addr = start_server()
+    name = 'long_' + 'x' * 200 + '.txt'
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', name)
+    with open(path, 'wb') as f:
+        f.write(b'long name')
+    with client.ServerConnection(addr) as conn:
+        conn.request_ids = itertools.count(0xFFFFFFFE)
+        conn.put(name, path=path)
+        conn.get(name, path=path + '.copy')
+        conn.get(name, path=path + '.copy2')
+        assert [status for _, status, _ in conn.results()] == [protocol.STATUS_OK] + [protocol.STATUS_FILE] * 2
+    for copy in [path + '.copy', path + '.copy2']:
+        with open(copy, 'rb') as f:
+            assert f.read() == b'long name'
+
+
+# Peak bytes allocated (by the server thread too) while function runs
+def peak_allocated(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# The payload of an unknown request is skipped without holding it in memory
+def test_unknown_request_payload_is_discarded_in_pieces(start_server):
+    addr = start_server()
+    with hello(addr) as sock:
+        def send_unknown():
+            sock.sendall(protocol.pack_frame(31, 1, payload_length=BIG_PAYLOAD))
+            piece = bytes(1024 * 1024)
+            for _ in range(BIG_PAYLOAD // len(piece)):
+                sock.sendall(piece)
+            frame = protocol.read_frame(sock)
+            assert (frame.opcode, frame.request_id) == (protocol.STATUS_UNKNOWN, 1)
+
+        assert peak_allocated(send_unknown) < BIG_PAYLOAD // 8
+
+
+# Payloads that can only be a digest or a name are refused by their announced
+# length, before anything is allocated for them
+def test_oversized_digest_and_name_payloads_drop_the_connection(start_server):
+    addr = start_server()
+    for opcode, flags in [(protocol.OP_COMMIT, protocol.FLAG_PATCH), (protocol.OP_CHANGE, 0),
+                          (protocol.OP_CHUNKS, 0)]:
+        with hello(addr) as sock:
+            def send_request():
+                sock.sendall(protocol.pack_frame(opcode, 1, 'capped.bin', BIG_PAYLOAD, flags, offset=0, size=0))
+                assert sock.recv(1) == b''
+
+            assert peak_allocated(send_request) < BIG_PAYLOAD // 8
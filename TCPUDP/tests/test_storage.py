@@ -0,0 +1,33 @@
+import os
+
+import client
+import protocol
+
+
+def write_numbers(name, count=1000):
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', name)
+    with open(path, 'w') as f:
+        f.writelines(f'{i}\n' for i in range(count))
+    return path
+
+
+def cache_counters(conn):
+    conn.stats()
+    cache = conn.result()[2]['summary_cache']
+    return cache['hits'], cache['misses']
+
+
+# PUT summarizes the upload as it streams in, so the summary it stored
+# must be found again under the stat of the stored file
+def test_summary_after_put_is_a_cache_hit(start_server):
+    addr = start_server()
+    with client.ServerConnection(addr) as conn:
+        conn.put('numbers.txt', path=write_numbers('numbers.txt'))
+        assert conn.result()[1] == protocol.STATUS_OK
+        hits, misses = cache_counters(conn)
+        conn.summary('numbers.txt')
+        _, status, text = conn.result()
+        assert status == protocol.STATUS_OK
+        assert text.startswith('Max: 999.0, Min: 0.0')
+        assert cache_counters(conn) == (hits + 1, misses)
@@ -0,0 +1,71 @@
+import os
+
+import client
+import protocol
+import server
+
+STRIPE = 64 * 1024
+
+
+def write_file(name, size):
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def put_stripes(conn, name, path, stripes):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        for offset in stripes:
+            conn.put_stripe(name, f, offset, min(STRIPE, size - offset), size)
+            assert conn.result()[1] == protocol.STATUS_OK
+
+
+def commit(conn, name, path):
+    conn.commit(name, os.path.getsize(path))
+    return conn.result()[1]
+
+
+# The staging file has the full size from the first stripe on; a stripe that
+# never arrived must not be committed as zeros
+def test_commit_waits_for_every_stripe(start_server):
+    addr = start_server()
+    path = write_file('gap.bin', 4 * STRIPE + 100)
+    with client.ServerConnection(addr) as conn:
+        put_stripes(conn, 'gap.bin', path, [0, 3 * STRIPE, STRIPE, 4 * STRIPE])
+        assert commit(conn, 'gap.bin', path) == protocol.STATUS_FAILED
+        assert not os.path.exists(os.path.join(server.UPLOAD_FOLDER_DESTINATION, 'gap.bin'))
+        put_stripes(conn, 'gap.bin', path, [2 * STRIPE])
+        assert commit(conn, 'gap.bin', path) == protocol.STATUS_OK
+    with server.open_stored('gap.bin') as stored, open(path, 'rb') as original:
+        assert stored.read() == original.read()
+
+
+# Stripes take the staging lock like other uploads (shared among themselves),
+# so none is written into a file being committed
+def test_stripes_are_refused_while_the_upload_is_locked(start_server):
+    addr = start_server()
+    path = write_file('locked.bin', STRIPE)
+    locked = server.open_staging_file(server.staging_path('locked.bin') + server.STRIPE_SUFFIX)
+    with locked, client.ServerConnection(addr) as conn, open(path, 'rb') as f:
+        conn.put_stripe('locked.bin', f, 0, STRIPE, STRIPE)
+        assert conn.result()[1] == protocol.STATUS_FAILED
+        conn.help()
+        assert conn.result()[1] == protocol.STATUS_HELP  # The stripe's data was skipped
+
+
+# A file sent as stripes over parallel connections is committed whole, and
+# comes back the same when fetched as stripes
+def test_striped_put_and_get_round_trip(start_server, monkeypatch):
+    addr = start_server()
+    path = write_file('striped.bin', 10 * STRIPE + 321)
+    monkeypatch.setattr(client, 'UPLOAD_FOLDER', os.path.dirname(path))
+    monkeypatch.setattr(client, 'DOWNLOAD_FOLDER_DESTINATION', 'striped_downloads')
+    assert client.striped_put(addr, 'striped.bin', streams=4, stripe_size=STRIPE)
+    staged = server.staging_path('striped.bin') + server.STRIPE_SUFFIX
+    assert not os.path.exists(staged) and not os.path.exists(staged + server.RECEIVED_SUFFIX)
+    assert client.striped_get(addr, 'striped.bin', streams=4, stripe_size=STRIPE)
+    with open(path, 'rb') as original, open(os.path.join('striped_downloads', 'striped.bin'), 'rb') as copy:
+        assert copy.read() == original.read()
@@ -0,0 +1,92 @@
+import os
+import socket
+
+import client
+import protocol
+import summary
+
+
+def upload(addr, name, lines):
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', name)
+    with open(path, 'w') as f:
+        f.writelines(f'{line}\n' for line in lines)
+    with client.ServerConnection(addr) as conn:
+        conn.put(name, path=path)
+        assert conn.result()[1] == protocol.STATUS_OK
+
+
+# SUMMARY over protocol v1, as the original client sends it; returns the text
+def v1_summary(addr, name):
+    with socket.create_connection(addr, timeout=5) as sock:
+        sock.sendall(bytes([0b011 << 5 | len(name)]) + name.encode('utf-8'))
+        header = protocol.recv_exact(sock, 1)[0]
+        assert header >> 5 == 0b010  # Successful SUMMARY
+        return bytes(protocol.recv_exact(sock, header & 0b11111)).decode('utf-8')
+
+
+def test_v1_summary_keeps_the_original_reply(start_server):
+    addr = start_server()
+    upload(addr, 'three.txt', [1, 2, 3])
+    assert v1_summary(addr, 'three.txt') == "Max: 3.0, Min: 1.0, Avg: 2.0\n"
+
+
+def test_v1_summary_fits_the_length_field(start_server):
+    addr = start_server()
+    upload(addr, 'long.txt', [1000, 0, 1, 'not a number'])
+    assert v1_summary(addr, 'long.txt') == "Max: 1000, Min: 0, Avg: 333.67\n"  # 31 bytes, digits dropped to fit
+
+
+def test_v2_summary_has_the_full_statistics(start_server):
+    addr = start_server()
+    upload(addr, 'full.txt', [1, 2, 3, 'x'])
+    with client.ServerConnection(addr) as conn:
+        conn.summary('full.txt')
+        _, status, text = conn.result()
+    assert status == protocol.STATUS_OK
+    assert "Std: " in text and "Count: 3" in text and "Malformed lines: 1 (4)" in text
+
+
+def test_v1_text_gives_up_when_nothing_fits():
+    assert summary.v1_text("Max: -1234567.0, Min: -1234567.0, Avg: -1234567.0, Std: 0.0, Count: 1\n", 31) is None
+
+
+def test_summary_caches_of_two_workers_share_entries(tmp_path):
+    path = tmp_path / 'cache.sqlite'
+    first, second = summary.SummaryCache(str(path)), summary.SummaryCache(str(path))
+    a = os.stat(tmp_path)
+    first.store('a.txt', a, 'hash-a', 'text a')
+    second.store('b.txt', a, 'hash-b', 'text b')  # Must not drop a.txt
+    assert first.lookup('b.txt', a) == (True, 'text b')
+    assert second.lookup('a.txt', a) == (True, 'text a')
+    second.rename('a.txt', 'c.txt')
+    assert first.lookup('a.txt', a) == (False, None)
+    assert first.lookup('c.txt', a) == (True, 'text a')
+
+
+def test_summary_cache_drops_the_least_recently_used(tmp_path):
+    cache = summary.SummaryCache(str(tmp_path / 'cache.sqlite'), capacity=2)
+    st = os.stat(tmp_path)
+    cache.store('a.txt', st, 'hash', 'a')
+    cache.store('b.txt', st, 'hash', 'b')
+    assert cache.lookup('a.txt', st)[0]  # Now b.txt is the least recently used
+    cache.store('c.txt', st, 'hash', 'c')
+    assert len(cache) == 2
+    assert cache.lookup('b.txt', st) == (False, None)
+    assert cache.lookup('a.txt', st) == (True, 'a')
+
+
+# A UDP upload computes no summary, but records the file's hash; the same
+# content uploaded again is recognized by it
+def test_summary_cache_recognizes_the_same_content_by_hash(start_server, start_udp_server):
+    addr, udp_addr = start_server(), start_udp_server()
+    upload(addr, 'again.txt', range(100))
+    assert client.udp_send_file('again.txt', os.path.join('downloads', 'again.txt'), udp_addr)
+    with client.ServerConnection(addr) as conn:
+        conn.stats()
+        before = conn.result()[2]['summary_cache']
+        conn.summary('again.txt')
+        assert conn.result()[1] == protocol.STATUS_OK
+        conn.stats()
+        after = conn.result()[2]['summary_cache']
+    assert (after['hits'], after['misses']) == (before['hits'] + 1, before['misses'])
@@ -0,0 +1,105 @@
+import os
+import socket
+import time
+
+import pytest
+
+import client
+import protocol
+import server
+
+
+def write_file(name, size):
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Files larger than the hot-file cache go out with sendfile() and come in
+# through recv_into(), many buffers' worth at a time
+@pytest.mark.parametrize('checksums', [False, True])
+def test_large_file_round_trip(start_server, monkeypatch, checksums):
+    monkeypatch.setattr(client, 'CHECKSUMS', checksums)
+    addr = start_server()
+    name = f'large_{checksums}.bin'
+    path = write_file(name, 4 * server.FILE_CACHE_MAX_FILE_SIZE + 12345)
+    with client.ServerConnection(addr) as conn:
+        conn.put(name, path=path)
+        assert conn.result()[1] == protocol.STATUS_OK
+        conn.get(name, path=path + '.copy')
+        assert conn.result()[1] == protocol.STATUS_FILE
+    assert read(path + '.copy') == read(path)
+
+
+# One connection carries many requests, sent before any reply is read; the
+# replies come back in order
+def test_pipelined_requests_on_one_connection(start_server):
+    addr = start_server()
+    names = [f'pipelined{i}.bin' for i in range(5)]
+    paths = [write_file(name, 1000 * (i + 1)) for i, name in enumerate(names)]
+    with client.ServerConnection(addr) as conn:
+        for name, path in zip(names, paths):
+            conn.put(name, path=path)
+        for name, path in zip(names, paths):
+            conn.get(name, path=path + '.copy')
+        conn.get('pipelined_missing.bin')
+        results = conn.results()
+    assert [(op, status) for op, status, _ in results] == (
+        [('put', protocol.STATUS_OK)] * 5 + [('get', protocol.STATUS_FILE)] * 5 + [('get', protocol.STATUS_NOT_FOUND)])
+    for path in paths:
+        assert read(path + '.copy') == read(path)
+
+
+def staged_bytes(conn, name):
+    conn.stat(name)
+    return conn.result()[2][0]
+
+
+# An upload cut off halfway stays staged; the next PUT sends only the rest
+def test_put_resumes_after_an_interrupted_upload(start_server):
+    addr = start_server()
+    size = 3 * 1024 * 1024
+    path = write_file('resumed.bin', size)
+    data = read(path)
+    with socket.create_connection(addr) as sock:
+        protocol.client_hello(sock)
+        sock.sendall(protocol.pack_frame(protocol.OP_PUT, 1, 'resumed.bin', size))
+        sock.sendall(data[:size // 2])
+    with client.ServerConnection(addr) as conn:
+        deadline = time.monotonic() + 5
+        while staged_bytes(conn, 'resumed.bin') < size // 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert staged_bytes(conn, 'resumed.bin') == size // 2
+        assert client.put_resuming(conn, 'resumed.bin', path) == protocol.STATUS_OK
+        assert staged_bytes(conn, 'resumed.bin') == 0
+    with server.open_stored('resumed.bin') as stored:
+        assert stored.read() == data
+
+
+# A ranged GET returns just the range, which lands at its offset in the
+# .part file; a download continues from what a .part file already holds
+def test_ranged_get_and_resumed_download(start_server):
+    addr = start_server()
+    path = write_file('ranged.bin', 2 * 1024 * 1024)
+    data = read(path)
+    copy = path + '.copy'
+    with client.ServerConnection(addr) as conn:
+        conn.put('ranged.bin', path=path)
+        assert conn.result()[1] == protocol.STATUS_OK
+        conn.get('ranged.bin', 1000, 5000, path=copy)
+        _, status, partial_path = conn.result()
+        assert status == protocol.STATUS_FILE and partial_path == copy + client.PARTIAL_SUFFIX
+        assert read(partial_path)[1000:] == data[1000:6000]
+
+        with open(partial_path, 'wb') as f:
+            f.write(data[:1024 * 1024 + 777])
+        assert client.get_resuming(conn, 'ranged.bin', copy) == protocol.STATUS_FILE
+    assert read(copy) == data
+    assert not os.path.exists(copy + client.PARTIAL_SUFFIX)
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+import client
+import impairment
+import server
+import udp_transfer
+
+
+def write_file(name, size):
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def test_udp_round_trip(start_udp_server):
+    addr = start_udp_server()
+    path = write_file('round.bin', 1024 * 1024)
+    assert client.udp_send_file('round.bin', path, addr)
+    assert client.udp_receive_file('round.bin', path + '.copy', addr)
+    with open(path, 'rb') as original, open(path + '.copy', 'rb') as copy:
+        assert original.read() == copy.read()
+
+
+# The receiver returns once the file is verified; it does not sit out
+# LINGER_TIME waiting for repeated FINs
+def test_small_udp_get_returns_without_lingering(start_udp_server):
+    addr = start_udp_server()
+    path = write_file('small.bin', 1024)
+    assert client.udp_send_file('small.bin', path, addr)
+    started = time.perf_counter()
+    assert client.udp_receive_file('small.bin', path + '.copy', addr)
+    assert time.perf_counter() - started < udp_transfer.LINGER_TIME / 2
+
+
+# A finished upload is stored on a worker thread: other transfers go on
+# meanwhile and the uploader still gets its FIN_ACK afterwards
+def test_storing_an_upload_does_not_stall_other_transfers(start_udp_server, monkeypatch):
+    addr = start_udp_server()
+    path = write_file('other.bin', 256 * 1024)
+    assert client.udp_send_file('other.bin', path, addr)
+
+    storing = threading.Event()
+    store_upload = server.store_upload
+
+    def slow_store_upload(f, staged_path, filename):
+        if filename == 'slow.bin':
+            storing.set()
+            time.sleep(1.5)
+        return store_upload(f, staged_path, filename)
+
+    monkeypatch.setattr(server, 'store_upload', slow_store_upload)
+    slow_path = write_file('slow.bin', 64 * 1024)
+    uploads = []
+    uploader = threading.Thread(target=lambda: uploads.append(client.udp_send_file('slow.bin', slow_path, addr)))
+    uploader.start()
+    assert storing.wait(5)
+    started = time.perf_counter()
+    assert client.udp_receive_file('other.bin', path + '.copy', addr)
+    assert time.perf_counter() - started < 1.0
+    assert uploader.is_alive()  # Still waiting for its FIN_ACK
+    uploader.join()
+    assert uploads == [True]
+    with server.open_stored('slow.bin') as stored, open(slow_path, 'rb') as original:
+        assert stored.read() == original.read()
+
+
+def test_failed_store_is_reported_to_the_uploader(start_udp_server, monkeypatch):
+    addr = start_udp_server()
+
+    def failing_store_upload(f, staged_path, filename):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(server, 'store_upload', failing_store_upload)
+    started = time.perf_counter()
+    assert not client.udp_send_file('failing.bin', write_file('failing.bin', 4096), addr)
+    assert time.perf_counter() - started < udp_transfer.IDLE_TIMEOUT / 2
+
+
+# Records the datagrams a server function sends instead of sending them
+class RecordingDatagramIO:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, datagram, addr):
+        self.sent.append(udp_transfer.decode_packet(datagram))
+
+
+# Sessions are admitted on the memory their windows take at the negotiated
+# payload size, not on their count: jumbo-payload sessions use up the budget
+# sooner than ones at the default payload size
+def test_udp_sessions_are_admitted_on_window_memory(monkeypatch):
+    jumbo = udp_transfer.MAX_PAYLOAD_SIZE
+    monkeypatch.setattr(server, 'UDP_SESSION_MEMORY_BUDGET', 2 * server.udp_session_memory(jumbo))
+    datagram_io = RecordingDatagramIO()
+    sessions = {}
+    try:
+        for transfer_id in range(3):
+            key = (('127.0.0.1', 40000), transfer_id)
+            command = f'put budget{transfer_id}.bin payload={jumbo}'.encode()
+            server.udp_open_session(datagram_io, sessions, key, command)
+        assert len(sessions) == 2
+        kind, _, _, body = datagram_io.sent[-1]
+        assert kind == udp_transfer.PACKET_ERROR and bytes(body) == b'Server busy'
+
+        server.udp_close_session(sessions, next(iter(sessions)))
+        key = (('127.0.0.1', 40000), 3)
+        assert server.udp_open_session(datagram_io, sessions, key, b'put budget3.bin') is not None
+    finally:
+        for key in list(sessions):
+            server.udp_close_session(sessions, key)
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Transfers through an impairing relay still deliver every byte intact. The
+# seeds make each run see the same losses, reorderings, duplicates and
+# flipped bytes.
+@pytest.mark.parametrize('kind, settings', [
+    ('dropped', dict(loss=0.05)),
+    ('reordered', dict(reorder=0.1, reorder_delay=0.005)),
+    ('duplicated', dict(duplicate=0.1)),
+    ('corrupted', dict(corrupt=0.05)),
+])
+def test_udp_transfer_through_impaired_relay(start_udp_server, kind, settings):
+    addr = start_udp_server()
+    name = f'impaired_{kind}.bin'
+    path = write_file(name, 256 * 1024)
+    with open(path, 'rb') as f:
+        original = f.read()
+    with impairment.UdpRelay(addr, impairment.Impairment(seed=16, **settings)) as relay:
+        assert client.udp_send_file(name, path, relay.address)
+        assert client.udp_receive_file(name, path + '.copy', relay.address)
+        stats = relay.stats()
+    assert stats['forward'][kind] + stats['backward'][kind] > 0
+    with server.open_stored(name) as stored:
+        kept = stored.read()
+    assert kept == original and sha256(kept) == sha256(original)
+    with open(path + '.copy', 'rb') as copy:
+        copied = copy.read()
+    assert copied == original and sha256(copied) == sha256(original)
+
+
+# Transfers from several clients at once each get their own session
+def test_concurrent_udp_transfers_are_kept_apart(start_udp_server):
+    addr = start_udp_server()
+    paths = [write_file(f'parallel{i}.bin', 128 * 1024 + i) for i in range(4)]
+    results = []
+
+    def upload_and_download(path):
+        name = os.path.basename(path)
+        results.append(client.udp_send_file(name, path, addr) and client.udp_receive_file(name, path + '.copy', addr))
+
+    threads = [threading.Thread(target=upload_and_download, args=(path,)) for path in paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * len(paths)
+    for path in paths:
+        with open(path, 'rb') as original, open(path + '.copy', 'rb') as copy:
+            assert original.read() == copy.read()
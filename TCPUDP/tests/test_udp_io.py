@@ -0,0 +1,97 @@
+import errno
+import os
+import socket
+
+import pytest
+
+import client
+import server
+import udp_io
+
+
+# Socket stand-in recording the sizes of the datagrams of each send call
+class RecordingSocket:
+    def __init__(self, fail_segmented=False):
+        self.calls = []
+        self.fail_segmented = fail_segmented
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockopt(self, *args):
+        return 0
+
+    def sendto(self, datagram, addr):
+        self.calls.append([len(datagram)])
+        return len(datagram)
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        if self.fail_segmented:
+            raise OSError(errno.EIO, "segmentation offload failed")
+        self.calls.append([len(buffer) for buffer in buffers])
+        return sum(len(buffer) for buffer in buffers)
+
+
+def pair(offload):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    return udp_io.DatagramIO(sender, offload), udp_io.DatagramIO(receiver, offload)
+
+
+# Datagrams arrive whole and in order, batched or not
+@pytest.mark.parametrize('offload', [True, False])
+def test_datagrams_round_trip(offload):
+    sender, receiver = pair(offload)
+    with sender.sock, receiver.sock:
+        datagrams = [os.urandom(1000) for _ in range(20)] + [os.urandom(123)]
+        sender.send(datagrams, receiver.sock.getsockname())
+        received = [bytes(receiver.recvfrom()[0]) for _ in datagrams]
+        assert received == datagrams and not receiver.pending
+        assert sender.stats()['datagrams_sent'] == receiver.stats()['datagrams_received'] == len(datagrams)
+        if sender.gso:
+            assert sender.stats()['send_calls'] == 1
+        else:
+            assert sender.stats()['send_calls'] == len(datagrams)
+
+
+# A batch is a run of equally sized datagrams, of which only the last may be
+# shorter, of at most GSO_MAX_SEGMENTS datagrams and MAX_DATAGRAM bytes
+def test_batches_follow_the_segmentation_rules(monkeypatch):
+    monkeypatch.setattr(udp_io.sys, 'platform', 'linux')
+    io = udp_io.DatagramIO(RecordingSocket())
+    assert io.gso
+    sizes = [100] * 3 + [50] + [100] * (udp_io.GSO_MAX_SEGMENTS + 1) + [200, 200] + [30000] * 3
+    io.send([bytes(size) for size in sizes], ('127.0.0.1', 9))
+    assert io.sock.calls == [[100, 100, 100, 50], [100] * udp_io.GSO_MAX_SEGMENTS, [100], [200, 200],
+                             [30000, 30000], [30000]]
+    assert io.stats()['datagrams_sent'] == len(sizes)
+
+
+# A kernel or device that cannot segment switches the socket to one
+# datagram per send, starting with the batch that failed
+def test_failed_segmented_send_falls_back(monkeypatch):
+    monkeypatch.setattr(udp_io.sys, 'platform', 'linux')
+    io = udp_io.DatagramIO(RecordingSocket(fail_segmented=True))
+    io.send([bytes(100)] * 3, ('127.0.0.1', 9))
+    assert not io.gso and io.sock.calls == [[100]] * 3
+
+
+# With the payload size left to the path MTU, loopback transfers use
+# datagrams far larger than an Ethernet frame
+def test_large_payload_transfers(start_udp_server, monkeypatch):
+    monkeypatch.setattr(client, 'UDP_PAYLOAD_SIZE', None)
+    addr = start_udp_server()
+    assert client.udp_payload_size(addr) > 8 * 1024
+    os.makedirs('downloads', exist_ok=True)
+    path = os.path.join('downloads', 'jumbo.bin')
+    data = os.urandom(2 * 1024 * 1024 + 17)
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert client.udp_send_file('jumbo.bin', path, addr)
+    assert client.udp_receive_file('jumbo.bin', path + '.copy', addr)
+    with server.open_stored('jumbo.bin') as stored:
+        assert stored.read() == data
+    with open(path + '.copy', 'rb') as copy:
+        assert copy.read() == data
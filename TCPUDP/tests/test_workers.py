@@ -0,0 +1,62 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import client
+import protocol
+import server
+
+
+def free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def stats(addr):
+    with client.ServerConnection(addr) as conn:
+        conn.stats()
+        return conn.result()[2]
+
+
+# A server started with --workers forks worker processes sharing its ports;
+# connections spread over them and each serves files written by the others
+def test_workers_serve_requests(tmp_path):
+    tcp_port, udp_port = free_port(socket.SOCK_STREAM), free_port(socket.SOCK_DGRAM)
+    script = os.path.join(os.path.dirname(os.path.abspath(server.__file__)), 'server.py')
+    process = subprocess.Popen([sys.executable, script, str(tcp_port), '0', '--workers', '2',
+                                '--udp-port', str(udp_port)],
+                               cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    addr = ('127.0.0.1', tcp_port)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                stats(addr)
+                break
+            except OSError:
+                assert time.monotonic() < deadline, "server did not start"
+                time.sleep(0.05)
+
+        workers = {stats(addr)['worker'] for _ in range(32)}
+        assert len(workers) == 2 and process.pid not in workers
+
+        path = os.path.join(tmp_path, 'shared.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(100000))
+        with client.ServerConnection(addr) as conn:
+            conn.put('shared.bin', path=path)
+            assert conn.result()[1] == protocol.STATUS_OK
+        for i in range(8):  # Whichever worker each connection lands on
+            with client.ServerConnection(addr) as conn:
+                conn.get('shared.bin', path=f'{path}.{i}')
+                assert conn.result()[1] == protocol.STATUS_FILE
+            with open(path, 'rb') as original, open(f'{path}.{i}', 'rb') as copy:
+                assert copy.read() == original.read()
+        assert client.udp_receive_file('shared.bin', path + '.udp', ('127.0.0.1', udp_port))
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=server.WORKER_SHUTDOWN_TIMEOUT + 5) == 0
@@ -0,0 +1,171 @@
+import collections
+import errno
+import socket
+import struct
+import sys
+
+# Batched datagram I/O for the UDP transfers (see udp_transfer.py).
+#
+# DatagramIO wraps a UDP socket. On Linux it sends a run of equally sized
+# datagrams with one sendmsg() carrying UDP_SEGMENT (generic segmentation
+# offload): the datagrams are passed as a scatter-gather list and the kernel
+# cuts them apart again, so a window of packets costs one system call
+# instead of one each. On receive it enables UDP_GRO, which lets the kernel
+# hand back a train of datagrams from the same sender as one buffer plus
+# the segment size; recvfrom() splits it and returns the datagrams one by
+# one from a queue.
+#
+# Kernels or platforms without these options fall back to one sendto() /
+# recvfrom() per datagram (Python has no sendmmsg()); so does a socket whose
+# first segmented send fails. The socket buffers are enlarged either way,
+# since a window of datagrams arriving at once overflows the default ones.
+
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)  # Linux 4.18
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)  # Linux 5.0
+IP_MTU = getattr(socket, 'IP_MTU', 14)  # Path MTU of a connected socket (Linux)
+IP_UDP_OVERHEAD = 28  # IPv4 and UDP headers
+MAX_DATAGRAM = 65507  # Largest UDP payload over IPv4
+GSO_MAX_SEGMENTS = 64  # Kernel limit on datagrams per segmented send
+SEGMENT_SIZE = struct.Struct('=H')
+GRO_SIZE = struct.Struct('=i')
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024  # Requested SO_SNDBUF/SO_RCVBUF (capped by the kernel)
+RECV_SIZE = 65535
+
+# Errors meaning the kernel or device cannot segment for us
+OFFLOAD_ERRORS = (errno.EIO, errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP)
+
+
+# Ask for larger socket buffers; the kernel silently caps them
+def set_buffer_sizes(sock, size=SOCKET_BUFFER_SIZE):
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError:
+            pass
+
+
+def _gso_supported(sock):
+    if sys.platform != 'linux':
+        return False
+    try:
+        sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+    except OSError:
+        return False
+    return True
+
+
+def _enable_gro(sock):
+    if sys.platform != 'linux' or not hasattr(socket, 'CMSG_SPACE'):
+        return False
+    try:
+        sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+    except OSError:
+        return False
+    return True
+
+
+# Largest UDP payload that fits the path MTU towards addr, or None if the
+# platform cannot tell
+def path_max_datagram(addr):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        try:
+            probe.connect(addr)
+            mtu = probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        except OSError:
+            return None
+    return min(mtu - IP_UDP_OVERHEAD, MAX_DATAGRAM)
+
+
+class DatagramIO:
+    def __init__(self, sock, offload=True, buffer_size=SOCKET_BUFFER_SIZE):
+        self.sock = sock
+        set_buffer_sizes(sock, buffer_size)
+        self.gso = offload and _gso_supported(sock)
+        self.gro = offload and _enable_gro(sock)
+        self.received = collections.deque()  # Datagrams split off a GRO buffer, with their sender
+        self.send_calls = 0
+        self.datagrams_sent = 0
+        self.recv_calls = 0
+        self.datagrams_received = 0
+
+    # Datagrams already received but not yet returned by recvfrom()
+    @property
+    def pending(self):
+        return len(self.received)
+
+    def sendto(self, datagram, addr):
+        self.send_calls += 1
+        self.datagrams_sent += 1
+        return self.sock.sendto(datagram, addr)
+
+    # Send datagrams to addr in order, segmented where possible
+    def send(self, datagrams, addr):
+        i = 0
+        while i < len(datagrams):
+            if not self.gso:
+                self.sendto(datagrams[i], addr)
+                i += 1
+                continue
+            # A batch is a run of datagrams of one size, of which only the
+            # last may be shorter
+            size = len(datagrams[i])
+            total = size
+            j = i + 1
+            while j < len(datagrams) and j - i < GSO_MAX_SEGMENTS:
+                length = len(datagrams[j])
+                if length > size or total + length > MAX_DATAGRAM:
+                    break
+                total += length
+                j += 1
+                if length < size:
+                    break
+            if j - i == 1:
+                self.sendto(datagrams[i], addr)
+                i += 1
+                continue
+            try:
+                self.sock.sendmsg(datagrams[i:j], [(SOL_UDP, UDP_SEGMENT, SEGMENT_SIZE.pack(size))], 0, addr)
+            except OSError as e:
+                if e.errno not in OFFLOAD_ERRORS:
+                    raise
+                self.gso = False  # Resend this batch one datagram at a time
+                continue
+            self.send_calls += 1
+            self.datagrams_sent += j - i
+            i = j
+
+    # Return the next (datagram, address); the socket's timeout applies when
+    # nothing is queued
+    def recvfrom(self):
+        if self.received:
+            return self.received.popleft()
+        if not self.gro:
+            datagram, addr = self.sock.recvfrom(RECV_SIZE)
+            self.recv_calls += 1
+            self.datagrams_received += 1
+            return datagram, addr
+        data, ancdata, _, addr = self.sock.recvmsg(RECV_SIZE, socket.CMSG_SPACE(GRO_SIZE.size))
+        self.recv_calls += 1
+        segment = 0
+        for level, kind, cdata in ancdata:
+            if level == SOL_UDP and kind == UDP_GRO and len(cdata) >= GRO_SIZE.size:
+                segment = GRO_SIZE.unpack_from(cdata)[0]
+        if segment <= 0 or segment >= len(data):
+            self.datagrams_received += 1
+            return data, addr
+        view = memoryview(data)
+        for start in range(segment, len(data), segment):
+            self.received.append((view[start:start + segment], addr))
+        self.datagrams_received += 1 + len(self.received)
+        return view[:segment], addr
+
+    def stats(self):
+        return {
+            'gso': self.gso,
+            'gro': self.gro,
+            'send_calls': self.send_calls,
+            'datagrams_sent': self.datagrams_sent,
+            'recv_calls': self.recv_calls,
+            'datagrams_received': self.datagrams_received,
+        }
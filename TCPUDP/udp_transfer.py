@@ -0,0 +1,769 @@
+import random
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import fec
+import integrity
+import udp_io
+
+# Sliding-window (selective-repeat) UDP transfer protocol shared by client.py
+# and server.py.
+#
+# Every datagram starts with HEADER: a 1-byte packet kind, the 32-bit transfer
+# ID chosen by the client (so one server port can demultiplex many concurrent
+# transfers, even several from the same address) and a 32-bit sequence number.
+# DATA packets carry up to PAYLOAD_SIZE bytes of the file. The receiver
+# answers each packet with an ACK whose sequence number is the next in-order
+# packet it expects (cumulative ACK) followed by a 64-bit bitmap of the packets
+# after that which it already buffered (selective ACK). The sender keeps up to
+# WINDOW_SIZE packets in flight and retransmits each one when its own timer,
+# derived from the measured round-trip time, runs out.
+#
+# Within that window the sender is limited by a congestion window (cwnd)
+# kept by a pluggable CongestionControl -- Reno-style AIMD by default -- and
+# by the window the receiver advertises in every ACK (its free reorder-buffer
+# slots). New packets are paced by a token bucket refilled at cwnd / RTT, so
+# a window goes out spread over a round trip instead of in one burst.
+#
+# With FEC (the command carries "fec=K,M", see fec.py) the sender follows
+# every block of K DATA packets with M REPAIR packets, from which the
+# receiver rebuilds lost packets without a retransmit round trip.
+#
+# Datagrams go through udp_io.DatagramIO, which batches them with UDP
+# segmentation offload where the kernel supports it. The command may also
+# carry "payload=N" to use larger DATA packets, up to what the path MTU
+# allows (path_payload_size()); the window shrinks to keep its bytes the same.
+#
+# Every datagram ends with PACKET_CHECKSUM, the CRC32 of everything before
+# it. A datagram that fails it is dropped like a lost one, so a corrupted
+# DATA packet is all that gets sent again. The FIN carries the hash of the
+# whole file, which both sides compute as the data goes through them (see
+# integrity.py); a receiver whose file does not match answers with an ERROR
+# instead of the FIN_ACK.
+
+HEADER = struct.Struct('!BII')  # kind, transfer ID, sequence number
+SACK_BITMAP = struct.Struct('!Q')
+ADVERTISED_WINDOW = struct.Struct('!I')  # Follows the SACK bitmap in an ACK
+RECOVERED_COUNT = struct.Struct('!I')
+PACKET_CHECKSUM = struct.Struct('!I')  # Trailer: CRC32 of the header and body
+SACK_BITS = 64
+
+# Packet kinds
+PACKET_CMD = 0  # client -> server: "put <name>" / "get <name>"
+PACKET_READY = 1  # server -> client: command accepted
+PACKET_ERROR = 2  # command refused or transfer failed, body is the reason
+PACKET_DATA = 3
+PACKET_ACK = 4
+PACKET_FIN = 5  # sequence number is the total number of DATA packets, body the file's hash
+PACKET_FIN_ACK = 6  # body: packets the receiver rebuilt through FEC
+PACKET_REPAIR = 7  # FEC repair; sequence number is the first of its block
+
+# Tunables
+PAYLOAD_SIZE = 1400  # File bytes per DATA packet (fits an Ethernet MTU)
+WINDOW_SIZE = 128  # DATA packets in flight
+MIN_WINDOW_SIZE = 16  # Window used however large the payloads get
+MAX_PAYLOAD_SIZE = udp_io.MAX_DATAGRAM - HEADER.size - PACKET_CHECKSUM.size - fec.REPAIR_HEADER.size
+INITIAL_RTO = 0.2  # Retransmit timeout (s) before the first RTT sample
+MIN_RTO = 0.01
+MAX_RTO = 2.0
+MAX_RETRANSMITS = 12  # Give up once a single packet was resent this often
+DUP_THRESHOLD = 3  # Resend a hole once this many later packets were SACKed
+IDLE_TIMEOUT = 10.0  # Give up when the peer stays silent this long (s)
+LINGER_TIME = 0.5  # Keep answering retransmitted FINs after completion (s), in the background
+STORE_POLL_INTERVAL = 0.005  # How often a receiver checks whether its file is stored yet (s)
+STORE_KEEPALIVE = 1.0  # ACKs sent this often meanwhile, so the sender does not give up on us (s)
+COMMAND_RETRIES = 5
+
+# Congestion control
+CONGESTION_CONTROL = 'reno'  # Name of the algorithm new senders use
+INITIAL_CWND = 10  # Packets sent before the first ACK
+MIN_CWND = 2  # Floor of the slow-start threshold
+PACING_GAIN = 1.25  # Pace at this multiple of cwnd / RTT ...
+SLOW_START_PACING_GAIN = 2.0  # ... or this one while cwnd is still doubling
+PACING_QUANTUM = 0.002  # Seconds of sending the token bucket may hold
+MIN_PACING_BURST = 2  # Packets the token bucket always holds at least
+
+
+class TransferError(Exception):
+    pass
+
+
+# Build a datagram from its parts
+def encode_packet(kind, transfer_id, seq=0, body=b''):
+    packet = HEADER.pack(kind, transfer_id, seq) + body
+    return packet + PACKET_CHECKSUM.pack(zlib.crc32(packet))
+
+
+# Split a datagram into (kind, transfer_id, seq, body); returns None for runt
+# and corrupted packets
+def decode_packet(datagram):
+    if len(datagram) < HEADER.size + PACKET_CHECKSUM.size:
+        return None
+    view = memoryview(datagram)
+    end = len(datagram) - PACKET_CHECKSUM.size
+    if PACKET_CHECKSUM.unpack_from(view, end)[0] != zlib.crc32(view[:end]):
+        return None
+    kind, transfer_id, seq = HEADER.unpack_from(view)
+    return kind, transfer_id, seq, view[HEADER.size:end]
+
+
+# Window (in packets) holding about as many bytes as the default one when
+# packets carry payload_size bytes
+def window_for(payload_size):
+    return max(WINDOW_SIZE * PAYLOAD_SIZE // payload_size, MIN_WINDOW_SIZE)
+
+
+# Largest payload whose DATA and FEC repair datagrams fit the path MTU
+# towards addr; PAYLOAD_SIZE when the MTU cannot be found out
+def path_payload_size(addr):
+    datagram = udp_io.path_max_datagram(addr)
+    if datagram is None:
+        return PAYLOAD_SIZE
+    return max(min(datagram - HEADER.size - PACKET_CHECKSUM.size - fec.REPAIR_HEADER.size, MAX_PAYLOAD_SIZE), 1)
+
+
+# Of several ACKs waiting to go to one peer only the last matters, since
+# each carries the receiver's whole state
+def coalesce_acks(datagrams):
+    last_ack = None
+    for i, datagram in enumerate(datagrams):
+        if datagram[0] == PACKET_ACK:
+            last_ack = i
+    return [datagram for i, datagram in enumerate(datagrams) if datagram[0] != PACKET_ACK or i == last_ack]
+
+
+# Pick a transfer ID for a new client-side transfer
+def new_transfer_id():
+    return random.getrandbits(32)
+
+
+# Smoothed RTT / retransmit timeout estimator (RFC 6298)
+class RttEstimator:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def backoff(self):
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+
+# Interface of a congestion control algorithm. cwnd is the number of DATA
+# packets the sender may have in flight; the sender reports every ACK and
+# every congestion event to the algorithm, which adjusts cwnd. Losses are
+# reported at most once per window of data.
+class CongestionControl:
+    name = None
+
+    def __init__(self, max_cwnd):
+        self.max_cwnd = max_cwnd
+        self.cwnd = min(INITIAL_CWND, max_cwnd)
+        self.ssthresh = None
+
+    # acked packets left the network; rtt is a new sample in seconds or None
+    def on_ack(self, acked, rtt, now):
+        pass
+
+    # A packet was lost (detected through SACK) with in_flight packets out
+    def on_loss(self, in_flight, now):
+        pass
+
+    # A retransmit timer expired
+    def on_timeout(self, in_flight, now):
+        pass
+
+    # Packets per second to pace new data at, or None to send unpaced
+    def pacing_rate(self, srtt):
+        if srtt is None:
+            return None
+        return PACING_GAIN * self.cwnd / max(srtt, 1e-6)
+
+
+# Reno-style AIMD: slow start doubles cwnd every round trip up to ssthresh,
+# congestion avoidance adds one packet per round trip, a loss halves cwnd
+# and a timeout collapses it to one packet
+class RenoCongestionControl(CongestionControl):
+    name = 'reno'
+
+    def in_slow_start(self):
+        return self.ssthresh is None or self.cwnd < self.ssthresh
+
+    def on_ack(self, acked, rtt, now):
+        if self.in_slow_start():
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_cwnd)
+
+    def on_loss(self, in_flight, now):
+        self.ssthresh = max(min(in_flight, self.cwnd) / 2, MIN_CWND)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, in_flight, now):
+        self.ssthresh = max(min(in_flight, self.cwnd) / 2, MIN_CWND)
+        self.cwnd = 1
+
+    def pacing_rate(self, srtt):
+        if srtt is None:
+            return None
+        gain = SLOW_START_PACING_GAIN if self.in_slow_start() else PACING_GAIN
+        return gain * self.cwnd / max(srtt, 1e-6)
+
+
+# No congestion control: the whole window is sent unpaced, as before
+# congestion control existed. Useful as a baseline in benchmarks.
+class FixedWindow(CongestionControl):
+    name = 'fixed'
+
+    def __init__(self, max_cwnd):
+        super().__init__(max_cwnd)
+        self.cwnd = max_cwnd
+
+    def pacing_rate(self, srtt):
+        return None
+
+
+congestion_controls = {}  # name -> CongestionControl subclass
+
+
+def register_congestion_control(cls):
+    congestion_controls[cls.name] = cls
+
+
+register_congestion_control(RenoCongestionControl)
+register_congestion_control(FixedWindow)
+
+
+# Create the algorithm called name, or return control if it already is one
+def new_congestion_control(control, max_cwnd):
+    if isinstance(control, CongestionControl):
+        return control
+    cls = congestion_controls.get(control)
+    if cls is None:
+        raise TransferError(f"Unknown congestion control {control}")
+    return cls(max_cwnd)
+
+
+# Token bucket for pacing: refilled at the pacing rate and holding at most
+# PACING_QUANTUM seconds worth of packets, so each poll sends a small burst
+class Pacer:
+    def __init__(self):
+        self.rate = None  # Packets per second; None sends without pacing
+        self.tokens = 0.0
+        self.updated = None
+
+    def refill(self, rate, now):
+        if rate is None:
+            self.rate = None
+            return
+        burst = max(rate * PACING_QUANTUM, MIN_PACING_BURST)
+        if self.rate is None:
+            self.tokens = burst
+        else:
+            self.tokens = min(self.tokens + (now - self.updated) * rate, burst)
+        self.rate = rate
+        self.updated = now
+
+    def ready(self):
+        return self.rate is None or self.tokens >= 1
+
+    # Retransmissions spend tokens too but are never held back, so the
+    # bucket may go negative
+    def spend(self):
+        if self.rate is not None:
+            self.tokens -= 1
+
+    def wait_time(self):
+        if self.ready():
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+# In-flight bookkeeping for one DATA packet
+class _Outstanding:
+    __slots__ = ('payload', 'sent_at', 'deadline', 'sends', 'fast_retransmitted')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.sent_at = 0.0
+        self.deadline = 0.0
+        self.sends = 0
+        self.fast_retransmitted = False
+
+
+# Sending half of a transfer: reads the file and produces DATA/FIN packets
+class WindowSender:
+    def __init__(self, f, transfer_id, window=WINDOW_SIZE, payload_size=PAYLOAD_SIZE,
+                 congestion_control=None, fec_params=None):
+        self.f = f
+        self.transfer_id = transfer_id
+        self.window = window
+        self.payload_size = payload_size
+        self.rtt = RttEstimator()
+        self.cc = new_congestion_control(congestion_control or CONGESTION_CONTROL, window)
+        self.pacer = Pacer()
+        self.peer_window = window  # Free slots the receiver last advertised
+        self.recovery_seq = 0  # Losses below this belong to the last congestion event
+        self.recovery_time = 0.0  # Timeouts of packets sent before this too
+        self.fec_params = fec_params  # (K, M) or None
+        self.encoder = fec.BlockEncoder(*fec_params) if fec_params else None
+        self.hasher = integrity.new_hasher()  # Fed the file as it is read, for the FIN
+        self.base = 0  # Lowest sequence number not yet acknowledged
+        self.next_seq = 0
+        self.total = None  # Number of DATA packets, known at end of file
+        self.outstanding = {}
+        self.fin_deadline = None
+        self.fin_sends = 0
+        self.last_heard = time.monotonic()
+        self.last_progress = 0.0  # When an ACK last covered new data
+        self.done = False
+        self.packets_sent = 0
+        self.bytes_sent = 0  # File bytes sent, retransmissions not counted again
+        self.retransmits = 0
+        self.fast_retransmits = 0
+        self.timeouts = 0
+        self.loss_events = 0
+        self.repairs_sent = 0
+        self.peer_recovered = 0  # Packets the receiver rebuilt, from its FIN_ACK
+        self.min_rtt = None
+        self.peak_cwnd = self.cc.cwnd
+        self.started = time.monotonic()
+
+    def _send(self, seq, entry, now):
+        entry.sends += 1
+        entry.sent_at = now
+        entry.deadline = now + self.rtt.rto
+        self.packets_sent += 1
+        self.pacer.spend()
+        return encode_packet(PACKET_DATA, self.transfer_id, seq, entry.payload)
+
+    def _repairs(self, block):
+        if block is None:
+            return []
+        block_start, bodies = block
+        out = []
+        for body in bodies:
+            self.repairs_sent += 1
+            self.pacer.spend()
+            out.append(encode_packet(PACKET_REPAIR, self.transfer_id, block_start, body))
+        return out
+
+    # Room for a new packet under the window, cwnd and receiver's window
+    def _can_send(self):
+        return (self.total is None
+                and self.next_seq < self.base + min(self.window, self.peer_window)
+                and len(self.outstanding) < self.cc.cwnd)
+
+    def _start_recovery(self, now):
+        self.loss_events += 1
+        self.recovery_seq = self.next_seq
+        self.recovery_time = now
+
+    def _retransmit(self, seq, entry, now):
+        if entry.sends > MAX_RETRANSMITS:
+            raise TransferError(f"Packet {seq} was not acknowledged after {entry.sends} attempts")
+        self.retransmits += 1
+        return self._send(seq, entry, now)
+
+    # Return the datagrams that are due now: new packets while the window has
+    # room, packets whose timer expired, and the FIN once everything is acked.
+    def poll(self, now):
+        if self.done:
+            return []
+        if now - self.last_heard > IDLE_TIMEOUT:
+            raise TransferError("Receiver stopped responding")
+        out = []
+        timed_out = False
+        new_event = False
+        for seq, entry in self.outstanding.items():
+            if entry.deadline <= now:
+                if now - self.last_progress < self.rtt.rto:
+                    # ACKs for newer data are still arriving, so the path is
+                    # only slower (queueing), not stalled; as with TCP's
+                    # retransmit timer, expire only an RTO after the last
+                    # one. Losses meanwhile are found through SACK.
+                    entry.deadline = self.last_progress + self.rtt.rto
+                    continue
+                if entry.sent_at >= self.recovery_time:
+                    new_event = True
+                out.append(self._retransmit(seq, entry, now))
+                timed_out = True
+        if timed_out:
+            self.timeouts += 1
+            self.rtt.backoff()
+            if new_event:
+                self.cc.on_timeout(len(self.outstanding), now)
+                self._start_recovery(now)
+        self.pacer.refill(self.cc.pacing_rate(self.rtt.srtt), now)
+        while self._can_send() and self.pacer.ready():
+            payload = self.f.read(self.payload_size)
+            if not payload:
+                self.total = self.next_seq
+                if self.encoder is not None:
+                    out.extend(self._repairs(self.encoder.flush()))
+                break
+            self.hasher.update(payload)
+            self.bytes_sent += len(payload)
+            entry = _Outstanding(payload)
+            self.outstanding[self.next_seq] = entry
+            out.append(self._send(self.next_seq, entry, now))
+            if self.encoder is not None:
+                out.extend(self._repairs(self.encoder.add(self.next_seq, payload)))
+            self.next_seq += 1
+        if self.total is not None and not self.outstanding:
+            if self.fin_deadline is None or self.fin_deadline <= now:
+                if self.fin_sends > MAX_RETRANSMITS:
+                    raise TransferError("FIN was not acknowledged")
+                self.fin_sends += 1
+                self.fin_deadline = now + self.rtt.rto * (2 ** (self.fin_sends - 1))
+                out.append(encode_packet(PACKET_FIN, self.transfer_id, self.total, self.hasher.digest()))
+        return out
+
+    # Process an ACK/FIN_ACK/ERROR from the receiver; returns datagrams to send
+    def handle(self, kind, seq, body, now):
+        self.last_heard = now
+        if kind == PACKET_ERROR:
+            raise TransferError(f"Receiver gave up: {bytes(body).decode(errors='replace')}")
+        if kind == PACKET_FIN_ACK and self.total is not None and seq == self.total:
+            if len(body) >= RECOVERED_COUNT.size:
+                self.peer_recovered = RECOVERED_COUNT.unpack_from(body)[0]
+            self.done = True
+            return []
+        if kind != PACKET_ACK:
+            return []
+        newest_sample = None
+        newly_acked = 0
+        for acked in range(self.base, seq):
+            entry = self.outstanding.pop(acked, None)
+            if entry is not None:
+                newly_acked += 1
+                if entry.sends == 1:
+                    newest_sample = entry.sent_at
+        self.base = max(self.base, seq)
+        highest_sacked = None
+        if len(body) >= SACK_BITMAP.size:
+            bitmap = SACK_BITMAP.unpack_from(body)[0]
+            while bitmap:
+                low_bit = bitmap & -bitmap
+                acked = seq + low_bit.bit_length()
+                bitmap ^= low_bit
+                entry = self.outstanding.pop(acked, None)
+                if entry is not None:
+                    newly_acked += 1
+                    if entry.sends == 1:
+                        newest_sample = max(newest_sample or 0.0, entry.sent_at)
+                highest_sacked = acked
+        if len(body) >= SACK_BITMAP.size + ADVERTISED_WINDOW.size:
+            self.peer_window = ADVERTISED_WINDOW.unpack_from(body, SACK_BITMAP.size)[0]
+        rtt = None
+        if newest_sample is not None:
+            rtt = now - newest_sample
+            self.rtt.sample(rtt)
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        if newly_acked:
+            self.last_progress = now
+            self.cc.on_ack(newly_acked, rtt, now)
+            self.peak_cwnd = max(self.peak_cwnd, self.cc.cwnd)
+        out = []
+        if highest_sacked is not None:
+            # Holes well below the highest SACKed packet are almost certainly
+            # lost; resend them once without waiting for the timer. With FEC
+            # the hole's block must be over first, so its repairs had their
+            # chance to rebuild it.
+            for hole, entry in self.outstanding.items():
+                last = hole
+                if self.fec_params is not None:
+                    last = hole - hole % self.fec_params[0] + self.fec_params[0]
+                if last + DUP_THRESHOLD > highest_sacked:
+                    break
+                if not entry.fast_retransmitted:
+                    if hole >= self.recovery_seq:
+                        self.cc.on_loss(len(self.outstanding), now)
+                        self._start_recovery(now)
+                    entry.fast_retransmitted = True
+                    self.fast_retransmits += 1
+                    out.append(self._retransmit(hole, entry, now))
+        return out
+
+    def next_timeout(self, now):
+        if self._can_send():
+            return self.pacer.wait_time()
+        deadlines = [entry.deadline for entry in self.outstanding.values()]
+        if self.fin_deadline is not None and not self.outstanding:
+            deadlines.append(self.fin_deadline)
+        if not deadlines:
+            return IDLE_TIMEOUT
+        return max(min(deadlines) - now, 0.0)
+
+    # Congestion and retransmit figures of the transfer so far
+    def stats(self):
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+        return {
+            'congestion_control': self.cc.name,
+            'packets_sent': self.packets_sent,
+            'bytes_sent': self.bytes_sent,
+            'retransmits': self.retransmits,
+            'fast_retransmits': self.fast_retransmits,
+            'timeouts': self.timeouts,
+            'loss_events': self.loss_events,
+            'cwnd': round(self.cc.cwnd, 2),
+            'peak_cwnd': round(self.peak_cwnd, 2),
+            'ssthresh': None if self.cc.ssthresh is None else round(self.cc.ssthresh, 2),
+            'peer_window': self.peer_window,
+            'srtt_ms': ms(self.rtt.srtt),
+            'min_rtt_ms': ms(self.min_rtt),
+            'rto_ms': ms(self.rtt.rto),
+            'fec': None if self.fec_params is None else fec.format_option(*self.fec_params),
+            'repairs_sent': self.repairs_sent,
+            'recovered': self.peer_recovered,
+            'seconds': round(time.monotonic() - self.started, 3),
+        }
+
+    # One-line version of stats() for log messages
+    def describe(self):
+        stats = self.stats()
+        text = (f"{stats['packets_sent']} packets, {stats['retransmits']} retransmitted "
+                f"({stats['fast_retransmits']} fast, {stats['timeouts']} timeouts), "
+                f"{stats['congestion_control']} cwnd {stats['cwnd']} (peak {stats['peak_cwnd']}), "
+                f"srtt {stats['srtt_ms']} ms")
+        if self.fec_params is not None:
+            text += f", {stats['repairs_sent']} FEC repairs, {stats['recovered']} packets recovered"
+        return text
+
+
+# Receiving half of a transfer: reorders DATA packets and writes the file.
+# on_complete, if given, is called once the whole file is written and
+# matches the sender's hash, before the FIN is acknowledged; the file's
+# chunk CRCs and hash are then in self.checksum. It may return a
+# concurrent.futures.Future for work that finishes elsewhere (storing the
+# file on a worker thread): the FIN is then acknowledged by poll() once the
+# future is done, and answered with ACKs until then.
+class WindowReceiver:
+    def __init__(self, f, transfer_id, window=WINDOW_SIZE, on_complete=None, fec_params=None):
+        self.f = f
+        self.transfer_id = transfer_id
+        self.window = window
+        self.on_complete = on_complete
+        self.decoder = fec.BlockDecoder(*fec_params) if fec_params else None
+        self.checksum = integrity.StreamChecksum()  # Fed the data in order as it is written
+        self.expected = 0  # Next in-order sequence number
+        self.buffered = {}  # Out-of-order packets waiting for a hole to fill
+        self.total = None
+        self.last_heard = time.monotonic()
+        self.storing = None  # Future returned by on_complete, until it is done
+        self.last_keepalive = 0.0
+        self.done = False
+        self.bytes_received = 0
+        self.packets_received = 0
+        self.duplicates = 0
+
+    # The ACK also advertises how many more packets the reorder buffer can
+    # take. Packets are written out as they arrive in order, so a slow disk
+    # delays the ACKs themselves and the sender's ACK clock slows with it.
+    def _ack(self):
+        bitmap = 0
+        for seq in self.buffered:
+            offset = seq - self.expected - 1
+            if offset < SACK_BITS:
+                bitmap |= 1 << offset
+        free = max(self.window - len(self.buffered), 0)
+        return encode_packet(PACKET_ACK, self.transfer_id, self.expected,
+                             SACK_BITMAP.pack(bitmap) + ADVERTISED_WINDOW.pack(free))
+
+    def poll(self, now):
+        if self.storing is not None:
+            if not self.storing.done():
+                if now - self.last_keepalive < STORE_KEEPALIVE:
+                    return []
+                self.last_keepalive = now
+                return [self._ack()]
+            storing, self.storing = self.storing, None
+            try:
+                storing.result()
+            except Exception as e:
+                raise TransferError(f"Storing the file failed: {e}") from e
+            self.done = True
+            return [self._fin_ack()]
+        if not self.done and now - self.last_heard > IDLE_TIMEOUT:
+            raise TransferError("Sender stopped responding")
+        return []
+
+    def _fin_ack(self):
+        return encode_packet(PACKET_FIN_ACK, self.transfer_id, self.total, RECOVERED_COUNT.pack(self.recovered))
+
+    # Take in the payload of DATA packet seq, writing out whatever is now in
+    # order; returns False for duplicates and packets outside the window
+    def _accept(self, seq, payload):
+        if not self.expected <= seq < self.expected + self.window or seq in self.buffered:
+            return False
+        self.buffered[seq] = payload
+        while self.expected in self.buffered:
+            payload = self.buffered.pop(self.expected)
+            self.f.write(payload)
+            self.checksum.update(payload)
+            self.bytes_received += len(payload)
+            self.expected += 1
+        return True
+
+    def _accept_rebuilt(self, rebuilt):
+        for seq, payload in rebuilt:
+            self._accept(seq, payload)
+        self.decoder.forget_below(self.expected)
+
+    def handle(self, kind, seq, body, now):
+        self.last_heard = now
+        if kind == PACKET_DATA:
+            payload = bytes(body)
+            if self._accept(seq, payload):
+                self.packets_received += 1
+                if self.decoder is not None:
+                    self._accept_rebuilt(self.decoder.add(seq, payload))
+            else:
+                self.duplicates += 1
+            return [self._ack()]
+        if kind == PACKET_REPAIR:
+            if self.decoder is None or self.done:
+                return []
+            rebuilt = self.decoder.add_repair(seq, bytes(body))
+            if not rebuilt:
+                return []
+            self._accept_rebuilt(rebuilt)
+            return [self._ack()]
+        if kind == PACKET_FIN:
+            self.total = seq
+            if self.expected == self.total:
+                if not self.done and self.storing is None:
+                    digest = bytes(body)
+                    if digest and digest != self.checksum.digest():
+                        raise TransferError("File does not match the sender's hash")
+                    self.f.flush()
+                    if self.on_complete is not None:
+                        self.storing = self.on_complete()
+                        self.last_keepalive = now
+                if self.storing is not None:
+                    return [self._ack()]  # Still storing; poll() sends the FIN_ACK
+                self.done = True
+                return [self._fin_ack()]
+            return [self._ack()]
+        return []
+
+    def next_timeout(self, now):
+        return STORE_POLL_INTERVAL if self.storing is not None else IDLE_TIMEOUT
+
+    @property
+    def recovered(self):
+        return self.decoder.recovered if self.decoder is not None else 0
+
+    def stats(self):
+        return {
+            'packets_received': self.packets_received,
+            'bytes_received': self.bytes_received,
+            'duplicates': self.duplicates,
+            'recovered': self.recovered,
+            'repairs_received': self.decoder.repairs_received if self.decoder is not None else 0,
+        }
+
+    # One-line version of stats() for log messages
+    def describe(self):
+        stats = self.stats()
+        text = f"{stats['bytes_received']} bytes in {stats['packets_received']} packets, {stats['duplicates']} duplicates"
+        if self.decoder is not None:
+            text += f", {stats['recovered']} recovered from {stats['repairs_received']} FEC repairs"
+        return text
+
+
+# Drive a WindowSender/WindowReceiver over a blocking socket (wrapped in a
+# udp_io.DatagramIO) until the transfer completes. ready_packet is resent if
+# the peer repeats its command because our READY got lost. A receiver returns
+# as soon as the file is complete and verified; FINs the sender repeats
+# after that are answered by linger().
+def run_transfer(io, peer, endpoint, ready_packet=None):
+    replies = []
+    while True:
+        now = time.monotonic()
+        if replies and not io.pending:
+            # Datagrams that arrived in one batch are answered together
+            io.send(coalesce_acks(replies), peer)
+            replies = []
+        io.send(endpoint.poll(now), peer)
+        if endpoint.done:
+            if replies:
+                io.send(coalesce_acks(replies), peer)  # The FIN_ACK among them
+            if isinstance(endpoint, WindowReceiver):
+                linger(io, peer, endpoint)
+            return endpoint
+        io.sock.settimeout(max(endpoint.next_timeout(now), 0.001))
+        try:
+            datagram, addr = io.recvfrom()
+        except socket.timeout:
+            continue
+        if addr != peer:
+            continue
+        packet = decode_packet(datagram)
+        if packet is None or packet[1] != endpoint.transfer_id:
+            continue
+        kind, _, seq, body = packet
+        if kind == PACKET_CMD:
+            if ready_packet is not None:
+                io.sendto(ready_packet, peer)
+            continue
+        try:
+            replies.extend(endpoint.handle(kind, seq, body, time.monotonic()))
+        except TransferError as e:
+            if kind != PACKET_ERROR:
+                io.sendto(encode_packet(PACKET_ERROR, endpoint.transfer_id, 0, str(e).encode()), peer)
+            raise
+
+
+# Answer the FINs a sender repeats when our FIN_ACK got lost, for
+# LINGER_TIME after a receiver completed, on a thread of its own. It works on
+# a duplicate of io's socket, so the caller may close its own right away.
+def linger(io, peer, receiver):
+    linger_io = udp_io.DatagramIO(io.sock.dup(), offload=io.gro)
+
+    def answer():
+        with linger_io.sock:
+            deadline = time.monotonic() + LINGER_TIME
+            while (remaining := deadline - time.monotonic()) > 0:
+                linger_io.sock.settimeout(remaining)
+                try:
+                    datagram, addr = linger_io.recvfrom()
+                except (socket.timeout, OSError):
+                    return
+                packet = decode_packet(datagram)
+                if addr == peer and packet is not None and packet[:2] == (PACKET_FIN, receiver.transfer_id):
+                    linger_io.send(receiver.handle(PACKET_FIN, packet[2], packet[3], time.monotonic()), peer)
+
+    threading.Thread(target=answer, name='udp-linger', daemon=True).start()
+
+
+# Client side of the command handshake: send CMD until the server answers.
+# Returns the first reply packet (READY, ERROR, or early DATA).
+def request(io, peer, transfer_id, command, timeout):
+    io.sock.settimeout(timeout)
+    for _ in range(COMMAND_RETRIES):
+        io.sendto(encode_packet(PACKET_CMD, transfer_id, 0, command.encode()), peer)
+        try:
+            while True:
+                datagram, addr = io.recvfrom()
+                if addr != peer:
+                    continue
+                packet = decode_packet(datagram)
+                if packet is not None and packet[1] == transfer_id:
+                    return packet
+        except socket.timeout:
+            continue
+    raise TransferError("Server did not answer the command")